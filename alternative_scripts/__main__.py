@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+
+# python alternative_scripts <command> ...
+from ena import main
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+import subprocess
+from datetime import datetime
+from collections import deque
+
+import events
+import profiling
+import io_engine
+
+
+# Seconds between two throughput measures, and concurrency decisions
+DEFAULT_INTERVAL = 10
+# A failed transfer is tried again (lftp put -c continues it) this many times
+MAX_RETRIES = 3
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(text: str) -> int:
+    """
+    Bytes per second from '800K', '20M', '1G' or a number, as lftp's
+    net:limit-rate. 0, 'none' or 'unlimited' mean no limit (0).
+    """
+    text = str(text).strip().upper()
+    if text in ("", "0", "NONE", "UNLIMITED"):
+        return 0
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]?)B?(?:/S)?", text)
+    if not match:
+        raise ValueError(f"[!] Rate not understood: {text} (e.g. 800K, 20M, 1G bytes per second)")
+
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2)])
+
+
+def format_rate(rate: float) -> str:
+    return f"{rate / 1e6:.1f} MB/s" if rate else "unlimited"
+
+
+class Schedule:
+    """
+    Upload rate caps by time of day, e.g. '08:00-19:00=20M,19:00-08:00=0':
+    20 MB/s during working hours, no limit at night. A window may cross
+    midnight; outside the listed windows the default cap applies.
+    """
+
+    def __init__(self, spec: str = None, default: int = 0):
+        self.default = default
+        self.windows = []
+        for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+            match = re.fullmatch(r"(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)", item)
+            if not match:
+                raise ValueError(f"[!] Schedule window not understood: {item} (e.g. 08:00-19:00=20M)")
+            start = int(match.group(1)) * 60 + int(match.group(2))
+            end = int(match.group(3)) * 60 + int(match.group(4))
+            self.windows.append((start, end, parse_rate(match.group(5))))
+
+    def cap(self, now: datetime = None) -> int:
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate
+
+        return self.default
+
+
+class AimdController:
+    """
+    Number of transfers run at the same time, adapted to the observed
+    throughput as TCP adapts its window (additive increase, multiplicative
+    decrease):
+        - one more transfer per interval while it brings more throughput;
+        - back one step when the last one brought nothing (uplink full),
+          staying there for hold intervals before probing again;
+        - halved when transfers fail or the throughput falls by more than
+          drop_threshold at the same concurrency (other users of the uplink,
+          congestion; smaller falls are the gaps between two files).
+    Under a rate cap, a throughput close to the cap is enough: no increase.
+    """
+
+    def __init__(
+        self,
+        min_workers: int = 1,
+        max_workers: int = 8,
+        decrease: float = 0.5,
+        error_threshold: float = 0.1,
+        gain_threshold: float = 0.05,
+        drop_threshold: float = 0.25,
+        hold: int = 6
+    ):
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.decrease = decrease
+        self.error_threshold = error_threshold
+        self.gain_threshold = gain_threshold
+        self.drop_threshold = drop_threshold
+        self.hold = hold
+
+        self.concurrency = min_workers
+        self.previous = None
+        self.holding = 0
+
+    def update(self, throughput: float, errors: int = 0, attempts: int = 0, cap: int = 0,
+               running: int = None) -> int:
+        """
+        Args:
+            throughput (float): Bytes per second over the last interval.
+            errors (int): Transfers that failed during the interval.
+            attempts (int): Transfers that ended (sent or failed) during the interval.
+            cap (int): Rate cap in force (0: none).
+            running (int): Transfers that ran the whole interval (less than the
+                           concurrency when the queue is nearly empty).
+        Returns:
+            int: Transfers to run during the next interval.
+        """
+        concurrency = self.concurrency
+        previous_concurrency, previous_throughput = self.previous or (None, None)
+        self.previous = (concurrency, throughput)
+
+        if errors and errors / max(attempts, errors) > self.error_threshold:
+            self.concurrency = max(self.min_workers, int(concurrency * self.decrease))
+            self.holding = self.hold
+        elif running is not None and running < concurrency:
+            # Not enough files left to tell anything
+            pass
+        elif previous_throughput is None or (cap and throughput >= 0.9 * cap):
+            pass
+        elif previous_concurrency == concurrency \
+                and throughput < previous_throughput * (1 - self.drop_threshold) \
+                and not self.holding:
+            # Less with the same number of transfers: someone else needs the uplink
+            self.concurrency = max(self.min_workers, int(concurrency * self.decrease))
+            self.holding = self.hold
+        elif previous_concurrency is not None and previous_concurrency < concurrency \
+                and throughput < previous_throughput * (1 + self.gain_threshold):
+            self.concurrency = previous_concurrency
+            self.holding = self.hold
+        elif self.holding:
+            self.holding -= 1
+        else:
+            self.concurrency = min(self.max_workers, concurrency + 1)
+
+        return self.concurrency
+
+
+def lftp_command(username: str, file_path: str, rate: int = 0) -> list:
+    # One session per file: net:limit-rate is per transfer
+    return [
+        "lftp",
+        f"{username}@webin2.ebi.ac.uk",
+        "-e", f'set net:limit-rate {rate}; put -c "{file_path}"; bye'
+    ]
+
+
+def process_bytes(pid: int) -> int:
+    # Bytes read by the transfer so far (Linux), None where it cannot be known
+    try:
+        with open(f"/proc/{pid}/io", mode="r") as handle:
+            for line in handle:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return None
+
+
+class UploadScheduler:
+    """
+    Runs the transfers of a file list under a time-of-day rate cap, with as
+    many at the same time as the controller decides. The cap of the moment
+    is shared by the transfers started in the interval (net:limit-rate of
+    cap / concurrency each). lftp cannot change the rate of a running
+    transfer: when the cap falls below the rates of the running ones, they
+    are stopped and started again at the new rate (put -c continues them).
+    Args:
+        file_list (list): Files to send.
+        command: Function (file_path, rate) -> command line of one transfer.
+        schedule (Schedule): Rate caps by time of day.
+        controller (AimdController): Concurrency policy.
+        interval (float): Seconds between two concurrency decisions.
+        retries (int): Attempts per file after the first one.
+    """
+
+    def __init__(
+        self,
+        file_list: list,
+        command,
+        schedule: Schedule = None,
+        controller: AimdController = None,
+        interval: float = DEFAULT_INTERVAL,
+        retries: int = MAX_RETRIES
+    ):
+        self.queue = deque((path, 0) for path in dict.fromkeys(file_list))
+        self.command = command
+        self.schedule = schedule or Schedule()
+        self.controller = controller or AimdController()
+        self.interval = interval
+        self.retries = retries
+
+        # path -> {'process', 'attempt', 'rate', 'size', 'offset', 'counted', 'start', 'baseline'}
+        self.active = {}
+        # path -> bytes already counted, for the transfers stopped to change their rate
+        self.resumed = {}
+        self.uploaded = []
+        self.failed = []
+        self.history = []
+
+    def start(self, file_path: str, attempt: int, rate: int) -> None:
+        process = subprocess.Popen(
+            self.command(file_path, rate),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        offset = self.resumed.pop(file_path, 0)
+        self.active[file_path] = {
+            "process": process,
+            "attempt": attempt,
+            "rate": rate,
+            "size": os.path.getsize(file_path),
+            "offset": offset,
+            "counted": offset,
+            "baseline": process_bytes(process.pid) or 0,
+            "start": time.perf_counter()
+        }
+        events.emit("upload_started", path=file_path, bytes=self.active[file_path]["size"], rate=rate)
+
+    def collect(self) -> tuple:
+        """
+        Accounts the bytes sent since the last call and the ended transfers.
+        Returns:
+            tuple: (bytes sent, transfers ended, failed transfers)
+        """
+        sent, ended, errors = 0, 0, 0
+        for file_path, transfer in list(self.active.items()):
+            process = transfer["process"]
+            returncode = process.poll()
+
+            if returncode is None:
+                read = process_bytes(process.pid)
+                if read is not None:
+                    # Never more than the file: the process also reads its own files
+                    progress = min(transfer["size"], transfer["offset"] + max(0, read - transfer["baseline"]))
+                    sent += max(0, progress - transfer["counted"])
+                    transfer["counted"] = max(transfer["counted"], progress)
+                continue
+
+            del self.active[file_path]
+            ended += 1
+            duration = time.perf_counter() - transfer["start"]
+            if returncode == 0:
+                sent += transfer["size"] - transfer["counted"]
+                self.uploaded.append(file_path)
+                # Sent: not worth keeping in the page cache of a shared node
+                io_engine.drop_cache(file_path)
+                events.emit("upload_finished", path=file_path, bytes=transfer["size"],
+                            duration_s=duration, ok=True)
+                continue
+
+            errors += 1
+            stderr = process.stderr.read().decode(errors="replace").strip() if process.stderr else ""
+            events.emit("upload_finished", path=file_path, bytes=transfer["size"],
+                        duration_s=duration, ok=False)
+            if transfer["attempt"] < self.retries:
+                # lftp put -c continues the partial file
+                self.queue.append((file_path, transfer["attempt"] + 1))
+            else:
+                print(f"[!] Upload failed for {file_path}: {stderr.splitlines()[-1] if stderr else returncode}")
+                self.failed.append(file_path)
+
+        return sent, ended, errors
+
+    def rerate(self, cap: int, concurrency: int) -> int:
+        """
+        When the rates of the running transfers add up to more than the cap
+        (0 is no limit), stops those faster than cap / concurrency and puts
+        them first in the queue, with the same attempt, to be started again
+        at that rate.
+        Returns:
+            int: Transfers stopped.
+        """
+        rates = [transfer["rate"] for transfer in self.active.values()]
+        if not cap or not rates or (all(rates) and sum(rates) <= cap):
+            return 0
+
+        rate = cap // concurrency
+        stopped = 0
+        for file_path, transfer in reversed(list(self.active.items())):
+            if transfer["rate"] and transfer["rate"] <= rate:
+                continue
+            process = transfer["process"]
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            if process.returncode == 0:
+                # Ended before being stopped: collected as sent
+                continue
+
+            del self.active[file_path]
+            if process.stderr:
+                process.stderr.close()
+            self.resumed[file_path] = transfer["counted"]
+            self.queue.appendleft((file_path, transfer["attempt"]))
+            stopped += 1
+            events.emit("upload_stopped", path=file_path, rate=transfer["rate"], cap=cap)
+
+        print(f"[UPLOAD] Cap lowered to {format_rate(cap)}: {stopped} transfers started again at the new rate")
+
+        return stopped
+
+    @profiling.profiled("scheduled_upload")
+    def run(self) -> dict:
+        """
+        Returns:
+            dict: 'uploaded' and 'failed' (lists of paths), 'history' (one dict
+                  per interval: time, concurrency, cap, throughput, errors).
+        """
+        start_time = time.perf_counter()
+        concurrency = self.controller.concurrency
+        while self.queue or self.active:
+            interval_start = time.perf_counter()
+            cap = self.schedule.cap()
+            # The rates of the running transfers are those of the cap when they started
+            self.rerate(cap, concurrency)
+
+            sent, ended, errors = 0, 0, 0
+            running = None
+            while time.perf_counter() - interval_start < self.interval and (self.queue or self.active):
+                while self.queue and len(self.active) < concurrency:
+                    file_path, attempt = self.queue.popleft()
+                    self.start(file_path, attempt, cap // concurrency if cap else 0)
+                running = len(self.active) if running is None else min(running, len(self.active))
+
+                time.sleep(min(0.2, self.interval / 10))
+                step = self.collect()
+                sent, ended, errors = sent + step[0], ended + step[1], errors + step[2]
+
+            elapsed = time.perf_counter() - interval_start
+            throughput = sent / elapsed if elapsed else 0.0
+            concurrency = self.controller.update(throughput, errors, ended, cap, running=running)
+            self.history.append({
+                "time_s": round(time.perf_counter() - start_time, 2),
+                "concurrency": concurrency,
+                "cap": cap,
+                "throughput": throughput,
+                "errors": errors
+            })
+            events.emit("upload_rate", bytes_per_s=throughput, cap=cap, concurrency=concurrency,
+                        errors=errors, queued=len(self.queue), active=len(self.active))
+            print(f"[UPLOAD] {format_rate(throughput):>12}  cap {format_rate(cap):>12}  "
+                  f"{len(self.active)} running, next {concurrency}  "
+                  f"{len(self.uploaded)} sent, {len(self.queue)} queued")
+
+        return {"uploaded": self.uploaded, "failed": self.failed, "history": self.history}
+
+
+def scheduled_upload(
+    file_list: list,
+    username: str,
+    rate_cap: str = None,
+    rate_schedule: str = None,
+    max_workers: int = 4,
+    adaptive: bool = True,
+    interval: float = DEFAULT_INTERVAL,
+    dry_run: bool = False
+) -> bool:
+    """
+    Uploads the files with one lftp session each, under the rate cap of the
+    time of day, with a concurrency adapted to the uplink (adaptive) or fixed
+    to max_workers.
+    """
+    schedule = Schedule(rate_schedule, default=parse_rate(rate_cap or 0))
+    if dry_run:
+        cap = schedule.cap()
+        for file_path in file_list:
+            print(lftp_command(username, file_path, cap // max_workers if cap else 0))
+        return False
+
+    controller = AimdController(max_workers=max_workers) if adaptive \
+        else AimdController(min_workers=max_workers, max_workers=max_workers)
+    scheduler = UploadScheduler(
+        file_list,
+        command=lambda file_path, rate: lftp_command(username, file_path, rate),
+        schedule=schedule,
+        controller=controller,
+        interval=interval
+    )
+    results = scheduler.run()
+
+    if results["failed"]:
+        print('\n'.join(f"[!] Not uploaded: {path}" for path in results["failed"]))
+
+    return not results["failed"]
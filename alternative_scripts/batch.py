@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import pipeline
+import metadata_cache
+from checksum_store import default_store_path
+
+
+# Options of pipeline.py for a campaign, one per line, paths relative to the campaign folder
+CAMPAIGN_ARGS = "pipeline.args"
+GENERATION_STAGES = ["samples_xml", "samples_valid", "experiment_xml", "reads_quick", "run_xml", "objects_valid", "details"]
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+
+    campaign_dirs = discover_campaigns(
+        data_dir=args.data_dir,
+        campaigns=args.campaigns
+    )
+    if not campaign_dirs:
+        print(f"[!] No campaign with a {CAMPAIGN_ARGS} file found in {args.data_dir}")
+        sys.exit(1)
+
+    report = run_batch(
+        campaign_dirs=campaign_dirs,
+        stages=args.stages,
+        workers=args.workers,
+        checksum_store=args.checksum_store or default_store_path(args.data_dir),
+        cache_dir=os.path.abspath(args.cache_dir or os.path.join(args.data_dir, ".ena_cache"))
+    )
+
+    report_path = save_report(report, args.data_dir)
+    print_report(report)
+    print(f"[BATCH][+] Report saved to: {report_path}")
+
+    if any(campaign["error"] for campaign in report):
+        sys.exit(1)
+
+
+def discover_campaigns(data_dir: str, campaigns: list = None) -> list:
+    campaign_dirs = []
+    for name in sorted(os.listdir(data_dir)):
+        campaign_dir = os.path.join(data_dir, name)
+
+        if campaigns and name not in campaigns:
+            continue
+        if not os.path.isfile(os.path.join(campaign_dir, CAMPAIGN_ARGS)):
+            continue
+
+        campaign_dirs.append(campaign_dir)
+
+    return campaign_dirs
+
+
+def run_batch(
+    campaign_dirs: list,
+    stages: list,
+    workers: int,
+    checksum_store: str,
+    cache_dir: str
+) -> list:
+    """
+    Runs the pipeline of every campaign in a pool of processes.
+    All the campaigns share the same checksum store and metadata cache, while
+    the pipeline lock keeps two processes off the same campaign outputs.
+    Returns:
+        list: One dictionary per campaign with keys 'campaign', 'status'
+              (stage -> status), 'error', 'log' and 'elapsed'.
+    """
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=metadata_cache.set_cache_dir,
+        initargs=(cache_dir,)
+    ) as pool:
+        futures = [
+            pool.submit(
+                run_campaign,
+                campaign_dir=campaign_dir,
+                stages=stages,
+                checksum_store=os.path.abspath(checksum_store)
+            )
+            for campaign_dir in campaign_dirs
+        ]
+
+        report = []
+        for campaign_dir, future in zip(campaign_dirs, futures):
+            campaign = future.result()
+            print(f"[BATCH][{'!' if campaign['error'] else '+'}] "
+                  f"{campaign['campaign']} finished in {campaign['elapsed']:.1f}s")
+            report.append(campaign)
+
+    return report
+
+
+def run_campaign(campaign_dir: str, stages: list, checksum_store: str) -> dict:
+    start_time = time.time()
+    campaign_dir = os.path.abspath(campaign_dir)
+    log_path = os.path.join(campaign_dir, "ena_batch.log")
+
+    campaign = {
+        "campaign": os.path.basename(campaign_dir),
+        "status": {},
+        "error": None,
+        "log": log_path
+    }
+
+    # Worker processes are reused, restore the directory for the next campaign
+    cwd = os.getcwd()
+    try:
+        with open(log_path, mode="w") as log, contextlib.redirect_stdout(log):
+            os.chdir(campaign_dir)
+
+            args = pipeline.parse_args([f"@{CAMPAIGN_ARGS}"])
+            config = pipeline.build_config(args)
+            config["checksum_store"] = checksum_store
+
+            campaign["status"] = pipeline.run_pipeline(
+                config=config,
+                selected_stages=stages,
+                force=args.force
+            )
+            pipeline.print_status(campaign["status"])
+
+    # The step functions exit on submission errors
+    except (Exception, SystemExit) as e:
+        campaign["error"] = f"{type(e).__name__}: {e}"
+
+    finally:
+        os.chdir(cwd)
+
+    if any(value == "failed" for value in campaign["status"].values()):
+        campaign["error"] = campaign["error"] or "A stage failed, see the log"
+
+    campaign["elapsed"] = time.time() - start_time
+
+    return campaign
+
+
+def save_report(report: list, data_dir: str) -> str:
+    report_path = os.path.join(data_dir, "ena_batch_report.json")
+    with open(report_path, mode="w") as handle:
+        json.dump(report, handle, indent=2)
+
+    return report_path
+
+
+def print_report(report: list) -> None:
+    print("[BATCH] Summary:")
+    for campaign in report:
+        print(f"  {campaign['campaign']} ({campaign['elapsed']:.1f}s) log: {campaign['log']}")
+        for name, value in campaign["status"].items():
+            print(f"    - {name:<16} {value}")
+        if campaign["error"]:
+            print(f"    [!] {campaign['error']}")
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Batch of campaigns")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-d", "--data_dir",
+                        help=f"Directory containing one folder per campaign, each with a {CAMPAIGN_ARGS} file.",
+                        type=str,
+                        default="data"
+                        )
+    parser.add_argument("-c", "--campaigns",
+                        help="Comma separated campaign folders to run (default: all the ones found).",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=None
+                        )
+    parser.add_argument("-n", "--workers",
+                        help="Campaigns processed at the same time.",
+                        type=int,
+                        default=os.cpu_count()
+                        )
+    parser.add_argument("--stages",
+                        help="Comma separated pipeline stages to run (default: the XML generation ones).",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=GENERATION_STAGES
+                        )
+    parser.add_argument("--checksum_store",
+                        help="SQLite file caching the checksums of all the campaigns (default: DATA_DIR/ena_checksums.sqlite).",
+                        type=str
+                        )
+    parser.add_argument("--cache_dir",
+                        help="Directory caching the parsed metadata of all the campaigns (default: DATA_DIR/.ena_cache).",
+                        type=str
+                        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import argparse
+import xml.etree.ElementTree as ET
+
+import events
+import profiling
+
+
+CHECKLIST_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "checklists"))
+# Checklist of the samples.xml template (ENA-CHECKLIST attribute)
+DEFAULT_CHECKLIST = "ERC000025"
+
+# INSDC terms accepted by ENA in place of a mandatory value
+MISSING_VALUES = [
+    "not applicable",
+    "not collected",
+    "not provided",
+    "restricted access",
+    "missing: control sample",
+    "missing: sample group",
+    "missing: synthetic construct",
+    "missing: lab stock",
+    "missing: third party data",
+    "missing: data agreement established pre-2023",
+    "missing: endangered species",
+    "missing: human-identifiable"
+]
+
+# ISO 8601 as accepted by ENA: year, year-month, date, with an optional time
+DATE_PATTERN = r"\d{4}(-\d{2}(-\d{2}([T ]\d{2}(:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:?\d{2})?)?)?)?"
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="checklist_validation")
+    events.start(args, command="checklist_validation")
+
+    from metadata_reader import read_metadata
+
+    violations = validate_metadata(
+        metadata_df=read_metadata(args.metadata_path),
+        checklist=load_checklist(args.checklist)
+    )
+
+    print_violations(violations, args.checklist)
+
+    if args.report:
+        violations.to_csv(args.report, sep="\t", index=False)
+        print(f"[CHECKLIST][+] Violations saved to: {args.report}")
+
+    if len(violations):
+        sys.exit(1)
+
+
+def get_checklist_path(checklist: str) -> str:
+    # Either a file or the accession of a checklist saved in data/checklists
+    if os.path.exists(checklist):
+        return checklist
+
+    for extension in ("tsv", "xml"):
+        path = os.path.join(CHECKLIST_DIR, f"{checklist}.{extension}")
+        if os.path.exists(path):
+            return path
+
+    raise FileNotFoundError(f"[!] Checklist {checklist} not found in {CHECKLIST_DIR}")
+
+
+def load_checklist(checklist: str) -> list:
+    """
+    Reads a checklist definition, either the TSV files of data/checklists or
+    the XML published by ENA (https://www.ebi.ac.uk/ena/browser/api/xml/ERC000025).
+    Returns:
+        list: One dictionary per field with keys 'field', 'requirement', 'type',
+              'min', 'max', 'units', 'pattern', 'values' and 'unique'.
+    """
+    checklist_path = get_checklist_path(checklist)
+
+    if checklist_path.endswith(".xml"):
+        return load_checklist_xml(checklist_path)
+
+    with open(checklist_path, mode="r", newline="") as handle:
+        rows = csv.DictReader(
+            (line for line in handle if not line.startswith("#")),
+            delimiter="\t"
+        )
+        fields = []
+        for row in rows:
+            fields.append({
+                "field": row["field"],
+                "requirement": row["requirement"] or "optional",
+                "type": row["type"] or "text",
+                "min": float(row["min"]) if row["min"] else None,
+                "max": float(row["max"]) if row["max"] else None,
+                "units": row["units"] or None,
+                "pattern": row["pattern"] or None,
+                "values": row["values"].split("|") if row["values"] else None,
+                "unique": row["unique"] == "yes"
+            })
+
+    return fields
+
+
+def load_checklist_xml(checklist_path: str) -> list:
+    # ENA checklists only define regular expressions and controlled vocabularies
+    fields = []
+    for field in ET.parse(checklist_path).iter("FIELD"):
+        values = [value.text for value in field.iter("VALUE")]
+        units = [unit.text for unit in field.iter("UNIT")]
+
+        fields.append({
+            "field": field.findtext("NAME"),
+            "requirement": field.findtext("MANDATORY", "optional"),
+            "type": "text",
+            "min": None,
+            "max": None,
+            "units": units[0] if units else None,
+            "pattern": field.findtext(".//REGEX_VALUE"),
+            "values": values or None,
+            "unique": False
+        })
+
+    return fields
+
+
+@profiling.profiled("validate_metadata")
+def validate_metadata(metadata_df: "pd.DataFrame", checklist: list) -> "pd.DataFrame":
+    """
+    Checks every column of the metadata against the checklist in one pass.
+    Each rule is applied to the whole column at once (pandas string methods
+    and NumPy comparisons), so thousands of samples cost a few array
+    operations per field instead of a Python loop over the rows.
+    Args:
+        metadata_df (pd.DataFrame): Rows of the sample_submission sheet, as read
+                                    from the spreadsheet (before any conversion).
+        checklist (list): Fields returned by load_checklist.
+    Returns:
+        pd.DataFrame: One row per violation with columns 'row' (spreadsheet row),
+                      'sample_alias', 'field', 'value' and 'problem'.
+    """
+    import numpy as np
+    import pandas as pd
+
+    # Spreadsheet row numbers: header, units row, then the samples
+    rows = metadata_df.index.to_numpy() + 2
+    aliases = metadata_df["sample_alias"].astype(str).to_numpy() \
+        if "sample_alias" in metadata_df else np.full(len(metadata_df), "")
+
+    violations = []
+
+    def report(field: str, mask, values, problem: str) -> None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.any():
+            violations.append(pd.DataFrame({
+                "row": rows[mask],
+                "sample_alias": aliases[mask],
+                "field": field,
+                "value": np.asarray(values, dtype=object)[mask],
+                "problem": problem
+            }))
+
+    for rule in checklist:
+        field = rule["field"]
+
+        if field not in metadata_df:
+            if rule["requirement"] == "mandatory":
+                violations.append(pd.DataFrame([{
+                    "row": 1,
+                    "sample_alias": "",
+                    "field": field,
+                    "value": "",
+                    "problem": "mandatory column missing"
+                }]))
+            continue
+
+        column = metadata_df[field]
+        # Dates and numbers read by pandas are checked on their text as well
+        text = column.astype(str).str.strip().where(column.notna(), "")
+        values = text.to_numpy()
+
+        empty = (text == "").to_numpy()
+        missing_term = text.str.lower().isin(MISSING_VALUES).to_numpy()
+
+        if rule["requirement"] == "mandatory":
+            report(field, empty, values, "mandatory value missing")
+
+        # Only the actual values are checked further
+        present = ~empty & ~missing_term
+
+        if rule["type"] in ("number", "integer"):
+            numbers = pd.to_numeric(text.where(present, None), errors="coerce").to_numpy(dtype=float)
+            not_number = present & np.isnan(numbers)
+            report(field, not_number, values, f"not a {rule['type']}")
+
+            valid = present & ~not_number
+            if rule["type"] == "integer":
+                report(field, valid & (np.mod(numbers, 1) != 0), values, "not an integer")
+            if rule["min"] is not None:
+                report(field, valid & (numbers < rule["min"]), values, f"below {rule['min']:g}")
+            if rule["max"] is not None:
+                report(field, valid & (numbers > rule["max"]), values, f"above {rule['max']:g}")
+
+        elif rule["type"] == "date":
+            well_formed = text.str.fullmatch(DATE_PATTERN).to_numpy(dtype=bool)
+            report(field, present & ~well_formed, values, "not an ISO 8601 date (YYYY[-MM[-DD]])")
+
+            # Impossible dates (2023-02-30) and dates in the future
+            dates = pd.to_datetime(text.str.slice(0, 10).where(present & well_formed, None),
+                                   format="mixed", errors="coerce")
+            report(field, present & well_formed & dates.isna().to_numpy(), values, "invalid date")
+            report(field, (dates > pd.Timestamp.now()).to_numpy(dtype=bool), values, "date in the future")
+
+        if rule["pattern"]:
+            matches = text.str.fullmatch(rule["pattern"]).to_numpy(dtype=bool)
+            report(field, present & ~matches, values, f"does not match {rule['pattern']}")
+
+        if rule["values"]:
+            allowed = text.isin(rule["values"]).to_numpy()
+            report(field, present & ~allowed, values, "not an allowed value")
+
+        if rule["unique"]:
+            duplicated = text.duplicated(keep=False).to_numpy()
+            report(field, present & duplicated, values, "duplicated")
+
+    if not violations:
+        return pd.DataFrame(columns=["row", "sample_alias", "field", "value", "problem"])
+
+    return pd.concat(violations, ignore_index=True).sort_values(["row", "field"], kind="stable")
+
+
+def print_violations(violations: "pd.DataFrame", checklist: str) -> None:
+    if not len(violations):
+        print(f"[CHECKLIST][+] Metadata complies with {checklist}")
+        return
+
+    print(f"[CHECKLIST][!] {len(violations)} violations of {checklist} "
+          f"in {violations['row'].nunique()} rows:")
+    for violation in violations.itertuples():
+        print(f"[!] row {violation.row} ({violation.sample_alias}) "
+              f"'{violation.field}' = '{violation.value}': {violation.problem}")
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Validating the sample metadata against an ENA checklist")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-i", "--metadata_path",
+                        help="Metadata of the sequences: ENA spreadsheet (.xlsx) or CSV/TSV/Parquet export.",
+                        type=str,
+                        required=True
+                        )
+    parser.add_argument("-c", "--checklist",
+                        help="Checklist accession saved in data/checklists (TSV or ENA XML), or a checklist file.",
+                        type=str,
+                        default=DEFAULT_CHECKLIST
+                        )
+    parser.add_argument("-r", "--report",
+                        help="TSV file where the violations are saved.",
+                        type=str
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+import sqlite3
+import queue
+import hashlib
+import threading
+
+import events
+import profiling
+import io_engine
+from fastq_check import FastqChecker, FastqError
+
+
+STORE_NAME = "ena_checksums.sqlite"
+# Target of the upload measures in the throughput table
+UPLOAD_TARGET = "webin2.ebi.ac.uk"
+
+# '<md5> <name>' (ours), '<md5>  <path>' / '<md5> *<path>' (md5sum) or 'MD5 (<path>) = <md5>' (BSD)
+MD5_LINE = re.compile(r"^\s*(?:([0-9a-fA-F]{32})\s+\*?(.+?)|MD5 \((.+)\) = ([0-9a-fA-F]{32}))\s*$")
+
+
+class ChecksumStore:
+    """
+    MD5 checksums of the sequence files, saved in a SQLite file of the campaign.
+    A checksum is valid as long as the file keeps the same path, size and
+    modification time, so each file is read at most once across s03/s04 runs.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            store_path,
+            timeout=60,
+            check_same_thread=False
+        )
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checksums ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "md5 TEXT, updated REAL)"
+            )
+            # Result of the FASTQ integrity check, problem is NULL for a valid file
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS fastq_checks ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "problem TEXT, updated REAL)"
+            )
+            # MD5 of the gzip stream made from an uncompressed file, for the
+            # compression settings (the bytes depend on the zlib version and level)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS compressed ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "settings TEXT, md5 TEXT, compressed_size INTEGER, updated REAL)"
+            )
+            # Measured speed of the past runs, for 'ena.py plan': kind is hash,
+            # compress or upload, target the mount point read or the server
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS throughput ("
+                "kind TEXT, target TEXT, bytes INTEGER, duration_s REAL, workers INTEGER, recorded REAL)"
+            )
+
+    def get(self, file_path: str) -> str:
+        path, size, mtime_ns = file_key(file_path)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT md5 FROM checksums WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def put(self, file_path: str, md5: str) -> None:
+        path, size, mtime_ns = file_key(file_path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, md5, time.time())
+            )
+
+    def get_check(self, file_path: str) -> tuple:
+        """
+        Returns (checked, problem): whether the file was checked since its last
+        change, and the problem found (None if it is valid).
+        """
+        path, size, mtime_ns = file_key(file_path)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT problem FROM fastq_checks WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns)
+            ).fetchone()
+
+        return (True, row[0]) if row else (False, None)
+
+    def put_check(self, file_path: str, problem: str) -> None:
+        path, size, mtime_ns = file_key(file_path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO fastq_checks VALUES (?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, problem, time.time())
+            )
+
+    def get_compressed(self, file_path: str, settings: str) -> tuple:
+        """
+        Returns (md5, compressed_size) of the gzip stream of the file, (None, None)
+        if it was not compressed with these settings since its last change.
+        """
+        path, size, mtime_ns = file_key(file_path)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT md5, compressed_size FROM compressed "
+                "WHERE path = ? AND size = ? AND mtime_ns = ? AND settings = ?",
+                (path, size, mtime_ns, settings)
+            ).fetchone()
+
+        return row if row else (None, None)
+
+    def put_compressed(self, file_path: str, settings: str, md5: str, compressed_size: int) -> None:
+        path, size, mtime_ns = file_key(file_path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO compressed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, settings, md5, compressed_size, time.time())
+            )
+
+    def put_throughput(self, kind: str, target: str, size: int, duration_s: float, workers: int = 1) -> None:
+        if duration_s <= 0 or size <= 0:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO throughput VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, target, size, duration_s, workers, time.time())
+            )
+
+    def get_throughput(self, kind: str, target: str = None, last: int = 50) -> list:
+        """
+        Returns the last measures of a kind, on a target (any if None), newest
+        first, as (target, bytes, duration_s, workers) tuples.
+        """
+        query = "SELECT target, bytes, duration_s, workers FROM throughput WHERE kind = ?"
+        params = [kind]
+        if target is not None:
+            query += " AND target = ?"
+            params.append(target)
+        with self.lock:
+            return self.connection.execute(
+                f"{query} ORDER BY recorded DESC LIMIT ?", params + [last]
+            ).fetchall()
+
+    def entries(self) -> list:
+        """
+        Returns (path, size, mtime_ns, md5) of every hashed file, the MD5 of
+        its gzip stream for the uncompressed files that were compressed.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, size, mtime_ns, md5 FROM checksums"
+            ).fetchall()
+            # Later rows win: the compressed stream of an uncompressed file
+            rows += self.connection.execute(
+                "SELECT path, size, mtime_ns, md5 FROM compressed"
+            ).fetchall()
+
+        return list({row[0]: row for row in rows}.values())
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def file_key(file_path: str) -> tuple:
+    stat = os.stat(file_path)
+    return os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns
+
+
+@profiling.profiled("hashing")
+def md5sum(
+    file_path: str,
+    block_size: int = None,
+    checker: FastqChecker = None,
+    keep_cache: bool = False
+) -> str:
+    # Read by blocks: sequence files do not fit in memory. The block size and
+    # the number of files read at once come from the settings of the device
+    size = os.path.getsize(file_path)
+
+    # The checker gets the same blocks in a second thread: zlib and hashlib
+    # release the GIL, so decompressing does not slow down the hashing
+    blocks = None
+    errors = []
+    if checker is not None:
+        blocks = queue.Queue(maxsize=4)
+
+        def check() -> None:
+            try:
+                for block in iter(blocks.get, None):
+                    checker.update(block)
+            except Exception as e:
+                errors.append(e)
+                # Keeps the reader from blocking on a full queue
+                for _ in iter(blocks.get, None):
+                    pass
+
+        consumer = threading.Thread(target=check, daemon=True)
+        consumer.start()
+
+    md5 = hashlib.md5()
+    with io_engine.device_slot(file_path):
+        events.emit("hash_started", path=file_path, bytes=size)
+        start_time = time.perf_counter()
+        try:
+            # The blocks queued for the checker must not be overwritten yet
+            for block in io_engine.read_blocks(
+                file_path,
+                block_size=block_size,
+                buffers=blocks.maxsize + 2 if blocks is not None else 2,
+                keep_cache=keep_cache
+            ):
+                md5.update(block)
+                if blocks is not None:
+                    blocks.put(block)
+        finally:
+            if blocks is not None:
+                blocks.put(None)
+                consumer.join()
+
+    if errors:
+        raise errors[0]
+
+    elapsed_time = time.perf_counter() - start_time
+    events.emit("hash_finished", path=file_path, bytes=size, duration_s=elapsed_time,
+                md5=md5.hexdigest())
+
+    return md5.hexdigest()
+
+
+def get_checksum(
+    file_path: str,
+    store: ChecksumStore = None,
+    verify_fastq: bool = False,
+    keep_cache: bool = False
+) -> str:
+    """
+    Returns the MD5 of a file, computing it only when the store has no valid entry.
+    With verify_fastq, the gzip stream and the FASTQ records are checked in the
+    same read (once per file version, the result is kept in the store) and
+    FastqError is raised for a corrupt or truncated file.
+    With keep_cache, the file stays in the page cache (read again right after).
+    """
+    md5 = None
+    checked, problem = False, None
+    if store is not None:
+        md5 = store.get(file_path)
+        if verify_fastq:
+            checked, problem = store.get_check(file_path)
+
+    if md5 and (checked or not verify_fastq):
+        events.emit("hash_cached", path=file_path, md5=md5)
+        if problem:
+            raise FastqError(problem)
+        return md5
+
+    checker = FastqChecker(file_path) if verify_fastq else None
+    start_time = time.perf_counter()
+    md5 = md5sum(file_path, checker=checker, keep_cache=keep_cache)
+    elapsed_time = time.perf_counter() - start_time
+
+    if checker is not None:
+        try:
+            checker.finish()
+        except FastqError as e:
+            problem = str(e)
+        events.emit("fastq_checked", path=file_path, records=checker.records, bases=checker.bases,
+                    members=checker.members, ok=problem is None, problem=problem)
+
+    if store is not None:
+        store.put(file_path, md5)
+        if checker is not None:
+            store.put_check(file_path, problem)
+        store.put_throughput("hash", io_engine.mount_point(file_path), os.path.getsize(file_path), elapsed_time)
+
+    if problem:
+        raise FastqError(problem)
+
+    return md5
+
+
+def default_store_path(campaign_dir: str) -> str:
+    return os.path.join(campaign_dir, STORE_NAME)
+
+
+def read_md5_file(checksum_path: str) -> dict:
+    """
+    Reads a checksum file (MD5.txt of the deliveries, md5sum or BSD output).
+    Paths are reduced to the file name, as the files are looked up in the
+    folder of the checksum file.
+    Returns:
+        dict: file name -> MD5 (lowercase), empty if the file does not exist.
+    """
+    checksums = {}
+    try:
+        with open(checksum_path, mode="r", errors="replace") as handle:
+            for line in handle:
+                match = MD5_LINE.match(line)
+                if match:
+                    md5, path = (match.group(1), match.group(2)) if match.group(1) \
+                        else (match.group(4), match.group(3))
+                    checksums[os.path.basename(path.replace("\\", "/"))] = md5.lower()
+    except FileNotFoundError:
+        pass
+
+    return checksums
+
+
+def write_md5_file(checksum_path: str, checksums: dict) -> str:
+    # '<md5> <file name>' lines sorted by name, replaced atomically
+    tmp_path = f"{checksum_path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode="w") as handle:
+        for name in sorted(checksums):
+            handle.write(f"{checksums[name]} {name}\n")
+    os.replace(tmp_path, checksum_path)
+
+    return checksum_path
+
+
+def record_throughput(store_path: str, kind: str, target: str, size: int, duration_s: float,
+                      workers: int = 1) -> None:
+    # For the steps that do not keep the store open (uploads)
+    store = ChecksumStore(store_path)
+    try:
+        store.put_throughput(kind, target, size, duration_s, workers)
+    finally:
+        store.close()
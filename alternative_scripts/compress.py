@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import zlib
+import time
+import hashlib
+import argparse
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import events
+import profiling
+import io_engine
+from checksum_store import ChecksumStore, get_checksum, UPLOAD_TARGET
+from fastq_check import FastqChecker, FastqError
+
+
+DEFAULT_LEVEL = 6
+# Uncompressed bytes per gzip member: large enough for the ratio to stay
+# within a fraction of a percent of a single stream
+BLOCK_SIZE = 4 * 1024 * 1024
+COMPRESSED_SUFFIXES = (".gz", ".bz2", ".xz", ".zst")
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="compress")
+    events.start(args, command="compress")
+
+    store = ChecksumStore(args.checksum_store) if args.checksum_store else None
+    failed = False
+    for file_path in args.files:
+        if is_compressed(file_path):
+            print(f"[COMPRESS][=] {file_path} is already compressed")
+            continue
+
+        if args.username:
+            failed |= not compress_upload(file_path, args.username, store, level=args.level,
+                                          workers=args.workers, dry_run=args.dry_run)
+            continue
+
+        output_path = None
+        if args.output_dir:
+            output_path = os.path.join(args.output_dir, os.path.basename(compressed_name(file_path)))
+        result = compress(file_path, output_path=output_path, level=args.level, workers=args.workers)
+        if store is not None:
+            store.put_compressed(file_path, settings(args.level), result["md5"], result["size"])
+            if output_path:
+                store.put(output_path, result["md5"])
+        print_result(result)
+
+    if store is not None:
+        store.close()
+
+    if failed:
+        sys.exit(1)
+
+
+def is_compressed(file_path: str) -> bool:
+    return file_path.endswith(COMPRESSED_SUFFIXES)
+
+
+def compressed_name(file_path: str) -> str:
+    # Name of the file at ENA: the uncompressed FASTQ files are sent gzipped
+    return file_path if is_compressed(file_path) else f"{file_path}.gz"
+
+
+def settings(level: int = DEFAULT_LEVEL) -> str:
+    # The same settings give the same bytes, hence the same MD5, on every run
+    return f"zlib {zlib.ZLIB_VERSION} level {level} members {BLOCK_SIZE}"
+
+
+def compress_block(data: bytes, level: int) -> bytes:
+    # 16 + MAX_WBITS: a complete gzip member, header with no name and mtime 0
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_members(
+    file_path: str,
+    level: int = DEFAULT_LEVEL,
+    workers: int = None,
+    checker: FastqChecker = None
+):
+    """
+    Compresses a file into gzip members of BLOCK_SIZE input bytes (as pigz or
+    bgzip), several blocks at once, and yields them in order: their
+    concatenation is a valid gzip file. zlib releases the GIL, so each thread
+    keeps a core busy. At most 2 blocks per worker are held in memory.
+    The checker gets the uncompressed blocks (FASTQ records).
+    """
+    workers = workers or os.cpu_count() or 1
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool, io_engine.device_slot(file_path):
+        for block in io_engine.read_blocks(file_path, block_size=BLOCK_SIZE):
+            # Copied: the read buffers are reused while the block is compressed
+            data = bytes(block)
+            if checker is not None:
+                checker.update(data)
+            pending.append(pool.submit(compress_block, data, level))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+@profiling.profiled("compress")
+def compress(
+    file_path: str,
+    output_path: str = None,
+    upload_command: list = None,
+    level: int = DEFAULT_LEVEL,
+    workers: int = None,
+    checker: FastqChecker = None
+) -> dict:
+    """
+    Compresses a file and hashes the gzip stream in the same pass, writing it
+    to output_path and/or to the standard input of upload_command. Without
+    either, only the MD5 of the stream is computed: nothing is written.
+    Returns:
+        dict: 'path', 'name' (compressed), 'md5' and 'size' of the stream,
+              'bytes_in', 'duration_s' and 'sent' (None without upload_command).
+    """
+    size_in = os.path.getsize(file_path)
+    events.emit("compress_started", path=file_path, bytes=size_in)
+    start_time = time.perf_counter()
+
+    md5 = hashlib.md5()
+    size = 0
+    # Started first: a missing upload command leaves no temporary file behind
+    process = subprocess.Popen(upload_command, stdin=subprocess.PIPE) if upload_command else None
+    handle = open(f"{output_path}.tmp", mode="wb") if output_path else None
+    sent = process is not None
+    finished = False
+    try:
+        for member in compress_members(file_path, level, workers, checker):
+            md5.update(member)
+            size += len(member)
+            if handle is not None:
+                handle.write(member)
+            if sent:
+                try:
+                    process.stdin.write(member)
+                except BrokenPipeError:
+                    # The upload failed, the hash is still needed
+                    sent = False
+        finished = True
+    finally:
+        if handle is not None:
+            handle.close()
+            # A partial stream is never renamed to output_path
+            if not finished:
+                os.remove(f"{output_path}.tmp")
+        if process is not None:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                sent = False
+            sent = process.wait() == 0 and sent
+
+    if output_path:
+        os.replace(f"{output_path}.tmp", output_path)
+
+    result = {
+        "path": file_path,
+        "name": os.path.basename(compressed_name(file_path)),
+        "md5": md5.hexdigest(),
+        "size": size,
+        "bytes_in": size_in,
+        "duration_s": time.perf_counter() - start_time,
+        "sent": sent if process is not None else None
+    }
+    events.emit("compress_finished", path=file_path, bytes=size_in, compressed_bytes=size,
+                duration_s=result["duration_s"], md5=result["md5"])
+
+    return result
+
+
+def compressed_checksum(
+    file_path: str,
+    store: ChecksumStore = None,
+    verify_fastq: bool = False,
+    level: int = DEFAULT_LEVEL,
+    workers: int = None
+) -> str:
+    """
+    MD5 of the file as sent to ENA: the file itself if it is compressed,
+    otherwise the gzip stream compress_upload sends (same bytes for the same
+    settings), computed without writing it. Same caching and FASTQ check as
+    checksum_store.get_checksum.
+    """
+    if is_compressed(file_path):
+        return get_checksum(file_path, store, verify_fastq=verify_fastq)
+
+    md5 = None
+    checked, problem = False, None
+    if store is not None:
+        md5, _ = store.get_compressed(file_path, settings(level))
+        if verify_fastq:
+            checked, problem = store.get_check(file_path)
+
+    if md5 and (checked or not verify_fastq):
+        events.emit("hash_cached", path=file_path, md5=md5)
+        if problem:
+            raise FastqError(problem)
+        return md5
+
+    checker = FastqChecker(file_path, compressed=False) if verify_fastq else None
+    result = compress(file_path, level=level, workers=workers, checker=checker)
+    problem = finish_check(checker)
+
+    if store is not None:
+        store.put_compressed(file_path, settings(level), result["md5"], result["size"])
+        if checker is not None:
+            store.put_check(file_path, problem)
+        store.put_throughput("compress", io_engine.mount_point(file_path), result["bytes_in"],
+                             result["duration_s"], workers or os.cpu_count() or 1)
+
+    if problem:
+        raise FastqError(problem)
+
+    return result["md5"]
+
+
+def finish_check(checker: FastqChecker) -> str:
+    if checker is None:
+        return None
+
+    problem = None
+    try:
+        checker.finish()
+    except FastqError as e:
+        problem = str(e)
+    events.emit("fastq_checked", path=checker.file_path, records=checker.records, bases=checker.bases,
+                members=checker.members, ok=problem is None, problem=problem)
+
+    return problem
+
+
+def upload_command(username: str, name: str) -> list:
+    # lftp only sends files: curl uploads its standard input, password from netrc
+    return [
+        "curl", "--silent", "--show-error", "--netrc",
+        "--upload-file", "-",
+        f"ftp://{username}@webin2.ebi.ac.uk/{name}"
+    ]
+
+
+def compress_upload(
+    file_path: str,
+    username: str,
+    store: ChecksumStore = None,
+    level: int = DEFAULT_LEVEL,
+    workers: int = None,
+    dry_run: bool = False
+) -> bool:
+    """
+    Sends an uncompressed file to the upload area as <name>.gz, compressed on
+    the fly: no compressed copy is written. The MD5 of the stream is saved
+    in the store, where s03 reads it for the run XML.
+    """
+    command = upload_command(username, os.path.basename(compressed_name(file_path)))
+    if dry_run:
+        print(command)
+        return True
+
+    previous = store.get_compressed(file_path, settings(level))[0] if store is not None else None
+
+    events.emit("upload_started", path=file_path, bytes=os.path.getsize(file_path))
+    result = compress(file_path, upload_command=command, level=level, workers=workers)
+    events.emit("upload_finished", path=file_path, bytes=result["size"],
+                duration_s=result["duration_s"], ok=result["sent"])
+
+    if store is not None:
+        store.put_compressed(file_path, settings(level), result["md5"], result["size"])
+        if result["sent"]:
+            store.put_throughput("upload", UPLOAD_TARGET, result["size"], result["duration_s"])
+    if previous and previous != result["md5"]:
+        print(f"[WARNING] {file_path}: the sent stream differs from the one hashed before, create the run XML again")
+
+    if not result["sent"]:
+        print(f"[!] Upload failed for {file_path}")
+        return False
+
+    print_result(result)
+    return True
+
+
+@profiling.profiled("compress_upload")
+def compress_upload_files(
+    file_list: list,
+    username: str,
+    checksum_store: str = None,
+    level: int = DEFAULT_LEVEL,
+    workers: int = None,
+    dry_run: bool = False
+) -> bool:
+    # One file at a time: each one already keeps every core busy
+    store = ChecksumStore(checksum_store) if checksum_store else None
+    try:
+        results = [
+            compress_upload(file_path, username, store, level=level, workers=workers, dry_run=dry_run)
+            for file_path in dict.fromkeys(file_list) if not is_compressed(file_path)
+        ]
+    finally:
+        if store is not None:
+            store.close()
+
+    return all(results)
+
+
+def print_result(result: dict) -> None:
+    ratio = result["size"] / result["bytes_in"] if result["bytes_in"] else 0
+    speed = result["bytes_in"] / result["duration_s"] / 1e6 if result["duration_s"] else 0
+    print(f"[COMPRESS][+] {result['md5']} {result['name']} "
+          f"({ratio:.0%} of {result['bytes_in'] / 1e6:.1f} MB, {speed:.0f} MB/s)")
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Compress uncompressed FASTQ files in parallel, hash and upload the stream")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("files",
+                        help="Uncompressed FASTQ files.",
+                        nargs="+"
+                        )
+    parser.add_argument("-o", "--output_dir",
+                        help="Write the <name>.gz files to this folder.",
+                        type=str
+                        )
+    parser.add_argument("-u", "--username",
+                        help="Send the compressed stream to the Webin upload area instead (password from netrc).",
+                        type=str
+                        )
+    parser.add_argument("--dry_run",
+                        action="store_true",
+                        help="Only print the upload commands."
+                        )
+    parser.add_argument("-j", "--workers",
+                        help="Blocks compressed at the same time (default: number of cores).",
+                        type=int
+                        )
+    parser.add_argument("--level",
+                        help="gzip compression level.",
+                        type=int,
+                        default=DEFAULT_LEVEL
+                        )
+    parser.add_argument("--checksum_store",
+                        help="SQLite file of the campaign where the MD5 of the compressed streams is saved.",
+                        type=str
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
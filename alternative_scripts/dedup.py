@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+
+import events
+import profiling
+from checksum_store import ChecksumStore, STORE_NAME, read_md5_file
+from submissions import TEST_SUFFIX
+from compress import compressed_checksum, compressed_name, is_compressed, settings
+
+
+# Shared by the campaigns of the user, outside of the repository
+STATE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "ena-submission")
+INDEX_PATH = os.path.join(STATE_DIR, "dedup_index.sqlite")
+
+SEQUENCE_SUFFIXES = (".fastq.gz", ".fq.gz", ".fastq", ".fq")
+DETAILS_PATTERN = "_details_"
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="dedup")
+    events.start(args, command="dedup")
+
+    index = DedupIndex(args.index)
+    for campaign_dir in args.campaign_dirs:
+        if not os.path.isdir(campaign_dir):
+            print(f"[!] {campaign_dir} is not a folder")
+            sys.exit(1)
+        files, runs = index.add_campaign(campaign_dir)
+        print(f"[DEDUP][+] {campaign_dir}: {files} files, {runs} registered run files")
+
+    # Files of the same size are only copies if their MD5 match
+    hashed = hash_unhashed(index.unhashed_same_size(), index)
+    if hashed:
+        print(f"[DEDUP] {hashed} files sharing their size with another one hashed")
+
+    groups = index.duplicates()
+    for md5, paths, runs in groups:
+        print(f"[DUPLICATE] {md5}")
+        for path in paths:
+            print(f"    {path}")
+        for run in runs:
+            print(f"    {format_run(run)}")
+    print(f"[DEDUP] {index.count()} files indexed, {len(groups)} contents found more than once")
+    index.close()
+
+
+class DedupIndex:
+    """
+    Every sequence file known across campaigns, by size and MD5, and the run
+    files already registered at ENA (details CSV of s05), by MD5.
+    The size comes first: a file whose size no other file has cannot be a
+    copy, so only the few files sharing a size need their MD5 compared.
+    """
+
+    def __init__(self, index_path: str = None):
+        self.index_path = index_path or INDEX_PATH
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            self.index_path,
+            timeout=60,
+            check_same_thread=False
+        )
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "md5 TEXT, campaign TEXT, updated REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_md5 ON files (md5)")
+            # campaign: folder of the metadata, where the details CSV is
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "md5 TEXT, file_name TEXT, run_accession TEXT, study_accession TEXT, "
+                "campaign TEXT, PRIMARY KEY (md5, run_accession))"
+            )
+
+    def add_file(self, path: str, md5: str = None, campaign: str = None) -> None:
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        with self.lock, self.connection:
+            # A known MD5 is kept until the file changes
+            row = self.connection.execute(
+                "SELECT md5 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, md5 or (row[0] if row else None),
+                 campaign, time.time())
+            )
+
+    def add_run(self, md5: str, file_name: str, run_accession: str, study_accession: str, campaign: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)",
+                (md5.lower(), file_name, run_accession, study_accession, campaign)
+            )
+
+    def add_details(self, details_path: str) -> int:
+        # <project>_details_<type>.csv written by s05 once the runs are registered
+        campaign = os.path.dirname(os.path.realpath(details_path))
+        added = 0
+        with open(details_path, mode="r", newline="") as handle:
+            for row in csv.DictReader(handle):
+                for side in ("forward", "reverse"):
+                    if row.get(f"{side}_checksum"):
+                        self.add_run(row[f"{side}_checksum"], row[f"{side}_file"], row["run_accession"],
+                                     row.get("study_accession"), campaign)
+                        added += 1
+
+        return added
+
+    def add_campaign(self, campaign_dir: str) -> tuple:
+        """
+        Indexes the sequence files of a campaign tree, with the MD5 found in
+        its checksum stores and MD5.txt files, and its registered runs.
+        Returns:
+            tuple: (sequence files, registered run files) indexed.
+        """
+        campaign = os.path.realpath(campaign_dir)
+        checksums = {}
+        files = []
+        runs = 0
+        for folder, _, names in os.walk(campaign):
+            for name in names:
+                path = os.path.join(folder, name)
+                if name == STORE_NAME:
+                    store = ChecksumStore(path)
+                    for file_path, size, mtime_ns, md5 in store.entries():
+                        checksums[(file_path, size, mtime_ns)] = md5
+                    store.close()
+                elif name.endswith("MD5.txt"):
+                    for file_name, md5 in read_md5_file(path).items():
+                        file_path = os.path.realpath(os.path.join(folder, file_name))
+                        if os.path.exists(file_path):
+                            stat = os.stat(file_path)
+                            checksums.setdefault((file_path, stat.st_size, stat.st_mtime_ns), md5)
+                elif DETAILS_PATTERN in name and name.endswith(".csv") \
+                        and not name.endswith(f"{TEST_SUFFIX}.csv"):
+                    runs += self.add_details(path)
+                elif name.endswith(SEQUENCE_SUFFIXES):
+                    files.append(path)
+
+        for path in files:
+            real_path = os.path.realpath(path)
+            stat = os.stat(real_path)
+            self.add_file(real_path, checksums.get((real_path, stat.st_size, stat.st_mtime_ns)), campaign)
+
+        events.emit("dedup_indexed", campaign=campaign, files=len(files), runs=runs)
+
+        return len(files), runs
+
+    def get(self, path: str) -> str:
+        # MD5 of this very file (same real path, size and modification time)
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT md5 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set_md5(self, path: str, md5: str) -> None:
+        # MD5 of an indexed file hashed later, its campaign is kept
+        stat = os.stat(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE files SET size = ?, mtime_ns = ?, md5 = ?, updated = ? WHERE path = ?",
+                (stat.st_size, stat.st_mtime_ns, md5, time.time(), path)
+            )
+
+    def same_size(self, path: str) -> list:
+        # (path, MD5 or None) of the other files of this size
+        path = os.path.realpath(path)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, md5 FROM files WHERE size = ? AND path != ?",
+                (os.path.getsize(path), path)
+            ).fetchall()
+
+        return rows
+
+    def unhashed_same_size(self) -> list:
+        # Files with no MD5 sharing their size with another file: possible copies
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path FROM files WHERE md5 IS NULL AND size IN ("
+                "SELECT size FROM files GROUP BY size HAVING COUNT(*) > 1) ORDER BY path"
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def copies(self, path: str, md5: str) -> list:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path FROM files WHERE md5 = ? AND path != ? ORDER BY path",
+                (md5, os.path.realpath(path))
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def runs(self, md5: str, campaign: str = None) -> list:
+        # Runs of other campaigns: a campaign finds its own once registered
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT file_name, run_accession, study_accession, campaign FROM runs "
+                "WHERE md5 = ? AND campaign != ? ORDER BY run_accession",
+                (md5.lower(), os.path.realpath(campaign) if campaign else "")
+            ).fetchall()
+
+        return [dict(zip(("file_name", "run_accession", "study_accession", "campaign"), row)) for row in rows]
+
+    def duplicates(self) -> list:
+        """
+        Returns:
+            list: (md5, paths, runs) of the contents held by several files or
+                  already registered in a run.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT md5, path FROM files WHERE md5 IN ("
+                "SELECT md5 FROM files WHERE md5 IS NOT NULL GROUP BY md5 HAVING COUNT(*) > 1) "
+                "ORDER BY md5, path"
+            ).fetchall()
+
+        groups = {}
+        for md5, path in rows:
+            groups.setdefault(md5, []).append(path)
+
+        return [(md5, paths, self.runs(md5)) for md5, paths in groups.items()]
+
+    def count(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def format_run(run: dict) -> str:
+    return f"{run['run_accession']} ({run['file_name']}, {run['study_accession'] or '?'}) in {run['campaign']}"
+
+
+def hash_unhashed(paths: list, index: DedupIndex, store: ChecksumStore = None) -> int:
+    """
+    Hashes indexed files that have no MD5 yet (indexed without a checksum
+    store or MD5.txt) and saves it in the index, so that both files of a
+    size match are compared. Files gone since they were indexed are left.
+    Returns:
+        int: Files hashed.
+    """
+    hashed = 0
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        md5 = compressed_checksum(path, store)
+        if md5:
+            index.set_md5(path, md5)
+            hashed += 1
+
+    return hashed
+
+
+def prefill(file_paths: list, index: DedupIndex, store: ChecksumStore) -> int:
+    """
+    Copies into the checksum store of the campaign the MD5 the index knows for
+    the very same files (symlinked or listed by another campaign), so they
+    are not hashed again.
+    Returns:
+        int: Checksums copied.
+    """
+    copied = 0
+    for path in dict.fromkeys(file_paths):
+        # The index holds the MD5 of the gzip stream of the uncompressed files
+        if not is_compressed(path) or store.get(path):
+            continue
+        md5 = index.get(path)
+        if md5:
+            store.put(path, md5)
+            copied += 1
+
+    if copied:
+        print(f"[DEDUP] {copied} checksums taken from other campaigns, not hashed again")
+
+    return copied
+
+
+@profiling.profiled("find_duplicates")
+def find_duplicates(
+    file_paths: list,
+    index: DedupIndex,
+    store: ChecksumStore,
+    campaign: str,
+    hash_candidates: bool = True,
+    checksums: dict = None
+) -> dict:
+    """
+    Finds the files of a campaign whose content is already known: another
+    file of the index has the same MD5, or a run of another campaign was
+    registered with it. Files with no MD5 yet are hashed (hash_candidates)
+    only if another file has their size, and so are the indexed files of
+    that size with no MD5; the others are unique, unless they match a run
+    whose files are gone, which is found once they are hashed.
+    The files are added to the index.
+    Args:
+        file_paths (list): Sequence files of the campaign.
+        index (DedupIndex): Files and runs of all campaigns.
+        store (ChecksumStore): Checksum store of the campaign.
+        campaign (str): Folder of the campaign metadata (its own runs are ignored).
+        hash_candidates (bool): Hash the files with a size match and no MD5 yet.
+        checksums (dict): path -> MD5 already known (MD5.txt of the delivery).
+    Returns:
+        dict: path -> {'md5', 'copies' (paths), 'runs' (registered runs)},
+              for the duplicated files only.
+    """
+    campaign = os.path.realpath(campaign)
+    duplicates = {}
+    for path in dict.fromkeys(file_paths):
+        md5 = (checksums or {}).get(path) or index.get(path) or (
+            store.get(path) if is_compressed(path) else store.get_compressed(path, settings())[0]
+        )
+        partners = index.same_size(path) if hash_candidates else []
+        if md5 is None:
+            # Unique size: no other file can hold the same content
+            if not partners:
+                index.add_file(path, None, campaign)
+                continue
+            md5 = compressed_checksum(path, store)
+
+        index.add_file(path, md5, campaign)
+        # The other side of the size match may not be hashed either
+        hash_unhashed([partner for partner, known in partners if known is None], index, store)
+        copies = index.copies(path, md5)
+        runs = index.runs(md5, campaign)
+        if not copies and not runs:
+            continue
+
+        duplicates[path] = {"md5": md5, "copies": copies, "runs": runs}
+        name = os.path.basename(compressed_name(path))
+        for run in runs:
+            print(f"[DUPLICATE] {name}: already registered as {format_run(run)}")
+        for copy in copies:
+            print(f"[DUPLICATE] {name}: same content as {copy}")
+        events.emit("duplicate_found", path=path, md5=md5, copies=len(copies),
+                    runs=[run["run_accession"] for run in runs])
+
+    return duplicates
+
+
+def check_run_checksums(
+    run_checksums: dict,
+    index: DedupIndex,
+    store: ChecksumStore,
+    campaign: str,
+    allow_duplicates: bool = False
+) -> dict:
+    """
+    Reports the files of a run XML already known elsewhere and raises
+    ValueError if some are registered in runs of other campaigns: the same
+    content registered twice makes two runs of one sequencing.
+    Closes the index.
+    """
+    duplicates = find_duplicates(
+        list(run_checksums), index, store, campaign,
+        hash_candidates=False,
+        checksums=run_checksums
+    )
+    index.close()
+
+    registered = [path for path, found in duplicates.items() if found["runs"]]
+    if registered and not allow_duplicates:
+        store.close()
+        raise ValueError(f"[!] {len(registered)} files already registered in other runs, run XML not written "
+                         f"(--allow_duplicates to write it anyway)")
+
+    return duplicates
+
+
+def skip_registered(
+    file_list: list,
+    index_path: str,
+    checksum_store: str,
+    campaign: str,
+    allow_duplicates: bool = False
+) -> list:
+    """
+    Leaves out of an upload the files whose content is already registered in
+    a run of another campaign (reported with its accession), unless
+    allow_duplicates. Copies that are not registered are only reported.
+    """
+    index = DedupIndex(index_path)
+    store = ChecksumStore(checksum_store)
+    try:
+        prefill(file_list, index, store)
+        duplicates = find_duplicates(file_list, index, store, campaign)
+    finally:
+        index.close()
+        store.close()
+
+    registered = [path for path, found in duplicates.items() if found["runs"]]
+    if not registered or allow_duplicates:
+        return file_list
+
+    print(f"[DEDUP] {len(registered)} files already registered are not sent (--allow_duplicates to send them)")
+    return [path for path in file_list if path not in registered]
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Index the sequence files of the campaigns, report the duplicates")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("campaign_dirs",
+                        help="Campaign folders to (re-)index: sequence files, checksum stores, MD5.txt and details CSV.",
+                        nargs="*"
+                        )
+    parser.add_argument("--index",
+                        help="SQLite file of the index (default: ~/.cache/ena-submission/dedup_index.sqlite).",
+                        type=str,
+                        default=INDEX_PATH
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
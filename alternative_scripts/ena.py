@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import importlib
+
+
+# Subcommand -> (script, description). The script is imported only when its
+# subcommand is called, and the scripts import pandas/bs4 inside the functions
+# needing them, so -h and the dry runs start without loading them.
+COMMANDS = {
+    "samples": (
+        "s01_create_samples_xml",
+        "STEP 1: create the samples XML and register it."
+    ),
+    "experiment": (
+        "s02_create_experiment_xml",
+        "STEP 2: create the experiments XML from the samples receipt."
+    ),
+    "run": (
+        "s03_create_run_xml",
+        "STEP 3: create the runs XML, sequences nested in 16_S and Metagenomes folders."
+    ),
+    "run-mapping": (
+        "s03_create_run_xml_singleReadsFolder",
+        "STEP 3: create the runs XML, sequences listed in the mapping tables."
+    ),
+    "upload": (
+        "s04_upload_files",
+        "STEP 4: upload the sequences to the ENA upload area."
+    ),
+    "register": (
+        "s05_register_object",
+        "STEP 5: register experiments and runs, save the accessions."
+    ),
+    "pipeline": (
+        "pipeline",
+        "Run the STEPs 1-5 of a campaign, skipping the up-to-date ones."
+    ),
+    "batch": (
+        "batch",
+        "Run the pipeline of many campaigns over a pool of processes."
+    ),
+    "checklist": (
+        "checklist_validation",
+        "Check the sample spreadsheet against an ENA checklist."
+    ),
+    "taxonomy": (
+        "taxonomy",
+        "Build the offline NCBI taxonomy index, look up tax_ids and names."
+    ),
+    "validate": (
+        "xsd_validation",
+        "Validate XML files against the ENA schemas, without sending them."
+    ),
+    "pairs": (
+        "paired_check",
+        "Check that the forward and reverse files of each sample have the same reads."
+    ),
+    "quick-check": (
+        "quick_check",
+        "Check the first reads of each file for swapped or mislabeled files."
+    ),
+    "watch": (
+        "watch",
+        "Hash the sequence files as they are delivered, fill the checksum store."
+    ),
+    "ingest": (
+        "ingest",
+        "Copy a delivery drive into the campaign, checking the provider's MD5."
+    ),
+    "io": (
+        "io_engine",
+        "Show or probe the read settings (block size, files at once) of each mount."
+    ),
+    "hash-worker": (
+        "hash_queue",
+        "Hash the files queued by s03 --hash_queue, from any node mounting the queue."
+    ),
+    "compress": (
+        "compress",
+        "Gzip uncompressed FASTQ files on all cores, hash and upload the stream."
+    ),
+    "dedup": (
+        "dedup",
+        "Index the files of the campaigns by size and MD5, report the duplicates."
+    ),
+    "status": (
+        "run_status",
+        "Check the ENA processing of the registered runs and the MD5 of their files."
+    ),
+    "promote": (
+        "promote",
+        "Register the submission validated in TEST permanently, sending the same XML bytes."
+    ),
+    "plan": (
+        "plan",
+        "Estimate the hashing, compression and upload time of a campaign, recommend workers."
+    ),
+}
+
+
+def main(argv: list = None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    # First positional argument, anything else is an option of the entry point
+    command = next((arg for arg in argv if not arg.startswith("-")), None)
+
+    parser = argparse.ArgumentParser("ena", fromfile_prefix_chars="@")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name, (module_name, description) in COMMANDS.items():
+        subparser = subparsers.add_parser(
+            name,
+            help=description,
+            description=description
+        )
+        if name == command:
+            module = importlib.import_module(module_name)
+            module.add_arguments(subparser)
+            subparser.set_defaults(main=module.main)
+
+    args = parser.parse_args(argv)
+
+    command_main = args.main
+    del args.main, args.command
+
+    command_main(args)
+
+
+if __name__ == "__main__":
+    main()
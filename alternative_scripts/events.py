@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import socket
+import atexit
+import argparse
+import threading
+
+
+# Active emitter of the process, None when --events is not given
+_emitter = None
+
+
+class EventEmitter:
+    """
+    Writes one JSON object per line for each event of a run, so that a
+    scheduler or a dashboard can follow a submission while it runs.
+    The target is a file (appended), '-' for stderr, tcp://host:port or
+    unix:///path/to/socket. Every event carries its name, a timestamp,
+    the command and the process id, plus the fields given to emit().
+    """
+
+    def __init__(self, target: str, command: str):
+        self.target = target
+        self.command = command
+        self.lock = threading.Lock()
+        self.sock = None
+        self.handle = None
+        self.discovered = set()
+
+        if target == "-":
+            self.handle = sys.stderr
+        elif target.startswith("tcp://"):
+            host, port = target[len("tcp://"):].rsplit(":", 1)
+            self.sock = socket.create_connection((host, int(port)), timeout=10)
+        elif target.startswith("unix://"):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(10)
+            self.sock.connect(target[len("unix://"):])
+        else:
+            # Line buffered: a reader tailing the file sees each event at once
+            self.handle = open(target, mode="a", buffering=1)
+
+    def emit(self, event: str, **fields) -> None:
+        record = {
+            "event": event,
+            "time": time.time(),
+            "command": self.command,
+            "pid": os.getpid()
+        }
+        record.update(fields)
+        line = json.dumps(record, default=str) + "\n"
+
+        with self.lock:
+            try:
+                if self.sock is not None:
+                    self.sock.sendall(line.encode())
+                elif self.handle is not None:
+                    self.handle.write(line)
+            except OSError as e:
+                # A dashboard going away must not stop the submission
+                print(f"[EVENTS][!] Cannot write to {self.target}, events disabled: {e}")
+                self.sock = None
+                self.handle = None
+
+    def close(self) -> None:
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+            elif self.handle is not None and self.handle is not sys.stderr:
+                self.handle.close()
+            self.sock = None
+            self.handle = None
+
+
+def emit(event: str, **fields) -> None:
+    """
+    Emits an event, doing nothing when --events is not given:
+        events.emit("hash_finished", path=file_path, bytes=size, duration_s=elapsed)
+    """
+    if _emitter is not None:
+        _emitter.emit(event, **fields)
+
+
+def file_discovered(path: str, **fields) -> None:
+    # The pipeline lists the inventory several times (fingerprints, upload):
+    # each file is reported once per process
+    if _emitter is None or path in _emitter.discovered:
+        return
+
+    _emitter.discovered.add(path)
+    _emitter.emit("file_discovered", path=path, bytes=os.path.getsize(path), **fields)
+
+
+def enabled() -> bool:
+    return _emitter is not None
+
+
+class heartbeat:
+    """
+    Context manager emitting an event every interval seconds while a long
+    external command runs (lftp, curl), so that a stall shows up as a gap
+    between the elapsed_s values instead of silence:
+        with events.heartbeat("upload_running", path=file_path):
+            subprocess.run(...)
+    """
+
+    def __init__(self, event: str, interval: float = 30, **fields):
+        self.event = event
+        self.interval = interval
+        self.fields = fields
+        self.done = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        if _emitter is not None:
+            self.start_time = time.perf_counter()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self) -> None:
+        while not self.done.wait(self.interval):
+            emit(self.event, elapsed_s=time.perf_counter() - self.start_time, **self.fields)
+
+    def __exit__(self, *exc_info):
+        if self.thread is not None:
+            self.done.set()
+            self.thread.join()
+        return False
+
+
+def start(args: argparse.Namespace, command: str) -> EventEmitter:
+    """
+    Opens the event target if --events was given and emits 'run_started';
+    'run_finished' is emitted when the process exits.
+    """
+    global _emitter
+
+    if not getattr(args, "events", None) or _emitter is not None:
+        return _emitter
+
+    _emitter = EventEmitter(args.events, command=command)
+    _emitter.emit("run_started", argv=sys.argv)
+    atexit.register(stop)
+
+    return _emitter
+
+
+def stop() -> None:
+    global _emitter
+
+    if _emitter is None:
+        return
+
+    _emitter.emit("run_finished")
+    _emitter.close()
+    _emitter = None
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--events",
+                        help="Where the JSONL progress events are written: a file, '-' for stderr, "
+                             "tcp://host:port or unix:///path.",
+                        type=str
+                        )
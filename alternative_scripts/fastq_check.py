@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import zlib
+
+
+# Longer than any read (ultra-long nanopore reads are a few Mb): not a FASTQ file
+MAX_LINE_LENGTH = 64 * 1024 * 1024
+
+
+class FastqError(ValueError):
+    pass
+
+
+class FastqChecker:
+    """
+    Checks a (gzipped) FASTQ file from the blocks read to compute its MD5, so
+    that the integrity check costs no extra read of the file:
+        - every gzip member decompresses and its CRC32/ISIZE trailer matches
+          (verified by zlib), the file does not end inside a member;
+        - records have four lines, '@' header, '+' separator and as many
+          quality values as bases; the file does not end inside a record.
+    Only the first structural problem is kept, the decompression goes on so
+    that a corrupt trailer later in the file is still found.
+    """
+
+    def __init__(self, file_path: str, compressed: bool = None):
+        self.file_path = file_path
+        self.compressed = file_path.endswith(".gz") if compressed is None else compressed
+        # 16 + MAX_WBITS: gzip wrapper, one decompressor per member
+        self.decompressor = zlib.decompressobj(wbits=31) if self.compressed else None
+        self.members = 0
+        self.in_member = False
+        self.records = 0
+        self.bases = 0
+        self.problem = None
+
+        self.carry = b""
+        self.pending = []
+
+    def update(self, block: bytes) -> None:
+        if not self.compressed:
+            self.parse(block)
+            return
+
+        data = block
+        while data and self.decompressor is not None:
+            try:
+                self.parse(self.decompressor.decompress(data))
+            except zlib.error as e:
+                # Bad deflate data, CRC or ISIZE: nothing after this point can be trusted
+                self.fail(f"corrupt gzip member {self.members + 1}: {e}")
+                self.decompressor = None
+                return
+
+            self.in_member = not self.decompressor.eof
+            if self.in_member:
+                return
+
+            # Next member of a concatenated (bgzip/pigz) file, zero padding is ignored
+            self.members += 1
+            data = self.decompressor.unused_data.lstrip(b"\0")
+            self.decompressor = zlib.decompressobj(wbits=31)
+
+    def parse(self, data: bytes) -> None:
+        if not data or self.problem is not None:
+            return
+
+        lines = (self.carry + data).split(b"\n")
+        self.carry = lines.pop()
+        if len(self.carry) > MAX_LINE_LENGTH:
+            self.fail(f"record {self.records + 1}: line longer than {MAX_LINE_LENGTH // (1024 * 1024)} MiB, "
+                      f"not a FASTQ file")
+            self.carry = b""
+            return
+
+        pending = self.pending + lines
+        complete = len(pending) - len(pending) % 4
+        self.pending = pending[complete:]
+        if complete:
+            self.check_records(pending[:complete])
+
+    def check_records(self, lines: list) -> None:
+        headers = lines[0::4]
+        sequences = lines[1::4]
+        separators = lines[2::4]
+        qualities = lines[3::4]
+
+        # Whole batch at once, then located only when something is wrong
+        if {header[:1] for header in headers} == {b"@"} \
+                and {separator[:1] for separator in separators} == {b"+"} \
+                and list(map(len, sequences)) == list(map(len, qualities)):
+            self.records += len(headers)
+            self.bases += sum(map(len, sequences))
+            return
+
+        for i, (header, sequence, separator, quality) in enumerate(
+            zip(headers, sequences, separators, qualities)
+        ):
+            record = self.records + i + 1
+            if header[:1] != b"@":
+                self.fail(f"record {record}: header does not start with '@': {header[:50]!r}")
+            elif separator[:1] != b"+":
+                self.fail(f"record {record}: third line does not start with '+': {separator[:50]!r}")
+            elif len(sequence.rstrip(b"\r")) != len(quality.rstrip(b"\r")):
+                self.fail(f"record {record}: {len(sequence)} bases but {len(quality)} quality values")
+            if self.problem is not None:
+                return
+
+    def fail(self, problem: str) -> None:
+        if self.problem is None:
+            self.problem = problem
+
+    def finish(self) -> None:
+        """
+        Raises FastqError if the file is corrupt or truncated.
+        """
+        if self.compressed and self.decompressor is not None:
+            if self.in_member:
+                self.fail("truncated gzip member (missing CRC32/ISIZE trailer)")
+            elif self.members == 0:
+                self.fail("empty gzip file")
+
+        if self.problem is None:
+            lines = self.pending + ([self.carry] if self.carry else [])
+            if len(lines) == 4:
+                # Last record without the final newline
+                self.check_records(lines)
+            elif lines:
+                self.fail(f"truncated record after record {self.records} ({len(lines)} of 4 lines)")
+
+        if self.problem is None and self.records == 0:
+            self.fail("no FASTQ record")
+
+        if self.problem is not None:
+            raise FastqError(f"[!] {self.file_path}: {self.problem}")
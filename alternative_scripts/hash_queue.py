@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import hashlib
+import argparse
+import threading
+
+import events
+import profiling
+import io_engine
+from checksum_store import md5sum
+from fastq_check import FastqChecker, FastqError
+
+
+# Claims not touched for STALE_AFTER seconds are given back to the queue:
+# their worker died or lost the file system. Workers touch theirs every HEARTBEAT
+HEARTBEAT = 30
+STALE_AFTER = 300
+DEFAULT_INTERVAL = 5
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="hash_queue")
+    events.start(args, command="hash_queue")
+
+    # Killed by the batch scheduler: the claim goes stale and is hashed again elsewhere
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    queue = HashQueue(args.queue_dir)
+    hashed = queue.work(idle_timeout=args.idle_timeout, interval=args.interval)
+    print(f"[QUEUE] {hashed} files hashed by {socket.gethostname()} (pid {os.getpid()})")
+
+
+class HashQueue:
+    """
+    Hashing tasks shared through a folder that every node mounts, no broker:
+        tasks/<size>-<id>.json            waiting, one per file version
+        claimed/<size>-<id>.<worker>      taken by a worker (atomic rename)
+        results/<id>.json                 MD5 (and FASTQ check) of the file
+    rename() is atomic on local and NFS file systems, so exactly one worker
+    gets each task. Workers never open the SQLite store (its locks are not
+    reliable over NFS): the coordinator merges the results into it.
+    The files must have the same path on all nodes.
+    """
+
+    def __init__(self, queue_dir: str):
+        self.queue_dir = queue_dir
+        self.tasks_dir = os.path.join(queue_dir, "tasks")
+        self.claimed_dir = os.path.join(queue_dir, "claimed")
+        self.results_dir = os.path.join(queue_dir, "results")
+        for directory in (self.tasks_dir, self.claimed_dir, self.results_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def task_id(path: str, size: int, mtime_ns: int) -> str:
+        # Same id for the same file version: a restarted coordinator finds its results
+        return hashlib.sha1(f"{path}\0{size}\0{mtime_ns}".encode()).hexdigest()
+
+    @staticmethod
+    def worker_id() -> str:
+        return f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+
+    def put(self, path: str, size: int, mtime_ns: int, verify_fastq: bool = False) -> str:
+        task_id = self.task_id(path, size, mtime_ns)
+        # Larger files first (names sort by size): the last task is a short one
+        name = f"{size:016d}-{task_id}"
+        if os.path.exists(self.result_path(task_id)) or self.claims(name):
+            return task_id
+
+        write_json(os.path.join(self.tasks_dir, f"{name}.json"), {
+            "id": task_id,
+            "path": path,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "verify_fastq": verify_fastq,
+            "queued": time.time()
+        })
+
+        return task_id
+
+    def claims(self, name: str) -> list:
+        return [entry for entry in os.listdir(self.claimed_dir) if entry.startswith(f"{name}.")]
+
+    def result_path(self, task_id: str) -> str:
+        return os.path.join(self.results_dir, f"{task_id}.json")
+
+    def pending(self) -> list:
+        return sorted((name for name in os.listdir(self.tasks_dir) if name.endswith(".json")), reverse=True)
+
+    def claim(self) -> tuple:
+        """
+        Takes the largest waiting task. Returns (task, claim_path), or
+        (None, None) when the queue is empty.
+        """
+        for name in self.pending():
+            claim_path = os.path.join(self.claimed_dir, f"{name[:-len('.json')]}.{self.worker_id()}")
+            try:
+                os.rename(os.path.join(self.tasks_dir, name), claim_path)
+            except FileNotFoundError:
+                # Taken by another worker in the meantime
+                continue
+
+            with open(claim_path, mode="r") as handle:
+                return json.load(handle), claim_path
+
+        return None, None
+
+    def run_task(self, task: dict, claim_path: str) -> dict:
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(HEARTBEAT):
+                try:
+                    os.utime(claim_path)
+                except FileNotFoundError:
+                    return
+
+        beating = threading.Thread(target=heartbeat, daemon=True)
+        beating.start()
+
+        result = dict(task, worker=self.worker_id(), md5=None, checked=False, problem=None, error=None)
+        start_time = time.perf_counter()
+        try:
+            result.update(hash_file(task["path"], task["size"], task["mtime_ns"], task["verify_fastq"]))
+        except OSError as e:
+            result["error"] = str(e)
+        finally:
+            stop.set()
+            beating.join()
+
+        result["duration_s"] = time.perf_counter() - start_time
+        write_json(self.result_path(task["id"]), result)
+        os.remove(claim_path)
+        events.emit("hash_task_done", path=task["path"], bytes=task["size"], worker=result["worker"],
+                    duration_s=result["duration_s"], ok=result["md5"] is not None)
+
+        return result
+
+    def work(self, idle_timeout: float = DEFAULT_IDLE_TIMEOUT, interval: float = DEFAULT_INTERVAL) -> int:
+        """
+        Hashes the queued files until no task came for idle_timeout seconds
+        (0: until the queue is empty, negative: forever).
+        Returns:
+            int: Files hashed.
+        """
+        hashed = 0
+        idle_since = time.time()
+        while True:
+            task, claim_path = self.claim()
+            if task is not None:
+                result = self.run_task(task, claim_path)
+                status = result["md5"] or f"[!] {result['error'] or result['problem']}"
+                print(f"[QUEUE][+] {status} {task['path']}")
+                hashed += 1
+                idle_since = time.time()
+                continue
+
+            if 0 <= idle_timeout <= time.time() - idle_since:
+                return hashed
+            time.sleep(interval)
+
+    def requeue_stale(self) -> int:
+        # Compared with the clock of the file server, not of this node
+        clock_path = os.path.join(self.queue_dir, ".clock")
+        with open(clock_path, mode="a"):
+            os.utime(clock_path)
+        now = os.stat(clock_path).st_mtime
+
+        requeued = 0
+        for entry in os.scandir(self.claimed_dir):
+            try:
+                if now - entry.stat().st_mtime < STALE_AFTER:
+                    continue
+                name = entry.name.split(".")[0]
+                os.rename(entry.path, os.path.join(self.tasks_dir, f"{name}.json"))
+            except FileNotFoundError:
+                continue
+            print(f"[WARNING] No news from {entry.name[len(name) + 1:]} for {STALE_AFTER} s, task queued again")
+            requeued += 1
+
+        return requeued
+
+
+def hash_file(path: str, size: int, mtime_ns: int, verify_fastq: bool = False) -> dict:
+    """
+    MD5 (and FASTQ check) of the version of a file given by its size and
+    modification time. A file changed since it was queued is not hashed.
+    """
+    stat = os.stat(path)
+    if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+        return {"error": "changed since it was queued"}
+
+    checker = FastqChecker(path) if verify_fastq else None
+    md5 = md5sum(path, checker=checker)
+
+    problem = None
+    if checker is not None:
+        try:
+            checker.finish()
+        except FastqError as e:
+            problem = str(e)
+
+    stat = os.stat(path)
+    if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+        return {"error": "changed while it was hashed"}
+
+    return {"md5": md5, "checked": checker is not None, "problem": problem}
+
+
+def write_json(path: str, data: dict) -> None:
+    # Readers on other nodes never see a partial file
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_path, mode="w") as handle:
+        json.dump(data, handle)
+    os.replace(tmp_path, path)
+
+
+@profiling.profiled("distributed_hashing")
+def distribute(
+    file_paths: list,
+    queue_dir: str,
+    store,
+    verify_fastq: bool = False,
+    local_workers: int = 1,
+    interval: float = DEFAULT_INTERVAL
+) -> int:
+    """
+    Queues the files missing from the checksum store, waits until workers
+    ('ena.py hash-worker <queue_dir>' on any node) have hashed them, and
+    merges their results into the store. This run hashes queued files too
+    with local_workers threads, so the queue is never left without workers.
+    Files whose result cannot be used (changed, unreadable) are left out of
+    the store and hashed again by the caller.
+    Args:
+        file_paths (list): Files to hash.
+        queue_dir (str): Queue folder on the file system shared by the nodes.
+        store (ChecksumStore): Store of the campaign, filled with the results.
+        verify_fastq (bool): Also check the gzip stream and the FASTQ records.
+        local_workers (int): Files hashed at the same time by this process.
+        interval (float): Seconds between two looks at the results.
+    Returns:
+        int: Checksums added to the store.
+    """
+    queue = HashQueue(queue_dir)
+
+    tasks = {}
+    for file_path in dict.fromkeys(file_paths):
+        if store.get(file_path) and (not verify_fastq or store.get_check(file_path)[0]):
+            continue
+        path = os.path.realpath(file_path)
+        stat = os.stat(path)
+        tasks[queue.put(path, stat.st_size, stat.st_mtime_ns, verify_fastq)] = path
+
+    if not tasks:
+        return 0
+
+    print(f"[QUEUE] {len(tasks)} files queued in {queue_dir}, "
+          f"start workers with: python ena.py hash-worker {os.path.abspath(queue_dir)}")
+    events.emit("hash_queued", files=len(tasks), queue_dir=queue_dir)
+    start_time = time.perf_counter()
+
+    local = []
+    merged = 0
+    workers = set()
+    last_report = 0
+    while tasks:
+        for task_id in list(tasks):
+            try:
+                with open(queue.result_path(task_id), mode="r") as handle:
+                    result = json.load(handle)
+            except FileNotFoundError:
+                continue
+
+            path = tasks.pop(task_id)
+            workers.add(result["worker"].rsplit("-", 1)[0])
+            os.remove(queue.result_path(task_id))
+            if merge(store, result):
+                merged += 1
+            else:
+                print(f"[WARNING] {path}: {result['error']}, hashed again here")
+
+        if not tasks:
+            break
+
+        queue.requeue_stale()
+
+        # Local workers stop when the queue is empty, restarted for requeued tasks
+        local = [thread for thread in local if thread.is_alive()]
+        if queue.pending():
+            for _ in range(local_workers - len(local)):
+                thread = threading.Thread(target=queue.work, kwargs={"idle_timeout": 0}, daemon=True)
+                thread.start()
+                local.append(thread)
+
+        if time.time() - last_report >= 60:
+            print(f"[QUEUE] {len(tasks)} files left ({len(queue.pending())} waiting for a worker)")
+            last_report = time.time()
+        time.sleep(interval)
+
+    for thread in local:
+        thread.join()
+
+    elapsed_time = time.perf_counter() - start_time
+    print(f"[QUEUE][+] {merged} checksums from {len(workers)} processes in {elapsed_time:.0f} s")
+    events.emit("hash_queue_finished", files=merged, processes=len(workers), duration_s=elapsed_time)
+
+    return merged
+
+
+def merge(store, result: dict) -> bool:
+    if result["error"]:
+        return False
+
+    # The store keys the checksum on the current size and modification time
+    try:
+        stat = os.stat(result["path"])
+    except FileNotFoundError:
+        result["error"] = "removed since it was hashed"
+        return False
+    if (stat.st_size, stat.st_mtime_ns) != (result["size"], result["mtime_ns"]):
+        result["error"] = "changed since it was hashed"
+        return False
+
+    store.put(result["path"], result["md5"])
+    if result["checked"]:
+        store.put_check(result["path"], result["problem"])
+    store.put_throughput("hash", io_engine.mount_point(result["path"]), result["size"], result["duration_s"])
+
+    return True
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Hash the files queued on a shared file system")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("queue_dir",
+                        help="Queue folder given to s03 (or the pipeline) with --hash_queue.",
+                        type=str
+                        )
+    parser.add_argument("--idle_timeout",
+                        help="Exit after this many seconds without a task (0: once the queue is empty, -1: never).",
+                        type=float,
+                        default=DEFAULT_IDLE_TIMEOUT
+                        )
+    parser.add_argument("--interval",
+                        help="Seconds between two looks at an empty queue.",
+                        type=float,
+                        default=DEFAULT_INTERVAL
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import events
+from checksum_store import ChecksumStore, get_checksum
+from s04_upload_files import upload_file
+
+
+def hash_and_upload(
+    file_list: list,
+    username: str,
+    checksum_store: str,
+    hash_workers: int = 2,
+    upload_workers: int = 4,
+    queue_size: int = 8,
+    dry_run: bool = False
+) -> dict:
+    """
+    Hashes (s03) and uploads (s04) the files at the same time.
+    Hash workers push each file into a bounded queue as soon as its checksum
+    is saved in the store, upload workers pop from it. The bound keeps the
+    hashing close to the uploads, so the file is usually still in the page
+    cache when lftp reads it, and wall time approaches max(hash, upload).
+    upload_file drops its pages from the cache once it is sent.
+    The run XML is then built by s03 from the store without reading the files.
+    Args:
+        file_list (list): Paths of the files to hash and upload.
+        username (str): Webin username, the password is read from netrc.
+        checksum_store (str): SQLite file where the checksums are saved.
+        hash_workers (int): Files hashed at the same time.
+        upload_workers (int): lftp sessions running at the same time.
+        queue_size (int): Hashed files waiting for an upload worker.
+        dry_run (bool): Only print the lftp commands.
+    Returns:
+        dict: A dictionary with keys:
+            - 'checksums' (dict of path -> MD5)
+            - 'uploaded' (list of str)
+            - 'failed' (list of str)
+    """
+    store = ChecksumStore(checksum_store)
+    upload_queue = queue.Queue(maxsize=queue_size)
+    lock = threading.Lock()
+
+    results = {
+        'checksums': {},
+        'uploaded': [],
+        'failed': []
+    }
+
+    file_list = list(dict.fromkeys(file_list))
+    progress = {
+        'files_total': len(file_list),
+        'bytes_total': sum(os.path.getsize(path) for path in file_list),
+        'files_done': 0,
+        'bytes_done': 0
+    }
+
+    def hash_task(file_path: str) -> None:
+        # Kept in the page cache for lftp
+        md5 = get_checksum(file_path, store, keep_cache=True)
+        with lock:
+            results['checksums'][file_path] = md5
+        print(f"[HASH][+] {md5} {file_path}")
+
+        # Blocks while the upload workers are behind
+        upload_queue.put(file_path)
+
+    def upload_worker() -> None:
+        while True:
+            file_path = upload_queue.get()
+            if file_path is None:
+                break
+
+            # Any error is a failed file: the worker keeps draining the queue,
+            # or the hash workers would block on a full one
+            try:
+                uploaded = upload_file(file_path, username, dry_run)
+                if dry_run:
+                    continue
+            except Exception as e:
+                print(f"[!] Upload failed for {file_path}: {e!r}")
+                uploaded = False
+
+            with lock:
+                results['uploaded' if uploaded else 'failed'].append(file_path)
+                progress['files_done'] += 1
+                progress['bytes_done'] += os.path.getsize(file_path)
+                events.emit("upload_progress", failed=len(results['failed']), **progress)
+            if uploaded:
+                print(f"[UPLOAD][+] {file_path}")
+
+    start_time = time.time()
+
+    uploaders = [
+        threading.Thread(target=upload_worker, daemon=True)
+        for _ in range(upload_workers)
+    ]
+    for uploader in uploaders:
+        uploader.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=hash_workers) as pool:
+            futures = [
+                pool.submit(hash_task, file_path)
+                for file_path in file_list
+            ]
+            for future in futures:
+                future.result()
+
+    finally:
+        for _ in uploaders:
+            upload_queue.put(None)
+        for uploader in uploaders:
+            uploader.join()
+        store.close()
+
+    elapsed_time = time.time() - start_time
+    print(f"[INFO] Hashed {len(results['checksums'])} files, "
+          f"uploaded {len(results['uploaded'])} in {elapsed_time:.2f}s")
+
+    if results['failed']:
+        print('\n'.join(f"[!] Not uploaded: {path}" for path in results['failed']))
+
+    return results
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import time
+import queue
+import shutil
+import fnmatch
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import events
+import profiling
+import io_engine
+from checksum_store import ChecksumStore, default_store_path, read_md5_file, write_md5_file
+
+
+DEFAULT_PATTERNS = ["*.fastq.gz", "*.fq.gz"]
+# Checksum files of the providers: MD5.txt, md5sum.txt, checksums.md5, <file>.md5, ...
+VENDOR_PATTERNS = ["*md5*.txt", "*MD5*.txt", "*checksum*.txt", "*.md5"]
+# Read from the drive in large blocks: the copy is limited by the drive, not by Python
+BLOCK_SIZE = 16 * 1024 * 1024
+MANIFEST_NAME = "MD5.txt"
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="ingest")
+    events.start(args, command="ingest")
+
+    checksum_store = args.checksum_store
+    if not checksum_store and args.metadata_path:
+        checksum_store = default_store_path(os.path.dirname(args.metadata_path))
+
+    results = ingest(
+        source_dir=args.source_dir,
+        destination_dir=args.destination_dir,
+        checksum_store=checksum_store,
+        patterns=args.patterns,
+        flatten=args.flatten,
+        workers=args.workers,
+        block_size=args.block_size
+    )
+
+    if args.report:
+        with open(args.report, mode="w", newline="") as handle:
+            writer = csv.DictWriter(handle, fieldnames=list(results[0]) if results else ["source"], delimiter="\t")
+            writer.writeheader()
+            writer.writerows(results)
+        print(f"[INGEST][+] Report saved to: {args.report}")
+
+    if any(result["status"] in ("mismatch", "failed") for result in results):
+        sys.exit(1)
+
+    unverified = [result["source"] for result in results if result["vendor_md5"] is None]
+    if args.require_vendor and unverified:
+        print('\n'.join(f"[!] {path}: no checksum from the provider" for path in unverified))
+        sys.exit(1)
+
+
+def find_vendor_checksums(source_dir: str) -> dict:
+    """
+    Reads every checksum file of the delivery.
+    Returns:
+        dict: (folder, file name) -> MD5, folder relative to source_dir.
+    """
+    checksums = {}
+    for folder, _, names in os.walk(source_dir):
+        relative_folder = os.path.relpath(folder, source_dir)
+        for name in names:
+            if not any(fnmatch.fnmatch(name, pattern) for pattern in VENDOR_PATTERNS):
+                continue
+
+            path = os.path.join(folder, name)
+            found = read_md5_file(path)
+            if not found and name.endswith(".md5"):
+                # <file>.md5 holding only the checksum
+                with open(path, mode="r", errors="replace") as handle:
+                    md5 = handle.read().strip().split(" ")[0].lower()
+                if len(md5) == 32:
+                    found = {name[:-len(".md5")]: md5}
+
+            for file_name, md5 in found.items():
+                checksums[(relative_folder, file_name)] = md5
+
+    return checksums
+
+
+def list_sequence_files(source_dir: str, patterns: list) -> list:
+    # Relative paths, hidden files (partial copies) left out
+    files = []
+    for folder, _, names in os.walk(source_dir):
+        for name in sorted(names):
+            if not name.startswith(".") and any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                files.append(os.path.relpath(os.path.join(folder, name), source_dir))
+
+    return sorted(files)
+
+
+def copy_file(source: str, destination: str, block_size: int = BLOCK_SIZE) -> str:
+    """
+    Copies a file and returns the MD5 of the bytes read: the blocks are hashed
+    while a second thread writes them, so the drive is read once and reading,
+    hashing and writing overlap (hashlib and file writes release the GIL).
+    Neither the source nor the copy is left in the page cache.
+    """
+    blocks = queue.Queue(maxsize=4)
+    errors = []
+
+    def write() -> None:
+        try:
+            with open(destination, mode="wb") as handle:
+                for block in iter(blocks.get, None):
+                    handle.write(block)
+                handle.flush()
+                os.fsync(handle.fileno())
+                # Written to disk: the pages can go
+                io_engine.fadvise(handle.fileno(), 0, 0, "DONTNEED")
+        except OSError as e:
+            errors.append(e)
+            # Keeps the reader from blocking on a full queue
+            for _ in iter(blocks.get, None):
+                pass
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+
+    md5 = hashlib.md5()
+    try:
+        with io_engine.device_slot(source):
+            for block in io_engine.read_blocks(source, block_size, buffers=blocks.maxsize + 2):
+                md5.update(block)
+                blocks.put(block)
+    finally:
+        blocks.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+    return md5.hexdigest()
+
+
+def ingest_file(
+    source_dir: str,
+    relative_path: str,
+    destination: str,
+    vendor_md5: str,
+    store: ChecksumStore,
+    block_size: int = BLOCK_SIZE
+) -> dict:
+    """
+    Copies one file of the delivery, unless an identical copy is already in
+    place, and compares its MD5 with the one of the provider.
+    Returns:
+        dict: 'source', 'destination', 'bytes', 'md5', 'vendor_md5' and 'status',
+              one of 'verified', 'copied' (no vendor checksum), 'mismatch',
+              'up-to-date' or 'failed'.
+    """
+    source = os.path.join(source_dir, relative_path)
+    size = os.path.getsize(source)
+    result = {
+        "source": source,
+        "destination": destination,
+        "bytes": size,
+        "md5": None,
+        "vendor_md5": vendor_md5,
+        "status": None
+    }
+
+    # Copied by a previous run: same size and the MD5 of the copy is known
+    if os.path.exists(destination) and os.path.getsize(destination) == size and store is not None:
+        md5 = store.get(destination)
+        if md5 and (vendor_md5 is None or md5 == vendor_md5):
+            result.update(md5=md5, status="up-to-date")
+            return result
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    # Hidden while copied: the watcher and the s03 glob ignore it
+    tmp_path = os.path.join(os.path.dirname(destination), f".{os.path.basename(destination)}.ingest")
+
+    start_time = time.perf_counter()
+    try:
+        md5 = copy_file(source, tmp_path, block_size)
+    except OSError as e:
+        print(f"[INGEST][!] {source}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        result["status"] = "failed"
+        return result
+    elapsed_time = time.perf_counter() - start_time
+
+    result["md5"] = md5
+    if vendor_md5 is not None and md5 != vendor_md5:
+        # The drive returned other bytes than the provider hashed: nothing is put in place
+        os.remove(tmp_path)
+        result["status"] = "mismatch"
+        print(f"[INGEST][!] {source}: MD5 {md5} but {vendor_md5} in the provider's checksums")
+    else:
+        shutil.copystat(source, tmp_path)
+        os.replace(tmp_path, destination)
+        if store is not None:
+            store.put(destination, md5)
+        result["status"] = "verified" if vendor_md5 else "copied"
+        print(f"[INGEST][+] {md5} {destination} ({size / elapsed_time / 1e6 if elapsed_time else 0:.0f} MB/s"
+              f"{', no provider checksum' if vendor_md5 is None else ''})")
+
+    events.emit("file_ingested", path=destination, source=source, bytes=size, md5=md5,
+                status=result["status"], duration_s=elapsed_time)
+
+    return result
+
+
+@profiling.profiled("ingest")
+def ingest(
+    source_dir: str,
+    destination_dir: str,
+    checksum_store: str = None,
+    patterns: list = None,
+    flatten: bool = False,
+    workers: int = 1,
+    block_size: int = BLOCK_SIZE
+) -> list:
+    """
+    Copies the sequence files of a delivery (a provider drive) into the
+    campaign layout. Each file is read once: its MD5 is computed during the
+    copy and checked against the checksum files of the provider. The MD5 of
+    the copies go to the checksum store and to an MD5.txt manifest in each
+    destination folder, holding only the checked files, which s03 then reads
+    instead of hashing the files again.
+    Args:
+        source_dir (str): Mount point of the delivery.
+        destination_dir (str): Folder of the campaign receiving the files.
+        checksum_store (str): SQLite checksum store of the campaign (optional).
+        patterns (list): Patterns of the files to copy.
+        flatten (bool): Copy all files into destination_dir instead of keeping
+                        the folders of the delivery.
+        workers (int): Files copied at the same time (1 for a single hard drive).
+        block_size (int): Bytes read at once.
+    Returns:
+        list: Result of ingest_file for each file.
+    """
+    if not os.path.isdir(source_dir):
+        raise FileNotFoundError(f"{source_dir} does not exist!")
+
+    vendor = find_vendor_checksums(source_dir)
+    vendor_by_name = {}
+    for (_, name), md5 in vendor.items():
+        vendor_by_name.setdefault(name, set()).add(md5)
+
+    files = list_sequence_files(source_dir, patterns or DEFAULT_PATTERNS)
+    print(f"[INGEST] {len(files)} files in {source_dir}, {len(vendor)} provider checksums")
+
+    destinations = {
+        relative_path: os.path.join(
+            destination_dir,
+            os.path.basename(relative_path) if flatten else relative_path
+        )
+        for relative_path in files
+    }
+    if len(set(destinations.values())) != len(destinations):
+        raise ValueError("[!] Several files of the delivery have the same name, copy them without --flatten")
+
+    def vendor_md5(relative_path: str) -> str:
+        folder, name = os.path.split(relative_path)
+        md5 = vendor.get((folder or ".", name))
+        if md5 is None and len(vendor_by_name.get(name, ())) == 1:
+            # Checksum file in another folder (e.g. one MD5.txt at the root of the drive)
+            md5 = next(iter(vendor_by_name[name]))
+        return md5
+
+    store = ChecksumStore(checksum_store) if checksum_store else None
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+            lambda relative_path: ingest_file(
+                source_dir=source_dir,
+                relative_path=relative_path,
+                destination=destinations[relative_path],
+                vendor_md5=vendor_md5(relative_path),
+                store=store,
+                block_size=block_size
+            ),
+            files
+        ))
+
+    elapsed_time = time.perf_counter() - start_time
+    if store is not None:
+        store.close()
+
+    write_manifests(results)
+
+    copied = sum(result["bytes"] for result in results if result["status"] in ("verified", "copied"))
+    counts = {status: sum(result["status"] == status for result in results)
+              for status in ("verified", "copied", "up-to-date", "mismatch", "failed")}
+    print(f"[INGEST][+] {', '.join(f'{count} {status}' for status, count in counts.items() if count)}; "
+          f"{copied / 1e9:.2f} GB in {elapsed_time:.0f} s"
+          f" ({copied / elapsed_time / 1e6 if elapsed_time else 0:.0f} MB/s)")
+
+    return results
+
+
+def write_manifests(results: list) -> list:
+    """
+    Adds the copied files to the MD5.txt of their destination folder, with
+    the MD5 computed during the copy. Mismatching and failed files are left
+    out (and removed from a previous manifest).
+    """
+    by_folder = {}
+    for result in results:
+        by_folder.setdefault(os.path.dirname(result["destination"]), []).append(result)
+
+    manifest_paths = []
+    for folder, folder_results in sorted(by_folder.items()):
+        manifest_path = os.path.join(folder, MANIFEST_NAME)
+        checksums = read_md5_file(manifest_path)
+        for result in folder_results:
+            name = os.path.basename(result["destination"])
+            if result["status"] in ("mismatch", "failed"):
+                checksums.pop(name, None)
+            else:
+                checksums[name] = result["md5"]
+
+        if checksums:
+            manifest_paths.append(write_md5_file(manifest_path, checksums))
+            print(f"[INGEST][+] Manifest saved to: {manifest_path}")
+
+    return manifest_paths
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Copying a delivery into the campaign, checking the provider's MD5")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("source_dir",
+                        help="Mount point (or folder) of the delivery.",
+                        type=str
+                        )
+    parser.add_argument("destination_dir",
+                        help="Folder of the campaign receiving the sequence files.",
+                        type=str
+                        )
+    parser.add_argument("-i", "--metadata_path",
+                        help="Excel file of the campaign: the checksums go to the store next to it, as for s03.",
+                        type=str
+                        )
+    parser.add_argument("--checksum_store",
+                        help="SQLite file where the checksums are saved (default: next to the metadata file).",
+                        type=str
+                        )
+    parser.add_argument("-p", "--patterns",
+                        help="Comma separated patterns of the files to copy.",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=DEFAULT_PATTERNS
+                        )
+    parser.add_argument("--flatten",
+                        action="store_true",
+                        help="Copy all files into destination_dir (mapping table layout) instead of keeping the folders."
+                        )
+    parser.add_argument("-j", "--workers",
+                        help="Files copied at the same time (1 for a hard drive, more for SSD or RAID).",
+                        type=int,
+                        default=1
+                        )
+    parser.add_argument("--block_size",
+                        help="Bytes read at once.",
+                        type=int,
+                        default=BLOCK_SIZE
+                        )
+    parser.add_argument("--require_vendor",
+                        action="store_true",
+                        help="Exit with an error if some files have no checksum from the provider."
+                        )
+    parser.add_argument("-r", "--report",
+                        help="TSV file where the result of every file is saved.",
+                        type=str
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+
+import profiling
+
+
+# Probed on this machine, outside of the repository
+STATE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "ena-submission")
+PROFILE_PATH = os.path.join(STATE_DIR, "io_profiles.json")
+
+MiB = 1024 * 1024
+# Used until a mount is probed: (block size, files read at the same time)
+DEFAULT_SETTINGS = {
+    "rotational": {"block_size": 8 * MiB, "concurrency": 1},
+    "ssd": {"block_size": 8 * MiB, "concurrency": 4},
+    # NFS, Lustre, overlay...: no block device behind, latency bound
+    "network": {"block_size": 16 * MiB, "concurrency": 4}
+}
+# Pages already read are dropped from the page cache every DROP_BEHIND bytes
+DROP_BEHIND = 64 * MiB
+
+PROBE_BLOCK_SIZES = [1 * MiB, 4 * MiB, 16 * MiB]
+PROBE_CONCURRENCY = [1, 2, 4, 8]
+
+# st_dev -> settings, semaphore and mount point, filled on first use
+_devices = {}
+_lock = threading.Lock()
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="io_engine")
+
+    for path in args.paths:
+        if not os.path.exists(path):
+            print(f"[!] {path} does not exist")
+            sys.exit(1)
+
+        if args.probe:
+            probe(path, budget=args.budget, profile_path=args.io_profile)
+        else:
+            settings = get_settings(path, profile_path=args.io_profile)
+            print(f"[IO] {path}: mount {settings['mount']} ({settings['kind']}), "
+                  f"blocks of {settings['block_size'] // MiB} MiB, {settings['concurrency']} files at once"
+                  f"{', probed' if settings.get('mb_s') else ''}")
+
+
+def fadvise(fd: int, offset: int, length: int, advice: str) -> None:
+    # Advisory only: not available on every platform and file system
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, f"POSIX_FADV_{advice}"))
+        except OSError:
+            pass
+
+
+def drop_cache(file_path: str) -> None:
+    """
+    Asks the kernel to drop the cached pages of a file that will not be read
+    again, so hashing or uploading terabytes does not evict the working sets
+    of the other jobs of the node. Dirty pages are kept until written.
+    """
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        fadvise(fd, 0, 0, "DONTNEED")
+    finally:
+        os.close(fd)
+
+
+def read_blocks(file_path: str, block_size: int = None, buffers: int = 2, keep_cache: bool = False):
+    """
+    Reads a file sequentially into preallocated buffers (readinto, no new
+    bytes object per block) and yields memoryviews of them.
+    The kernel is told the access is sequential (larger read-ahead), and the
+    pages already read are dropped from the page cache as the read goes,
+    unless keep_cache (the file is read again soon, e.g. by lftp).
+    Args:
+        file_path (str): File to read.
+        block_size (int): Bytes per block (default: the setting of its device).
+        buffers (int): Buffers used in turn. A block stays valid until
+                       `buffers - 1` more blocks are read: a consumer holding
+                       blocks (queue to another thread) needs queue size + 2.
+        keep_cache (bool): Leave the pages in the page cache.
+    """
+    block_size = block_size or get_settings(file_path)["block_size"]
+    pool = [bytearray(block_size) for _ in range(buffers)]
+
+    with open(file_path, mode="rb", buffering=0) as handle:
+        fd = handle.fileno()
+        fadvise(fd, 0, 0, "SEQUENTIAL")
+
+        offset = 0
+        dropped = 0
+        index = 0
+        while True:
+            buffer = pool[index % buffers]
+            index += 1
+
+            size = handle.readinto(buffer)
+            if not size:
+                break
+            yield memoryview(buffer)[:size]
+            offset += size
+
+            # The previous blocks are consumed by now
+            if not keep_cache and offset - dropped >= DROP_BEHIND:
+                fadvise(fd, dropped, offset - dropped, "DONTNEED")
+                dropped = offset
+
+        if not keep_cache:
+            fadvise(fd, 0, 0, "DONTNEED")
+
+
+def device_kind(st_dev: int) -> str:
+    # Linux: /sys/dev/block/<major>:<minor> is the partition or the disk
+    sys_path = f"/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}"
+    for queue_dir in (os.path.join(sys_path, "queue"), os.path.join(sys_path, "..", "queue")):
+        try:
+            with open(os.path.join(queue_dir, "rotational")) as handle:
+                return "rotational" if handle.read().strip() == "1" else "ssd"
+        except OSError:
+            continue
+
+    return "network"
+
+
+def mount_point(path: str) -> str:
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+
+    return path
+
+
+def load_profiles(profile_path: str = None) -> dict:
+    try:
+        with open(profile_path or PROFILE_PATH, mode="r") as handle:
+            return json.load(handle)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def get_device(path: str, profile_path: str = None) -> dict:
+    """
+    Settings of the device holding path: the probed ones of its mount point
+    if any, otherwise the defaults of its kind (rotational, ssd, network).
+    The semaphore limits the files read at the same time on the device.
+    """
+    st_dev = os.stat(path).st_dev
+    with _lock:
+        if st_dev not in _devices:
+            mount = mount_point(path)
+            kind = device_kind(st_dev)
+            settings = dict(DEFAULT_SETTINGS[kind], mount=mount, kind=kind)
+            settings.update(load_profiles(profile_path).get(mount, {}))
+            _devices[st_dev] = {
+                "settings": settings,
+                "semaphore": threading.BoundedSemaphore(settings["concurrency"])
+            }
+
+    return _devices[st_dev]
+
+
+def get_settings(path: str, profile_path: str = None) -> dict:
+    return get_device(path, profile_path)["settings"]
+
+
+@contextlib.contextmanager
+def device_slot(path: str):
+    """
+    Waits for one of the read slots of the device holding path. Reading more
+    files at once than a spinning disk can serve makes it seek between them,
+    so each device has its own limit, whatever the number of workers.
+    """
+    semaphore = get_device(path)["semaphore"]
+    with semaphore:
+        yield
+
+
+def measure(files: list, block_size: int, concurrency: int, budget: int) -> float:
+    """
+    Reads budget bytes from the files with concurrency threads, each from its
+    own file or region, and returns the throughput in MB/s. The pages of the
+    files are dropped first so the device is measured, not the page cache.
+    """
+    for path in files:
+        drop_cache(path)
+
+    # (file, start, length) read by each thread
+    per_thread = budget // concurrency
+    tasks = []
+    for i in range(concurrency):
+        path = files[i % len(files)]
+        # Several threads on the same file read distant regions of it
+        sharing = len(range(i % len(files), concurrency, len(files)))
+        region = os.path.getsize(path) // sharing
+        tasks.append((path, (i // len(files)) * region, min(per_thread, region)))
+
+    read = []
+
+    def read_region(path: str, start: int, length: int) -> None:
+        buffer = bytearray(block_size)
+        done = 0
+        with open(path, mode="rb", buffering=0) as handle:
+            handle.seek(start)
+            while done < length:
+                size = handle.readinto(buffer)
+                if not size:
+                    break
+                done += size
+        read.append(done)
+
+    threads = [threading.Thread(target=read_region, args=task) for task in tasks]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed_time = time.perf_counter() - start_time
+
+    for path in files:
+        drop_cache(path)
+
+    return sum(read) / elapsed_time / 1e6 if elapsed_time else 0.0
+
+
+def probe(directory: str, budget: int = 256 * MiB, profile_path: str = None) -> dict:
+    """
+    Finds the block size and the number of files read at the same time giving
+    the best throughput on the mount holding directory, from its largest files:
+    block size first (one reader), then the concurrency with that block size.
+    The result is saved in the profile file, used by get_settings afterwards.
+    Returns:
+        dict: 'block_size', 'concurrency', 'mb_s' and 'probed' (epoch seconds).
+    """
+    files = []
+    for folder, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(folder, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append((os.path.getsize(path), path))
+    files = [path for size, path in sorted(files, reverse=True)[:max(PROBE_CONCURRENCY)] if size]
+    if not files:
+        raise FileNotFoundError(f"[!] No file to probe the read speed in {directory}")
+
+    mount = mount_point(directory)
+    print(f"[IO] Probing {mount} ({device_kind(os.stat(directory).st_dev)}) "
+          f"with {len(files)} files, {budget // MiB} MiB per trial")
+
+    best = {"block_size": PROBE_BLOCK_SIZES[0], "concurrency": 1, "mb_s": 0.0}
+    for block_size in PROBE_BLOCK_SIZES:
+        mb_s = measure(files, block_size, 1, budget)
+        print(f"[IO]   {block_size // MiB:>3} MiB blocks, 1 file   : {mb_s:8.1f} MB/s")
+        if mb_s > best["mb_s"]:
+            best = {"block_size": block_size, "concurrency": 1, "mb_s": mb_s}
+
+    for concurrency in PROBE_CONCURRENCY[1:]:
+        mb_s = measure(files, best["block_size"], concurrency, budget)
+        print(f"[IO]   {best['block_size'] // MiB:>3} MiB blocks, {concurrency} files : {mb_s:8.1f} MB/s")
+        # More readers only if clearly faster: on a hard drive they mostly seek
+        if mb_s > best["mb_s"] * 1.1:
+            best.update(concurrency=concurrency, mb_s=mb_s)
+
+    best["probed"] = time.time()
+
+    profile_path = profile_path or PROFILE_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(profile_path)), exist_ok=True)
+    profiles = load_profiles(profile_path)
+    profiles[mount] = best
+    tmp_path = f"{profile_path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode="w") as handle:
+        json.dump(profiles, handle, indent=2)
+    os.replace(tmp_path, profile_path)
+
+    # Settings already in use by this process follow the probe
+    with _lock:
+        _devices.pop(os.stat(directory).st_dev, None)
+
+    print(f"[IO][+] {mount}: blocks of {best['block_size'] // MiB} MiB, {best['concurrency']} files at once "
+          f"({best['mb_s']:.0f} MB/s), saved to {profile_path}")
+
+    return best
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Read settings of the storage (block size, files read at once)")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("paths",
+                        help="Folders (or files) whose mount settings are shown or probed.",
+                        nargs="+"
+                        )
+    parser.add_argument("--probe",
+                        action="store_true",
+                        help="Measure the read speed with several block sizes and readers, save the best settings."
+                        )
+    parser.add_argument("--budget",
+                        help="Bytes read per probe trial.",
+                        type=int,
+                        default=256 * MiB
+                        )
+    parser.add_argument("--io_profile",
+                        help="JSON file of the probed settings (default: ~/.cache/ena-submission/io_profiles.json).",
+                        type=str,
+                        default=PROFILE_PATH
+                        )
+    profiling.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import hashlib
+
+
+# Directory shared by the processes of a batch run, None keeps the cache in memory
+CACHE_DIR = None
+
+_memory = {}
+
+
+def set_cache_dir(cache_dir: str) -> None:
+    global CACHE_DIR
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    CACHE_DIR = cache_dir
+
+
+def get_cache_key(metadata_path: str, variant: str = "") -> str:
+    # variant: how the DataFrame was made (checks passed, values filled), an
+    # entry of one reader is never returned to another
+    stat = os.stat(metadata_path)
+    key = f"{os.path.realpath(metadata_path)}\t{stat.st_size}\t{stat.st_mtime_ns}\t{variant}"
+
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def get(metadata_path: str, variant: str = ""):
+    """
+    Returns the metadata DataFrame parsed by a previous load_metadata call
+    with the same variant, or None if the spreadsheet changed since (or was
+    never parsed that way).
+    """
+    key = get_cache_key(metadata_path, variant)
+
+    if key in _memory:
+        return _memory[key].copy()
+
+    if CACHE_DIR:
+        cache_path = os.path.join(CACHE_DIR, f"{key}.pkl")
+        if os.path.exists(cache_path):
+            with open(cache_path, mode="rb") as handle:
+                _memory[key] = pickle.load(handle)
+            return _memory[key].copy()
+
+    return None
+
+
+def put(metadata_path: str, metadata_df, variant: str = "") -> None:
+    key = get_cache_key(metadata_path, variant)
+    _memory[key] = metadata_df.copy()
+
+    if CACHE_DIR:
+        # Write then rename, other processes may be reading the same entry
+        cache_path = os.path.join(CACHE_DIR, f"{key}.pkl")
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="wb") as handle:
+            pickle.dump(metadata_df, handle)
+        os.replace(tmp_path, cache_path)
+
+
+def clear() -> None:
+    # Only the in-memory entries, the files in CACHE_DIR are kept
+    _memory.clear()
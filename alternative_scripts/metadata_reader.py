@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+
+import metadata_cache
+import profiling
+
+
+SHEET_NAME = "sample_submission"
+# Suffix -> format; LIMS exports come as CSV/TSV or Parquet
+FORMATS = {
+    ".xlsx": "excel",
+    ".xls": "excel",
+    ".csv": "csv",
+    ".tsv": "tsv",
+    ".txt": "tsv",
+    ".parquet": "parquet",
+    ".pq": "parquet"
+}
+# Template rows (units, descriptions) start with '#' in the sample_alias column
+COMMENT_PREFIX = "#"
+
+
+def metadata_format(metadata_path: str) -> str:
+    suffix = os.path.splitext(metadata_path)[1].lower()
+    if suffix not in FORMATS:
+        raise ValueError(f"[!] Metadata format not supported: {metadata_path} "
+                         f"(expected one of {', '.join(sorted(FORMATS))})")
+
+    return FORMATS[suffix]
+
+
+@profiling.profiled("read_metadata")
+def read_metadata(metadata_path: str) -> "pd.DataFrame":
+    """
+    Reads the samples of a metadata file: the sample_submission sheet of the
+    ENA spreadsheet, or a CSV/TSV/Parquet export with the same columns.
+    Every column is read as text, so the same samples give the same
+    DataFrame whatever the format: object columns of str, NaN when empty.
+    The rows of the index keep their position in the file.
+    Args:
+        metadata_path (str): .xlsx, .csv, .tsv or .parquet file.
+    Returns:
+        pd.DataFrame: One row per sample.
+    """
+    file_format = metadata_format(metadata_path)
+    if file_format == "excel":
+        metadata_df = read_excel(metadata_path)
+    elif file_format == "parquet":
+        metadata_df = read_parquet(metadata_path)
+    else:
+        metadata_df = read_delimited(metadata_path, delimiter="," if file_format == "csv" else "\t")
+
+    return filter_samples(as_text(metadata_df))
+
+
+def read_excel(metadata_path: str) -> "pd.DataFrame":
+    import pandas as pd
+
+    return pd.read_excel(metadata_path, sheet_name=SHEET_NAME, dtype=str)
+
+
+def read_delimited(metadata_path: str, delimiter: str) -> "pd.DataFrame":
+    """
+    pyarrow's multithreaded reader, with every column typed as a string (no
+    inference: tax_ids, depths and dates stay as written). Without pyarrow,
+    pandas' C reader with the same types.
+    """
+    try:
+        from pyarrow import csv as pa_csv
+        import pyarrow as pa
+    except ImportError:
+        import pandas as pd
+        return pd.read_csv(metadata_path, sep=delimiter, dtype=str, keep_default_na=False, na_values=[""])
+
+    # Names of the columns, to type all of them before the first block is read
+    with open(metadata_path, mode="r", encoding="utf-8-sig", newline="") as handle:
+        header = next(csv.reader(handle, delimiter=delimiter))
+
+    table = pa_csv.read_csv(
+        metadata_path,
+        parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in header},
+            strings_can_be_null=True,
+            null_values=[""]
+        )
+    )
+
+    return table.to_pandas()
+
+
+def read_parquet(metadata_path: str) -> "pd.DataFrame":
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(f"[!] Reading {metadata_path} needs pyarrow (pip install pyarrow)")
+
+    table = pq.read_table(metadata_path)
+    # Same text as a CSV export: numbers and dates cast by Arrow, not by Python row by row
+    table = table.cast(pa.schema([pa.field(name, pa.string()) for name in table.column_names]))
+
+    return table.to_pandas()
+
+
+def as_text(metadata_df: "pd.DataFrame") -> "pd.DataFrame":
+    import numpy as np
+
+    metadata_df = metadata_df.astype(object)
+    return metadata_df.where(metadata_df.notna(), np.nan)
+
+
+def filter_samples(metadata_df: "pd.DataFrame") -> "pd.DataFrame":
+    # The units row under the header of the ENA spreadsheet ('#units'), kept
+    # by some exports, and the empty rows at the end of the sheet
+    aliases = metadata_df["sample_alias"].astype(str).str.strip()
+    keep = metadata_df["sample_alias"].notna() & (aliases != "") & ~aliases.str.startswith(COMMENT_PREFIX)
+
+    return metadata_df[keep].copy()
+
+
+def format_dates(dates: "pd.Series") -> "pd.Series":
+    """
+    Removes the time from the collection dates. ISO dates (the text of
+    Excel dates, Arrow casts and most exports) are cut at 10 characters;
+    only the other ones are parsed.
+    """
+    import pandas as pd
+
+    text = dates.astype(str).str.strip()
+    iso = dates.notna() & text.str.match(r"\d{4}-\d{2}-\d{2}(?:$|[ T])")
+    formatted = text.str.slice(0, 10).where(iso, dates)
+
+    others = dates.notna() & ~iso
+    if others.any():
+        formatted[others] = pd.to_datetime(text[others]).dt.strftime("%Y-%m-%d")
+
+    return formatted.astype(object)
+
+
+@profiling.profiled("load_metadata")
+def load_metadata(metadata_path: str) -> "pd.DataFrame":
+    """
+    Samples of the metadata file with the dates normalized, reused while
+    the file does not change (s02). Not checked: s01 caches its checked
+    samples under a key of its own.
+    """
+    metadata_df = metadata_cache.get(metadata_path)
+    if metadata_df is not None:
+        return metadata_df
+
+    metadata_df = read_metadata(metadata_path)
+    metadata_df["collection date"] = format_dates(metadata_df["collection date"])
+
+    metadata_cache.put(metadata_path, metadata_df)
+
+    return metadata_df
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import zlib
+import queue
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import events
+import profiling
+
+
+BLOCK_SIZE = 8 * 1024 * 1024
+# Bytes of the read ID compared between R1 and R2 (Illumina IDs are shorter)
+ID_WIDTH = 96
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="paired_check")
+    events.start(args, command="paired_check")
+
+    pairs = list_campaign_pairs(args)
+    if not pairs:
+        print("[!] No read pairs found")
+        sys.exit(1)
+
+    results = check_pairs(pairs, workers=args.workers)
+    print_results(results)
+
+    if args.report:
+        save_results(results, args.report)
+        print(f"[PAIRS][+] Report saved to: {args.report}")
+
+    if any(result["problem"] for result in results):
+        sys.exit(1)
+
+
+def list_read_pairs(
+    experiment_type: str,
+    samples_dir: str = None,
+    forward_pattern: str = None,
+    WGS_samples_dir: str = None,
+    AMP_samples_dir: str = None,
+    mapping_WGS: str = None,
+    mapping_AMP: str = None
+) -> list:
+    """
+    Lists the read pairs of an experiment as s04 (mapping tables) or s03
+    (glob of the nested samples directory) find them.
+    Returns:
+        list: (sample_alias, forward path, reverse path, experiment_type) tuples.
+    """
+    mapping_path = mapping_WGS if experiment_type == "WGS" else mapping_AMP
+    if mapping_path:
+        exp_dir = os.path.abspath(WGS_samples_dir if experiment_type == "WGS" else AMP_samples_dir)
+        with open(mapping_path, mode="r", newline="") as handle:
+            return [
+                (
+                    row["sample_alias"],
+                    os.path.join(exp_dir, row["forward"]),
+                    os.path.join(exp_dir, row["reverse"]),
+                    experiment_type
+                )
+                for row in csv.DictReader(handle, delimiter="\t")
+            ]
+
+    if samples_dir:
+        # Imported here: only the nested layout needs s03
+        from s03_create_run_xml import find_read_pairs
+
+        return [
+            # WARNING: sample alias is assumed to be the first three fields, as in s03
+            ("_".join(os.path.basename(forward).split("_")[:3]), forward, reverse, experiment_type)
+            for forward, reverse in find_read_pairs(samples_dir, experiment_type, forward_pattern)
+        ]
+
+    return []
+
+
+def list_campaign_pairs(args) -> list:
+    """
+    Read pairs of all the experiments, from the options of add_pair_arguments
+    (an argparse.Namespace or the pipeline configuration).
+    """
+    options = args if isinstance(args, dict) else vars(args)
+
+    pairs = []
+    for experiment_type in options["experiment_types"]:
+        pairs += list_read_pairs(
+            experiment_type=experiment_type,
+            samples_dir=options["samples_dir"],
+            forward_pattern=options["forward_pattern_wgs"] if experiment_type == "WGS"
+                else options["forward_pattern_16s"],
+            WGS_samples_dir=options["WGS_samples_dir"],
+            AMP_samples_dir=options["AMP_samples_dir"],
+            mapping_WGS=options["mapping_WGS"],
+            mapping_AMP=options["mapping_AMP"]
+        )
+
+    return pairs
+
+
+def read_blocks(file_path: str, block_size: int = BLOCK_SIZE, limit: int = None):
+    # Decompressed content of a (gzipped, possibly multi-member) file, at most limit bytes
+    remaining = limit
+    with open(file_path, mode="rb") as handle:
+        if not file_path.endswith(".gz"):
+            while remaining is None or remaining > 0:
+                block = handle.read(block_size if remaining is None else min(block_size, remaining))
+                if not block:
+                    return
+                if remaining is not None:
+                    remaining -= len(block)
+                yield block
+            return
+
+        # Concatenated (bgzip/pigz) members are decompressed one after the other
+        decompressor = zlib.decompressobj(wbits=31)
+        in_member = False
+        for block in iter(lambda: handle.read(block_size), b""):
+            while block:
+                # No more than the limit is decompressed, the rest waits in unconsumed_tail
+                data = decompressor.decompress(block, remaining or 0)
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+                if remaining == 0:
+                    return
+                block = decompressor.unconsumed_tail
+                if block:
+                    continue
+                in_member = not decompressor.eof
+                if in_member:
+                    break
+                block = decompressor.unused_data.lstrip(b"\0")
+                decompressor = zlib.decompressobj(wbits=31)
+
+        if in_member:
+            raise zlib.error("truncated gzip member")
+
+
+def parse_records(data: "np.ndarray") -> tuple:
+    """
+    Parses the complete records at the start of a buffer with NumPy: the
+    newlines are located once, then every record field is a strided view of
+    the line boundaries, so no Python code runs per read.
+    Returns:
+        tuple: (ids, id_lengths, bases, end, problem) where ids is a
+               (reads x ID_WIDTH) byte matrix of the read IDs, bases the
+               number of bases, end the offset after the last complete record.
+    """
+    import numpy as np
+
+    newlines = np.flatnonzero(data == 10)
+    n_records = len(newlines) // 4
+    newlines = newlines[:n_records * 4]
+    if n_records == 0:
+        return np.zeros((0, ID_WIDTH), dtype=np.uint8), np.zeros(0, dtype=np.int64), 0, 0, None
+
+    starts = np.empty_like(newlines)
+    starts[0] = 0
+    starts[1:] = newlines[:-1] + 1
+    lengths = newlines - starts
+
+    header_starts = starts[0::4]
+    problem = None
+    if not (data[header_starts] == ord("@")).all():
+        record = int(np.flatnonzero(data[header_starts] != ord("@"))[0])
+        problem = f"record {record + 1} of the block: header does not start with '@'"
+    elif not (data[starts[2::4]] == ord("+")).all():
+        record = int(np.flatnonzero(data[starts[2::4]] != ord("+"))[0])
+        problem = f"record {record + 1} of the block: third line does not start with '+'"
+    elif not (lengths[1::4] == lengths[3::4]).all():
+        record = int(np.flatnonzero(lengths[1::4] != lengths[3::4])[0])
+        problem = f"record {record + 1} of the block: sequence and quality lengths differ"
+
+    # Read ID: after '@', up to the first space or '/' (/1 and /2 differ between R1 and R2).
+    # Only a fixed width window of each header is looked at, not the whole buffer
+    offsets = np.arange(ID_WIDTH)
+    if header_starts[-1] + 1 + ID_WIDTH > len(data):
+        data = np.concatenate([data, np.zeros(ID_WIDTH, dtype=np.uint8)])
+    window = np.lib.stride_tricks.sliding_window_view(data, ID_WIDTH)[header_starts + 1]
+    separator = (window == 32) | (window == 47) | (offsets >= lengths[0::4, None] - 1)
+    id_lengths = np.where(separator.any(axis=1), separator.argmax(axis=1), ID_WIDTH)
+
+    # Fixed width matrix of the ID bytes, padded with zeros
+    window[offsets >= id_lengths[:, None]] = 0
+    ids = window
+
+    bases = int(lengths[1::4].sum())
+
+    return ids, id_lengths, bases, int(newlines[-1]) + 1, problem
+
+
+def parse_file(file_path: str, output: queue.Queue) -> None:
+    """
+    Decompresses and parses a file, putting ('records', ids, id_lengths, bases)
+    items in output, then ('end', problem). Runs in its own thread: zlib and
+    most of the NumPy operations release the GIL, so R1 and R2 are parsed in
+    parallel.
+    """
+    import numpy as np
+
+    carry = b""
+    problem = None
+    try:
+        for block in read_blocks(file_path):
+            data = np.frombuffer(carry + block, dtype=np.uint8)
+            ids, id_lengths, bases, end, problem = parse_records(data)
+            if problem:
+                break
+            output.put(("records", ids, id_lengths, bases))
+            carry = data[end:].tobytes()
+
+        if not problem and carry:
+            # Last record without a final newline
+            ids, id_lengths, bases, end, problem = parse_records(
+                np.frombuffer(carry + b"\n", dtype=np.uint8)
+            )
+            if end == 0:
+                problem = "truncated record at the end of the file"
+            else:
+                output.put(("records", ids, id_lengths, bases))
+
+    except (OSError, zlib.error) as e:
+        problem = f"cannot read: {e}"
+
+    output.put(("end", problem))
+
+
+@profiling.profiled("check_pair")
+def check_pair(sample_alias: str, forward: str, reverse: str, experiment_type: str = None) -> dict:
+    """
+    Checks that the forward and reverse files of a sample have the same
+    number of reads, with the same IDs in the same order.
+    Returns:
+        dict: sample_alias, experiment_type, forward, reverse, reads/bases of
+              each file, the first mismatching read and the problem (None if OK).
+    """
+    import numpy as np
+
+    result = {
+        "sample_alias": sample_alias,
+        "experiment_type": experiment_type,
+        "forward": forward,
+        "reverse": reverse,
+        "forward_reads": 0,
+        "reverse_reads": 0,
+        "forward_bases": 0,
+        "reverse_bases": 0,
+        "first_mismatch": None,
+        "problem": None
+    }
+
+    for path in (forward, reverse):
+        if not os.path.exists(path):
+            result["problem"] = f"file not found: {path}"
+            return result
+
+    outputs = {"forward": queue.Queue(maxsize=4), "reverse": queue.Queue(maxsize=4)}
+    threads = [
+        threading.Thread(target=parse_file, args=(path, outputs[side]), daemon=True)
+        for side, path in (("forward", forward), ("reverse", reverse))
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Parsed reads not compared yet, per side
+    pending = {"forward": [], "reverse": []}
+    finished = {}
+    compared = 0
+
+    while len(finished) < 2:
+        for side in ("forward", "reverse"):
+            if side in finished:
+                continue
+            # Read from the side that is behind, the other one waits in its queue
+            if pending[side] and not pending[other(side)] and other(side) not in finished:
+                continue
+
+            item = outputs[side].get()
+            if item[0] == "end":
+                finished[side] = item[1]
+                continue
+
+            _, ids, id_lengths, bases = item
+            result[f"{side}_reads"] += len(ids)
+            result[f"{side}_bases"] += bases
+            pending[side].append((ids, id_lengths))
+
+        # Compare the reads both sides have parsed so far
+        forward_ids, forward_lengths = concatenate(pending["forward"])
+        reverse_ids, reverse_lengths = concatenate(pending["reverse"])
+        n = min(len(forward_ids), len(reverse_ids))
+        if n and result["first_mismatch"] is None:
+            mismatch = (forward_lengths[:n] != reverse_lengths[:n]) \
+                | (forward_ids[:n] != reverse_ids[:n]).any(axis=1)
+            if mismatch.any():
+                result["first_mismatch"] = compared + int(np.flatnonzero(mismatch)[0]) + 1
+        compared += n
+        pending["forward"] = [(forward_ids[n:], forward_lengths[n:])]
+        pending["reverse"] = [(reverse_ids[n:], reverse_lengths[n:])]
+
+    for thread in threads:
+        thread.join()
+
+    if finished["forward"] or finished["reverse"]:
+        result["problem"] = "; ".join(
+            f"{side}: {problem}" for side, problem in finished.items() if problem
+        )
+    elif result["forward_reads"] != result["reverse_reads"]:
+        result["problem"] = f"{result['forward_reads']} forward reads but {result['reverse_reads']} reverse reads"
+    elif result["first_mismatch"] is not None:
+        result["problem"] = f"read IDs differ from read {result['first_mismatch']}"
+
+    events.emit("pair_checked", sample_alias=sample_alias, forward=forward, reverse=reverse,
+                reads=result["forward_reads"], ok=result["problem"] is None, problem=result["problem"])
+
+    return result
+
+
+def other(side: str) -> str:
+    return "reverse" if side == "forward" else "forward"
+
+
+def concatenate(parts: list) -> tuple:
+    import numpy as np
+
+    if not parts:
+        return np.zeros((0, ID_WIDTH), dtype=np.uint8), np.zeros(0, dtype=np.int64)
+    if len(parts) == 1:
+        return parts[0]
+
+    return np.concatenate([ids for ids, _ in parts]), np.concatenate([lengths for _, lengths in parts])
+
+
+def check_pairs(pairs: list, workers: int = 2) -> list:
+    """
+    Checks the read pairs, several samples at a time (each one uses two threads).
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda pair: check_pair(*pair), pairs))
+
+
+def print_results(results: list) -> None:
+    for result in results:
+        status = f"[!] {result['problem']}" if result["problem"] else "OK"
+        print(f"[PAIRS] {result['sample_alias']:<24} {result['forward_reads']:>12} reads "
+              f"{result['forward_bases'] + result['reverse_bases']:>15} bases  {status}")
+
+    failed = [result for result in results if result["problem"]]
+    print(f"[PAIRS] {len(results) - len(failed)}/{len(results)} pairs consistent")
+
+
+def save_results(results: list, report_path: str) -> None:
+    with open(report_path, mode="w", newline="") as handle:
+        writer = csv.DictWriter(handle, fieldnames=list(results[0]), delimiter="\t")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Checking the paired-end read files")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    add_pair_arguments(parser)
+    parser.add_argument("-j", "--workers",
+                        help="Samples checked at the same time (two threads each).",
+                        type=int,
+                        default=2
+                        )
+    parser.add_argument("-r", "--report",
+                        help="TSV file where the reads and bases of every sample are saved.",
+                        type=str
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+def add_pair_arguments(parser: argparse.ArgumentParser) -> None:
+    # Where the pairs are listed from, shared with quick_check
+    parser.add_argument("-e", "--experiment_types",
+                        help="String defining either 16S, WGS or both.",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=["16S", "WGS"]
+                        )
+    parser.add_argument("-s", "--samples_dir",
+                        help="Directory containing the 16_S and Metagenomes folders (nested layout).",
+                        type=str
+                        )
+    parser.add_argument("-w", "--WGS_samples_dir",
+                        help="Directory containing the WGS sequences listed in the mapping table.",
+                        type=str
+                        )
+    parser.add_argument("-a", "--AMP_samples_dir",
+                        help="Directory containing the 16S sequences listed in the mapping table.",
+                        type=str
+                        )
+    parser.add_argument("-m", "--mapping_WGS",
+                        help="Table containing rawreads filename (forward and reverse) and sample_alias for WGS",
+                        type=str
+                        )
+    parser.add_argument("-k", "--mapping_AMP",
+                        help="Table containing rawreads filename (forward and reverse) and sample_alias for AMPLICON",
+                        type=str
+                        )
+    parser.add_argument("-f", "--forward_pattern_16s",
+                        help="Pattern followed in naming the forward sequence files (16S).",
+                        type=str,
+                        default="*1.fastq.gz"
+                        )
+    parser.add_argument("-g", "--forward_pattern_wgs",
+                        help="Pattern followed in naming the forward sequence files (WGS).",
+                        type=str,
+                        default="*1.fq.gz"
+                        )
+
+
+if __name__ == "__main__":
+    main()
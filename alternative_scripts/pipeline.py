@@ -0,0 +1,883 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import fcntl
+import hashlib
+import argparse
+import contextlib
+
+import s01_create_samples_xml as s01
+import s02_create_experiment_xml as s02
+import s03_create_run_xml as s03
+import s03_create_run_xml_singleReadsFolder as s03_mapping
+import s04_upload_files as s04
+import s05_register_object as s05
+import metadata_cache
+import events
+import profiling
+import xsd_validation
+import checklist_validation
+import quick_check
+import submissions
+from paired_check import list_campaign_pairs
+from checksum_store import default_store_path, record_throughput, UPLOAD_TARGET
+from hash_upload import hash_and_upload
+from compress import compress_upload_files, is_compressed
+from dedup import DedupIndex, skip_registered
+from bandwidth import scheduled_upload
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="pipeline")
+    events.start(args, command="pipeline")
+
+    config = build_config(args)
+
+    status = run_pipeline(
+        config=config,
+        selected_stages=args.stages,
+        force=args.force
+    )
+
+    print_status(status)
+    events.emit("pipeline_finished", status=status)
+
+    if any(value == "failed" for value in status.values()):
+        sys.exit(1)
+
+
+def build_config(args: argparse.Namespace) -> dict:
+    registrationType = None if args.registration_type == "null" else args.registration_type
+
+    config = vars(args)
+    config["registration_type"] = registrationType
+    config["forward_pattern_dict"] = {
+        "16S": args.forward_pattern_16s,
+        "WGS": args.forward_pattern_wgs
+    }
+    if not config["checksum_store"]:
+        config["checksum_store"] = default_store_path(os.path.dirname(args.metadata_path))
+    # Mapping tables name the files relative to these directories, with or without a trailing /
+    for key in ("WGS_samples_dir", "AMP_samples_dir"):
+        if config[key]:
+            config[key] = os.path.abspath(config[key])
+
+    if config["cache_dir"]:
+        metadata_cache.set_cache_dir(config["cache_dir"])
+
+    return config
+
+
+def run_pipeline(config: dict, selected_stages: list = None, force: bool = False) -> dict:
+    """
+    Runs the s01 -> s05 stages in dependency order, skipping the up-to-date ones.
+    A stage is up to date when the fingerprint of its inputs and parameters
+    matches the one recorded by the previous run and all of its outputs exist.
+    Args:
+        config (dict): Merged command line options of the s01-s05 scripts.
+        selected_stages (list): Names of the stages to consider (None for all).
+        force (bool): Re-run the generation stages even if up to date.
+    Returns:
+        dict: stage name -> one of 'up-to-date', 'done', 'dry-run',
+              'disabled', 'skipped', 'not selected', 'blocked', 'failed'.
+    """
+    state_path = get_state_path(config["metadata_path"])
+
+    # Two runs on the same campaign would overwrite each other's XML files
+    with campaign_lock(f"{os.path.splitext(state_path)[0]}.lock"):
+        state = load_state(state_path)
+        status = run_stages(config, state, state_path, selected_stages, force)
+
+    return status
+
+
+def run_stages(
+    config: dict,
+    state: dict,
+    state_path: str,
+    selected_stages: list,
+    force: bool
+) -> dict:
+
+    status = {}
+    stages = build_stages(config)
+    for stage in stages:
+        name = stage["name"]
+
+        if selected_stages and name not in selected_stages:
+            # Left out stages still block the others until their outputs exist
+            outputs_exist = all(os.path.exists(path) for path in stage["outputs"])
+            status[name] = "not selected" if outputs_exist else "blocked"
+            continue
+
+        if not stage["enabled"]:
+            print(f"[INFO] Stage {name} disabled")
+            status[name] = "disabled"
+            continue
+
+        blocking = [
+            dep for dep in stage["deps"]
+            if status.get(dep) in ("blocked", "dry-run", "failed")
+        ]
+        if blocking:
+            print(f"[INFO] Stage {name} waiting for: {', '.join(blocking)}")
+            status[name] = "blocked"
+            continue
+
+        # Never recorded, even as up to date: the files were not validated
+        if stage["schemas"] and not xsd_validation.schemas_available(config["schema_dir"]):
+            print(f"[WARNING] Stage {name}: ENA schemas not found in {config['schema_dir']}, XML files not "
+                  f"validated. Download them with: python ena.py validate --download")
+            status[name] = "skipped"
+            continue
+
+        fingerprint = stage_fingerprint(stage)
+        previous = state.get(name, {})
+        outputs_exist = all(os.path.exists(path) for path in stage["outputs"])
+
+        if stage["kind"] == "register" and outputs_exist:
+            status[name] = check_receipt(stage, fingerprint, previous)
+            if status[name] == "up-to-date":
+                state[name] = {
+                    "fingerprint": previous.get("fingerprint", fingerprint),
+                    "outputs": stage["outputs"]
+                }
+                save_state(state_path, state)
+                continue
+            if status[name] == "failed":
+                continue
+
+        elif not force and outputs_exist \
+                and previous.get("fingerprint") == fingerprint:
+            print(f"[PIPELINE][=] {name} is up to date")
+            status[name] = "up-to-date"
+            continue
+
+        if stage["kind"] == "register" and not config["registration_type"]:
+            print(f"[INFO] Stage {name}: dry-run mode, nothing is sent to ENA")
+            status[name] = "dry-run"
+            continue
+
+        # Stale outputs would make the stage functions refuse to overwrite
+        if stage["kind"] == "generate":
+            for path in stage["outputs"]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        print(f"[PIPELINE][+] Running {name}")
+        events.emit("stage_started", stage=name)
+        start_time = time.perf_counter()
+        with profiling.stage(name):
+            completed = stage["run"]()
+
+        if completed is False:
+            # A failed validation is a failure in dry-run mode as well
+            dry_run = not config["registration_type"] and stage["kind"] != "validate"
+            status[name] = "dry-run" if dry_run else "failed"
+            events.emit("stage_finished", stage=name, status=status[name],
+                        duration_s=time.perf_counter() - start_time)
+            continue
+
+        # Fingerprint again since some stages write their own inputs (MD5.txt)
+        state[name] = {
+            "fingerprint": stage_fingerprint(stage),
+            "outputs": stage["outputs"]
+        }
+        save_state(state_path, state)
+        status[name] = "done"
+        events.emit("stage_finished", stage=name, status=status[name],
+                    duration_s=time.perf_counter() - start_time)
+
+    return status
+
+
+def check_receipt(stage: dict, fingerprint: str, previous: dict) -> str:
+    # ENA refuses to register the same aliases twice: an existing successful
+    # receipt is final, while a failed one is retried once the inputs change
+    receipt_path = stage["outputs"][0]
+    message = s01.receipt_output_handling(receipt_path)
+
+    if message["success"]:
+        if previous.get("fingerprint", fingerprint) != fingerprint:
+            print(f"[WARNING] Inputs of {stage['name']} changed after the registration. "
+                  f"Move away {receipt_path} and use MODIFY mode (-s 2) to update ENA.")
+        print(f"[PIPELINE][=] {stage['name']} already registered: {receipt_path}")
+        return "up-to-date"
+
+    if previous.get("fingerprint") == fingerprint:
+        print('\n'.join(f'[!] {k} --> {v}' for k, v in message.items()))
+        print(f"[!] {stage['name']} failed with the same inputs, fix them and run again.")
+        return "failed"
+
+    print(f"[INFO] Removing failed receipt {receipt_path}")
+    os.remove(receipt_path)
+    return "stale"
+
+
+def build_stages(config: dict) -> list:
+    metadata_path = config["metadata_path"]
+    template_dir = config["template_dir"]
+    experiment_types = config["experiment_types"]
+
+    # WARNING: project name is assumed to be in the first field of the path
+    project_name = os.path.basename(metadata_path).split("_")[0]
+    metadata_dir = os.path.dirname(metadata_path)
+
+    def output(suffix: str) -> str:
+        return os.path.join(metadata_dir, f"{project_name}_{suffix}")
+
+    samples_path = output("ena_samples.xml")
+    # The TEST receipts do not stand for the permanent ones (ena.py promote)
+    partition = submissions.get_partition(config["registration_type"])
+    samples_receipt_path = submissions.artifact_path(metadata_dir, project_name, "ena_samples_receipt.xml", partition)
+    experiment_path = output("ena_experiment.xml")
+    run_path = output("ena_run.xml")
+    object_receipt_path = submissions.artifact_path(metadata_dir, project_name, "ena_object_receipt.xml", partition)
+
+    submission_file = "submission_ADD.xml" if config["submission_type"] == 1 \
+        else "submission_MOD.xml"
+    submission_path = os.path.join(template_dir, submission_file)
+
+    checklist = None if config["checklist"] == "none" else config["checklist"]
+
+    mapping_mode = bool(config["mapping_WGS"] or config["mapping_AMP"])
+    registration = {
+        "submission_type": config["submission_type"],
+        "registration_type": config["registration_type"]
+    }
+
+    stages = [
+        {
+            "name": "samples_xml",
+            "kind": "generate",
+            "deps": [],
+            "inputs": lambda: [metadata_path, os.path.join(template_dir, "samples.xml")]
+                + ([checklist_validation.get_checklist_path(checklist)] if checklist else [])
+                + ([config["taxonomy_index"]] if config["taxonomy_index"] else []),
+            "inventory": lambda: [],
+            "params": {"checklist": checklist, "fill_taxonomy": config["fill_taxonomy"]},
+            "outputs": [samples_path],
+            "run": lambda: s01.create_samples_file(
+                metadata_path=metadata_path,
+                template_dir=template_dir,
+                checklist=checklist,
+                taxonomy_index=config["taxonomy_index"],
+                fill_taxonomy=config["fill_taxonomy"]
+            )
+        },
+        {
+            "name": "samples_valid",
+            "kind": "validate",
+            "enabled": not config["no_validation"],
+            "schemas": True,
+            "deps": ["samples_xml"],
+            "inputs": lambda: [samples_path] + get_schema_files(config),
+            "inventory": lambda: [],
+            "params": {},
+            "outputs": [],
+            "run": lambda: xsd_validation.validate_files([samples_path], config["schema_dir"])
+        },
+        {
+            "name": "samples_receipt",
+            "kind": "register",
+            "deps": ["samples_xml", "samples_valid"],
+            "inputs": lambda: [samples_path, submission_path],
+            "inventory": lambda: [],
+            "params": registration,
+            "outputs": [samples_receipt_path],
+            "run": lambda: s01.register_samples(
+                samples_xml_path=samples_path,
+                template_dir=template_dir,
+                user_password=config["user_password"],
+                submission_type=config["submission_type"],
+                registration_type=config["registration_type"]
+            )
+        },
+        {
+            "name": "experiment_xml",
+            "kind": "generate",
+            "deps": ["samples_receipt"],
+            "inputs": lambda: [samples_receipt_path, metadata_path] + [
+                os.path.join(template_dir, f"experiment_{experiment_type}.xml")
+                for experiment_type in experiment_types
+            ],
+            "inventory": lambda: [],
+            "params": {
+                "experiment_types": experiment_types,
+                "check": config["check"],
+                "samples_dir": config["samples_dir"],
+                "forward_pattern_dict": config["forward_pattern_dict"]
+            },
+            "outputs": [experiment_path],
+            "run": lambda: s02.create_experiment(
+                samples_receipt_path=samples_receipt_path,
+                metadata_path=metadata_path,
+                samples_dir=config["samples_dir"],
+                template_dir=template_dir,
+                forward_pattern_dict=config["forward_pattern_dict"],
+                experiment_types=experiment_types,
+                check=config["check"]
+            )
+        },
+        {
+            "name": "reads_quick",
+            "kind": "validate",
+            "enabled": not config["no_quick_check"],
+            "deps": [],
+            "inputs": lambda: get_mapping_tables(config),
+            "inventory": lambda: get_inventory(config),
+            "params": {"experiment_types": experiment_types},
+            "outputs": [],
+            "run": lambda: quick_check.quick_check(list_campaign_pairs(config))
+        },
+        {
+            "name": "compress",
+            "kind": "upload",
+            "enabled": not config["no_upload"],
+            "deps": ["reads_quick"],
+            "inputs": lambda: [],
+            "inventory": lambda: get_inventory(config),
+            "params": {},
+            "outputs": [],
+            "run": lambda: compress_upload(config)
+        },
+        {
+            "name": "upload",
+            "kind": "upload",
+            "enabled": not config["no_upload"],
+            "deps": ["reads_quick"],
+            "inputs": lambda: [],
+            "inventory": lambda: get_inventory(config),
+            "params": {},
+            "outputs": [],
+            "run": lambda: upload(config)
+        },
+        {
+            "name": "run_xml",
+            "kind": "generate",
+            "deps": ["reads_quick"],
+            "inputs": lambda: [os.path.join(template_dir, "run.xml")]
+                + get_mapping_tables(config)
+                + get_checksum_files(config),
+            "inventory": lambda: get_inventory(config),
+            "params": {
+                "metadata_path": metadata_path,
+                "experiment_types": experiment_types,
+                "forward_pattern_dict": config["forward_pattern_dict"],
+                "verify_fastq": config["verify_fastq"]
+            },
+            "outputs": [run_path],
+            "run": (lambda: s03_mapping.create_run(
+                metadata_path=metadata_path,
+                template_dir=template_dir,
+                experiment_types=experiment_types,
+                WGS_samples_dir=config["WGS_samples_dir"],
+                AMP_samples_dir=config["AMP_samples_dir"],
+                mapping_WGS=config["mapping_WGS"],
+                mapping_AMP=config["mapping_AMP"],
+                checksum_store=config["checksum_store"],
+                verify_fastq=config["verify_fastq"],
+                hash_queue=config["hash_queue"],
+                local_workers=config["local_workers"],
+                dedup_index=config["dedup_index"],
+                allow_duplicates=config["allow_duplicates"]
+            )) if mapping_mode else (lambda: s03.create_run(
+                metadata_path=metadata_path,
+                samples_dir=config["samples_dir"],
+                template_dir=template_dir,
+                forward_pattern_dict=config["forward_pattern_dict"],
+                experiment_types=experiment_types,
+                checksum_store=config["checksum_store"],
+                verify_fastq=config["verify_fastq"],
+                hash_queue=config["hash_queue"],
+                local_workers=config["local_workers"],
+                dedup_index=config["dedup_index"],
+                allow_duplicates=config["allow_duplicates"]
+            ))
+        },
+        {
+            "name": "objects_valid",
+            "kind": "validate",
+            "enabled": not config["no_validation"],
+            "schemas": True,
+            "deps": ["experiment_xml", "run_xml"],
+            "inputs": lambda: [experiment_path, run_path] + get_schema_files(config),
+            "inventory": lambda: [],
+            "params": {},
+            "outputs": [],
+            "run": lambda: xsd_validation.validate_files([experiment_path, run_path], config["schema_dir"])
+        },
+        {
+            "name": "object_receipt",
+            "kind": "register",
+            "deps": ["experiment_xml", "run_xml", "objects_valid", "compress", "upload"],
+            "inputs": lambda: [experiment_path, run_path, submission_path],
+            "inventory": lambda: [],
+            "params": registration,
+            "outputs": [object_receipt_path],
+            "run": lambda: s05.register_objects(
+                metadata_path=metadata_path,
+                template_dir=template_dir,
+                user_password=config["user_password"],
+                submission_type=config["submission_type"],
+                registration_type=config["registration_type"]
+            )
+        },
+        {
+            "name": "details",
+            "kind": "generate",
+            "deps": ["object_receipt"],
+            "inputs": lambda: [
+                samples_receipt_path, object_receipt_path,
+                experiment_path, run_path, samples_path
+            ],
+            "inventory": lambda: [],
+            "params": {"experiment_types": experiment_types},
+            "outputs": [
+                submissions.artifact_path(metadata_dir, project_name, f"details_{experiment_type}.csv", partition)
+                for experiment_type in experiment_types
+            ],
+            "run": lambda: save_details(config)
+        }
+    ]
+
+    for stage in stages:
+        stage.setdefault("enabled", True)
+        stage.setdefault("schemas", False)
+
+    return stages
+
+
+def compress_upload(config: dict) -> bool:
+    # Uncompressed FASTQ files, gzipped while they are sent: the MD5 of the
+    # stream lands in the store for run_xml
+    username = config["user_password"].split(":")[0] \
+        if config["user_password"] else None
+    dry_run = not config["registration_type"]
+
+    uploaded = compress_upload_files(
+        file_list=[path for path in get_upload_files(config) if not is_compressed(path)],
+        username=username,
+        checksum_store=config["checksum_store"],
+        dry_run=dry_run
+    )
+
+    return not dry_run and uploaded
+
+
+def upload(config: dict) -> bool:
+    username = config["user_password"].split(":")[0] \
+        if config["user_password"] else None
+    dry_run = not config["registration_type"]
+
+    # The uncompressed files are sent by the compress stage
+    file_list = [path for path in get_upload_files(config) if is_compressed(path)]
+    if not file_list:
+        return not dry_run
+    # 16S and WGS files in one plan, largest first
+    file_list = s04.plan_uploads(file_list)
+
+    if not config["overlap"]:
+        total_bytes = sum(os.path.getsize(path) for path in file_list)
+        start_time = time.perf_counter()
+        if config["rate_cap"] or config["rate_schedule"] or config["adaptive"]:
+            uploaded = scheduled_upload(
+                file_list=file_list,
+                username=username,
+                rate_cap=config["rate_cap"],
+                rate_schedule=config["rate_schedule"],
+                max_workers=config["upload_workers"],
+                adaptive=config["adaptive"],
+                dry_run=dry_run
+            )
+        else:
+            uploaded = s04.upload_files(
+                file_list=file_list,
+                username=username,
+                interactive=False,
+                dry_run=dry_run,
+                parallel=config["upload_workers"]
+            )
+
+        # Speed of the uplink, for 'ena.py plan'
+        if uploaded and not dry_run:
+            record_throughput(config["checksum_store"], "upload", UPLOAD_TARGET, total_bytes,
+                              time.perf_counter() - start_time, config["upload_workers"])
+        return not dry_run and uploaded
+
+    # The checksums land in the store, run_xml then only reads them back
+    results = hash_and_upload(
+        file_list=file_list,
+        username=username,
+        checksum_store=config["checksum_store"],
+        hash_workers=config["hash_workers"],
+        upload_workers=config["upload_workers"],
+        dry_run=dry_run
+    )
+
+    return not dry_run and not results["failed"]
+
+
+def get_upload_files(config: dict) -> list:
+    if not config["dedup_index"]:
+        return get_inventory(config)
+
+    # Content already registered by another campaign is not sent again
+    return skip_registered(
+        get_inventory(config),
+        index_path=config["dedup_index"],
+        checksum_store=config["checksum_store"],
+        campaign=os.path.dirname(os.path.abspath(config["metadata_path"])),
+        allow_duplicates=config["allow_duplicates"]
+    )
+
+
+def save_details(config: dict) -> list:
+    partition = submissions.get_partition(config["registration_type"])
+    details_paths = []
+    for experiment_type in config["experiment_types"]:
+        receipt_df = s05.parse_objects_receipts(
+            metadata_path=config["metadata_path"],
+            template_dir=config["template_dir"],
+            experiment_type=experiment_type,
+            partition=partition
+        )
+        details_paths.append(s05.save_results_metadata(
+            dataframe=receipt_df,
+            metadata_path=config["metadata_path"],
+            template_dir=config["template_dir"],
+            experiment_type=experiment_type,
+            partition=partition
+        ))
+
+    # The registered runs are known to the next campaigns (not the TEST ones)
+    if config["dedup_index"] and partition == "permanent":
+        index = DedupIndex(config["dedup_index"])
+        for details_path in details_paths:
+            index.add_details(details_path)
+        index.close()
+
+    return details_paths
+
+
+def get_mapping_tables(config: dict) -> list:
+    return [
+        path for path in (config["mapping_WGS"], config["mapping_AMP"])
+        if path
+    ]
+
+
+def get_schema_files(config: dict) -> list:
+    # Validation runs again once the schemas are downloaded or updated
+    return [
+        os.path.join(config["schema_dir"], name)
+        for name in list(xsd_validation.SCHEMA_FILES.values()) + [xsd_validation.COMMON_SCHEMA]
+    ]
+
+
+def get_inventory(config: dict) -> list:
+    """
+    Lists the sequence files of the campaign, as found by s04 (mapping tables)
+    or by the s03 glob (nested samples directory).
+    """
+    inventory = []
+    for experiment_type in config["experiment_types"]:
+        if config["mapping_WGS"] or config["mapping_AMP"]:
+            inventory += s04.gather_files(
+                experiment_type=experiment_type,
+                WGS_samples_dir=config["WGS_samples_dir"],
+                AMP_samples_dir=config["AMP_samples_dir"],
+                mapping_WGS=config["mapping_WGS"],
+                mapping_AMP=config["mapping_AMP"]
+            )
+        else:
+            for filename_for, filename_rev in s03.find_read_pairs(
+                samples_dir=config["samples_dir"],
+                experiment_type=experiment_type,
+                forward_pattern=config["forward_pattern_dict"][experiment_type]
+            ):
+                inventory += [filename_for, filename_rev]
+
+    return inventory
+
+
+def get_checksum_files(config: dict) -> list:
+    # MD5.txt files are read by s03 instead of hashing the sequences again
+    checksum_files = set()
+    for path in get_inventory(config):
+        checksum_files.add(os.path.join(os.path.dirname(path), "MD5.txt"))
+    for samples_dir in (config["WGS_samples_dir"], config["AMP_samples_dir"]):
+        if samples_dir:
+            checksum_files.add(os.path.join(os.path.abspath(samples_dir), "MD5.txt"))
+
+    return sorted(checksum_files)
+
+
+def stage_fingerprint(stage: dict) -> str:
+    fingerprint = {
+        "inputs": {path: file_fingerprint(path) for path in stage["inputs"]()},
+        "inventory": inventory_fingerprint(stage["inventory"]()),
+        "params": stage["params"]
+    }
+
+    return hashlib.md5(
+        json.dumps(fingerprint, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def file_fingerprint(path: str) -> str:
+    if not path or not os.path.exists(path):
+        return "missing"
+
+    md5 = hashlib.md5()
+    with open(path, mode="rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def inventory_fingerprint(paths: list) -> str:
+    # Sequence files are too big to be read here: size and modification
+    # time are enough to notice a new or re-delivered file
+    md5 = hashlib.md5()
+    for path in sorted(paths):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            md5.update(f"{os.path.abspath(path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+        else:
+            md5.update(f"{os.path.abspath(path)}\tmissing\n".encode())
+
+    return md5.hexdigest()
+
+
+class CampaignLocked(RuntimeError):
+    pass
+
+
+@contextlib.contextmanager
+def campaign_lock(lock_path: str):
+    with open(lock_path, mode="w") as handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise CampaignLocked(f"[!] {lock_path} is held by another run of the pipeline")
+
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def get_state_path(metadata_path: str) -> str:
+    # WARNING: project name is assumed to be in the first field of the path
+    project_name = os.path.basename(metadata_path).split("_")[0]
+
+    return os.path.join(
+        os.path.dirname(metadata_path),
+        f"{project_name}_ena_pipeline.json"
+    )
+
+
+def load_state(state_path: str) -> dict:
+    if not os.path.exists(state_path):
+        return {}
+
+    with open(state_path, mode="r") as handle:
+        return json.load(handle)
+
+
+def save_state(state_path: str, state: dict) -> None:
+    # Write then rename, an interrupted run must not corrupt the state
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, mode="w") as handle:
+        json.dump(state, handle, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def print_status(status: dict) -> None:
+    print("[PIPELINE] Summary:")
+    for name, value in status.items():
+        print(f"  - {name:<16} {value}")
+
+
+def parse_args(argv: list = None):
+    # Options can also be read from a file, one per line: @pipeline.args
+    parser = argparse.ArgumentParser("ENA submission pipeline", fromfile_prefix_chars="@")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-i", "--metadata_path",
+                        help="Metadata of the sequences: ENA spreadsheet (.xlsx) or CSV/TSV/Parquet export.",
+                        type=str,
+                        required=True
+                        )
+    parser.add_argument("-t", "--template_dir",
+                        help="Directory containing the templates for the submission.",
+                        type=str,
+                        required=True
+                        )
+    parser.add_argument("-e", "--experiment_types",
+                        help="String defining either 16S, WGS or both.",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=["16S", "WGS"]
+                        )
+    parser.add_argument("-s", "--samples_dir",
+                        help="Directory containing the 16_S and Metagenomes folders (nested layout).",
+                        type=str
+                        )
+    parser.add_argument("-w", "--WGS_samples_dir",
+                        help="Directory containing the WGS sequences listed in the mapping table.",
+                        type=str
+                        )
+    parser.add_argument("-a", "--AMP_samples_dir",
+                        help="Directory containing the 16S sequences listed in the mapping table.",
+                        type=str
+                        )
+    parser.add_argument("-m", "--mapping_WGS",
+                        help="Table containing rawreads filename (forward and reverse) and sample_alias for WGS",
+                        type=str
+                        )
+    parser.add_argument("-k", "--mapping_AMP",
+                        help="Table containing rawreads filename (forward and reverse) and sample_alias for AMPLICON",
+                        type=str
+                        )
+    parser.add_argument("-f", "--forward_pattern_16s",
+                        help="Pattern followed in naming the forward sequence files (16S).",
+                        type=str,
+                        default="*1.fastq.gz"
+                        )
+    parser.add_argument("-g", "--forward_pattern_wgs",
+                        help="Pattern followed in naming the forward sequence files (WGS).",
+                        type=str,
+                        default="*1.fq.gz"
+                        )
+    parser.add_argument("-c", "--check",
+                        action="store_true",
+                        help="Check that the forward files exist before adding an experiment (s02)."
+                        )
+    parser.add_argument("-S", "--submission_type",
+                        help="Submission type: \n -type 1 for ADD mode; \n -type 2 fpr MODIFY mode",
+                        type=int,
+                        default=1,
+                        choices=[1, 2]
+                        )
+    parser.add_argument("-x", "--registration_type",
+                        help="Registration type: 'y' or 'yes' for permanent; 'n' or 'no' for test. Leave empty for dry run.",
+                        type=str,
+                        default="null",
+                        choices=['y', 'yes', 'n', 'no', "null"]
+                        )
+    parser.add_argument("-u", "--user_password",
+                        help="User and password for the submission (e.g. user1:password1234).",
+                        type=str
+                        )
+    parser.add_argument("--no_upload",
+                        action="store_true",
+                        help="Do not run s04, the files are uploaded separately."
+                        )
+    parser.add_argument("--overlap",
+                        action="store_true",
+                        help="Upload each file as soon as its checksum is computed (s03 and s04 at the same time)."
+                        )
+    parser.add_argument("--hash_workers",
+                        help="Files hashed at the same time (only with --overlap).",
+                        type=int,
+                        default=2
+                        )
+    parser.add_argument("--upload_workers",
+                        help="Files uploaded at the same time (parallel transfers of the session, at most with --adaptive).",
+                        type=int,
+                        default=4
+                        )
+    parser.add_argument("--rate_cap",
+                        help="Upload rate shared by all transfers, e.g. 20M (bytes per second).",
+                        type=str
+                        )
+    parser.add_argument("--rate_schedule",
+                        help="Rate caps by time of day, e.g. '08:00-19:00=20M,19:00-08:00=0' (--rate_cap elsewhere).",
+                        type=str
+                        )
+    parser.add_argument("--adaptive",
+                        action="store_true",
+                        help="Adapt the number of transfers to the throughput of the uplink, up to --upload_workers."
+                        )
+    parser.add_argument("--checksum_store",
+                        help="SQLite file caching the checksums (default: ena_checksums.sqlite next to the metadata).",
+                        type=str
+                        )
+    parser.add_argument("--verify_fastq",
+                        action="store_true",
+                        help="While hashing (s03), also check the gzip CRC/size and the FASTQ records of every file."
+                        )
+    parser.add_argument("--hash_queue",
+                        help="Folder on a shared file system: s03 files are hashed by 'ena.py hash-worker' on any node.",
+                        type=str
+                        )
+    parser.add_argument("--local_workers",
+                        help="Files hashed by the pipeline itself while waiting for the queue (0: only wait).",
+                        type=int,
+                        default=1
+                        )
+    parser.add_argument("--dedup_index",
+                        help="Index of the files of all campaigns ('ena.py dedup'): files already registered "
+                             "elsewhere are reported, not sent, and block the run XML.",
+                        type=str
+                        )
+    parser.add_argument("--allow_duplicates",
+                        action="store_true",
+                        help="Send and register the files even if they are already registered in other campaigns."
+                        )
+    parser.add_argument("--cache_dir",
+                        help="Directory where the parsed metadata is cached between runs.",
+                        type=str
+                        )
+    parser.add_argument("--checklist",
+                        help="ENA checklist the metadata is validated against (data/checklists), 'none' to skip.",
+                        type=str,
+                        default=checklist_validation.DEFAULT_CHECKLIST
+                        )
+    parser.add_argument("--taxonomy_index",
+                        help="Taxonomy index built with 'ena.py taxonomy --build': tax_id and scientific_name are checked against it.",
+                        type=str
+                        )
+    parser.add_argument("--fill_taxonomy",
+                        action="store_true",
+                        help="With --taxonomy_index, fill the missing tax_id or scientific_name instead of reporting them."
+                        )
+    parser.add_argument("--no_quick_check",
+                        action="store_true",
+                        help="Do not check the first reads of the files (swapped or mislabeled files) before upload and run_xml."
+                        )
+    parser.add_argument("--no_validation",
+                        action="store_true",
+                        help="Do not validate the XML files against the ENA schemas before submitting them."
+                        )
+    parser.add_argument("--schema_dir",
+                        help="Directory containing the ENA SRA XSD files (default: data/schemas).",
+                        type=str,
+                        default=xsd_validation.SCHEMA_DIR
+                        )
+    parser.add_argument("--stages",
+                        help="Comma separated stages to consider: samples_xml, samples_valid, samples_receipt, "
+                             "experiment_xml, reads_quick, compress, upload, run_xml, objects_valid, object_receipt, details.",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=None
+                        )
+    parser.add_argument("--force",
+                        action="store_true",
+                        help="Re-run the generation stages even if their inputs did not change."
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import argparse
+
+import events
+import profiling
+import io_engine
+from paired_check import add_pair_arguments, list_campaign_pairs
+from checksum_store import ChecksumStore, default_store_path, read_md5_file, UPLOAD_TARGET
+from compress import DEFAULT_LEVEL, settings, is_compressed
+from bandwidth import parse_rate, format_rate
+
+
+# Used until a run on this machine has measured them (bytes per second):
+# one MD5 stream per device kind, zlib on one core, the whole upload session
+DEFAULT_RATES = {
+    "hash": {"rotational": 120e6, "ssd": 400e6, "network": 150e6},
+    "compress": 25e6,
+    "upload": 10e6
+}
+# Gzipped FASTQ / FASTQ, until some files of the campaign are compressed
+DEFAULT_RATIO = 0.3
+DEFAULT_UPLOAD_WORKERS = 4
+# Measures of the store used for an estimate, newest first
+HISTORY = 200
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="plan")
+    events.start(args, command="plan")
+
+    store_path = args.checksum_store or (
+        default_store_path(os.path.dirname(os.path.abspath(args.metadata_path))) if args.metadata_path else None
+    )
+    # Not created by a plan: without a store, every file is still to hash
+    store = ChecksumStore(store_path) if store_path and os.path.exists(store_path) else None
+    if store is None:
+        print("[WARNING] No checksum store, every file counts as not hashed and the rates are assumed")
+
+    try:
+        pairs = list_campaign_pairs(args)
+        if not pairs:
+            print("[!] No read pair found, check the directories and mapping tables")
+            sys.exit(1)
+        paths = sorted({path for _, forward, reverse, _ in pairs for path in (forward, reverse)})
+        result = estimate(
+            paths,
+            store,
+            level=args.level,
+            upload_rate=parse_rate(args.upload_rate) if args.upload_rate else None,
+            overlap=args.overlap
+        )
+    finally:
+        if store is not None:
+            store.close()
+
+    print_plan(result)
+
+    if args.output:
+        tmp_path = f"{args.output}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w") as handle:
+            json.dump(result, handle, indent=2)
+        os.replace(tmp_path, args.output)
+        print(f"[PLAN][+] Plan written to {args.output}")
+
+
+def inventory(paths: list, store: ChecksumStore = None, level: int = DEFAULT_LEVEL) -> dict:
+    """
+    What is left to do for each file of the campaign: hashing (no MD5 in the
+    store or in the MD5.txt of its folder or of the folder above, as s03
+    reads them), compressing (uncompressed files without a gzip stream of
+    these settings in the store) and the bytes sent to ENA.
+    Returns:
+        dict: mount point -> list of dicts 'path', 'size', 'hash', 'compress', 'upload_bytes' (None if unknown).
+    """
+    manifests = {}
+
+    def listed(file_path):
+        folder = os.path.dirname(file_path)
+        for checksum_path in (os.path.join(folder, "MD5.txt"), os.path.join(os.path.dirname(folder), "MD5.txt")):
+            if checksum_path not in manifests:
+                manifests[checksum_path] = read_md5_file(checksum_path) if os.path.exists(checksum_path) else {}
+            if os.path.basename(file_path) in manifests[checksum_path]:
+                return True
+        return False
+
+    mounts = {}
+    compression = settings(level)
+    for file_path in paths:
+        if not os.path.exists(file_path):
+            mounts.setdefault(None, []).append({"path": file_path})
+            continue
+
+        entry = {"path": file_path, "size": os.path.getsize(file_path)}
+        if is_compressed(file_path):
+            entry["compress"] = False
+            entry["hash"] = not (store is not None and store.get(file_path)) and not listed(file_path)
+            entry["upload_bytes"] = entry["size"]
+        else:
+            # The MD5 sent to ENA is the one of the stream, hashed while compressing
+            md5, compressed_size = store.get_compressed(file_path, compression) if store is not None else (None, None)
+            entry["compress"] = md5 is None
+            entry["hash"] = False
+            entry["upload_bytes"] = compressed_size
+
+        mounts.setdefault(io_engine.mount_point(file_path), []).append(entry)
+
+    return mounts
+
+
+def measured_rate(store: ChecksumStore, kind: str, target: str = None, per_worker: bool = False) -> tuple:
+    # (bytes per second, number of measures), (None, 0) without history
+    if store is None:
+        return None, 0
+    measures = store.get_throughput(kind, target, last=HISTORY)
+    duration = sum(duration_s * (workers if per_worker else 1) for _, _, duration_s, workers in measures)
+    if not duration:
+        return None, 0
+
+    return sum(size for _, size, _, _ in measures) / duration, len(measures)
+
+
+def upload_history(store: ChecksumStore) -> dict:
+    # Workers of the past sessions -> (bytes per second, number of sessions)
+    sessions = {}
+    for _, size, duration_s, workers in (store.get_throughput("upload", UPLOAD_TARGET, last=HISTORY) if store else []):
+        total = sessions.setdefault(workers, [0, 0.0, 0])
+        total[0] += size
+        total[1] += duration_s
+        total[2] += 1
+
+    return {workers: (size / duration, count) for workers, (size, duration, count) in sessions.items()}
+
+
+@profiling.profiled("plan")
+def estimate(
+    paths: list,
+    store: ChecksumStore = None,
+    level: int = DEFAULT_LEVEL,
+    upload_rate: float = None,
+    overlap: bool = False
+) -> dict:
+    """
+    Bytes to hash, compress and upload, the rate of each stage and the
+    recommended workers. The rates come from the measures of the previous
+    runs in the checksum store (hash per mount, compression per core,
+    upload sessions per number of transfers), then from the io probe of
+    the mount, then from DEFAULT_RATES ('assumed').
+    Stages follow each other, or run at the pace of the slowest one with
+    overlap (hashing and compressing while uploading, as pipeline --overlap).
+    """
+    cpus = os.cpu_count() or 1
+    mounts = inventory(paths, store, level)
+    missing = [entry["path"] for entry in mounts.pop(None, [])]
+    files = [entry for entries in mounts.values() for entry in entries]
+
+    # Compression ratio of the files already compressed with these settings
+    known = [entry for entry in files if not is_compressed(entry["path"]) and entry["upload_bytes"]]
+    ratio = sum(entry["upload_bytes"] for entry in known) / sum(entry["size"] for entry in known) \
+        if known else DEFAULT_RATIO
+    upload_bytes = sum(
+        entry["upload_bytes"] if entry["upload_bytes"] is not None else entry["size"] * ratio
+        for entry in files
+    )
+
+    stages = []
+    hash_workers = 0
+    for mount, entries in sorted(mounts.items()):
+        device = io_engine.get_settings(mount)
+        workers = min(device["concurrency"], cpus)
+        rate, count = measured_rate(store, "hash", mount)
+        source = f"measured, {count} files"
+        if rate is None and device.get("mb_s"):
+            rate, source = device["mb_s"] * 1e6 / device["concurrency"], "io probe"
+        elif rate is None:
+            rate, source = DEFAULT_RATES["hash"][device["kind"]], "assumed"
+        rate *= workers
+        if device.get("mb_s"):
+            # Never faster than the device read at its best concurrency
+            rate = min(rate, device["mb_s"] * 1e6)
+        hash_workers += workers
+        stages.append(stage(
+            f"hash {mount}", sum(entry["size"] for entry in entries if entry["hash"]), rate, workers, source,
+            files=sum(entry["hash"] for entry in entries)
+        ))
+
+    rate, count = measured_rate(store, "compress", per_worker=True)
+    source = f"measured, {count} files" if rate else "assumed"
+    stages.append(stage(
+        "compress", sum(entry["size"] for entry in files if entry["compress"]),
+        (rate or DEFAULT_RATES["compress"]) * cpus, cpus, source,
+        files=sum(entry["compress"] for entry in files)
+    ))
+
+    sessions = upload_history(store)
+    if upload_rate:
+        workers, source = DEFAULT_UPLOAD_WORKERS, "given"
+    elif sessions:
+        # Fewest transfers among the fastest sessions (within 10%)
+        best = max(rate for rate, _ in sessions.values())
+        workers = min(w for w, (rate, _) in sessions.items() if rate >= best * 0.9)
+        upload_rate, count = sessions[workers]
+        source = f"measured, {count} sessions"
+    else:
+        workers, upload_rate, source = DEFAULT_UPLOAD_WORKERS, DEFAULT_RATES["upload"], "assumed"
+    stages.append(stage("upload", upload_bytes, upload_rate, workers, source, files=len(files)))
+
+    durations = [s["duration_s"] for s in stages]
+    result = {
+        "files": len(files),
+        "bytes": sum(entry["size"] for entry in files),
+        "missing": missing,
+        "compression_ratio": ratio,
+        "overlap": overlap,
+        "stages": stages,
+        "workers": {
+            "hash": min(hash_workers, cpus),
+            "compress": cpus,
+            "upload": workers
+        },
+        "wall_s": max(durations) if overlap else sum(durations)
+    }
+    events.emit("plan_estimated", files=result["files"], bytes=result["bytes"], wall_s=result["wall_s"])
+
+    return result
+
+
+def stage(name: str, size: float, rate: float, workers: int, source: str, files: int) -> dict:
+    return {
+        "stage": name,
+        "files": files,
+        "bytes": int(size),
+        "rate": rate,
+        "workers": workers,
+        "source": source,
+        "duration_s": size / rate if size else 0.0
+    }
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def print_plan(result: dict) -> None:
+    print(f"[PLAN] {result['files']} files ({result['bytes'] / 1e9:.2f} GB), "
+          f"compression ratio {result['compression_ratio']:.2f}")
+    for path in result["missing"]:
+        print(f"[WARNING] Listed but not found: {path}")
+    for s in result["stages"]:
+        print(f"[PLAN] {s['stage']:<24} {s['files']:5d} files {s['bytes'] / 1e9:9.2f} GB  "
+              f"{format_rate(s['rate']):>12} ({s['source']})  {s['workers']:2d} workers  "
+              f"~{format_duration(s['duration_s'])}")
+    print(f"[PLAN] Expected wall time: ~{format_duration(result['wall_s'])}"
+          f"{' (stages overlapped)' if result['overlap'] else ''}")
+    workers = result["workers"]
+    print(f"[PLAN] Recommended: --hash_workers {workers['hash']} / --local_workers {workers['hash']} (hashing), "
+          f"compress -j {workers['compress']}, --upload_workers {workers['upload']}")
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Estimate the hashing, compression and upload time of a campaign")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    add_pair_arguments(parser)
+    parser.add_argument("-i", "--metadata_path",
+                        help="Metadata of the campaign: its checksum store is next to it.",
+                        type=str
+                        )
+    parser.add_argument("--checksum_store",
+                        help="SQLite checksum store of the previous runs (default: next to the metadata).",
+                        type=str
+                        )
+    parser.add_argument("-l", "--level",
+                        help="Compression level of the uncompressed files (as compress -l).",
+                        type=int,
+                        default=DEFAULT_LEVEL
+                        )
+    parser.add_argument("--upload_rate",
+                        help="Speed of the uplink, e.g. 50M, instead of the one measured by the previous uploads.",
+                        type=str
+                        )
+    parser.add_argument("--overlap",
+                        action="store_true",
+                        help="Hashing and uploading at the same time (pipeline --overlap)."
+                        )
+    parser.add_argument("-o", "--output",
+                        help="JSON file where the plan is saved.",
+                        type=str
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import atexit
+import argparse
+import threading
+import functools
+
+
+# Active profiler of the process, None when --profile is not given
+_profiler = None
+
+
+class Profiler:
+    """
+    Wall and CPU time of the named stages of a run, optionally with the
+    cProfile statistics and the tracemalloc peak memory of each stage.
+    Stages can be nested: the inner ones are reported as 'outer/inner'.
+    """
+
+    def __init__(self, report_path: str, command: str, cprofile: bool = False, memory: bool = False):
+        self.report_path = report_path
+        self.command = command
+        self.cprofile = cprofile
+        self.memory = memory
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = {}
+        self.profiles = {}
+
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+
+    def stack(self) -> list:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def enter(self, name: str) -> dict:
+        stack = self.stack()
+        frame = {
+            "name": "/".join([parent["name"] for parent in stack[-1:]] + [name]),
+            "start_wall": time.perf_counter(),
+            "start_cpu": time.thread_time(),
+            "peak": 0,
+            "profile": None
+        }
+
+        if self.memory:
+            import tracemalloc
+            # The peak is process wide: hand the current one to the parent before resetting
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        # cProfile allows a single active profiler per thread
+        if self.cprofile and not stack and threading.current_thread() is threading.main_thread():
+            import cProfile
+            frame["profile"] = self.profiles.setdefault(frame["name"], cProfile.Profile())
+            frame["profile"].enable()
+
+        stack.append(frame)
+        return frame
+
+    def exit(self, frame: dict) -> None:
+        if frame["profile"] is not None:
+            frame["profile"].disable()
+
+        wall = time.perf_counter() - frame["start_wall"]
+        cpu = time.thread_time() - frame["start_cpu"]
+
+        stack = self.stack()
+        stack.pop()
+
+        if self.memory:
+            import tracemalloc
+            frame["peak"] = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], frame["peak"])
+
+        with self.lock:
+            stage = self.stages.setdefault(frame["name"], {
+                "calls": 0,
+                "wall_s": 0.0,
+                "cpu_s": 0.0
+            })
+            stage["calls"] += 1
+            stage["wall_s"] += wall
+            stage["cpu_s"] += cpu
+            if self.memory:
+                stage["peak_mb"] = max(stage.get("peak_mb", 0), frame["peak"] / (1024 * 1024))
+
+    def save(self) -> str:
+        report = {
+            "command": self.command,
+            "argv": sys.argv,
+            "started": self.started,
+            "wall_s": time.perf_counter() - self.start_wall,
+            "cpu_s": time.process_time() - self.start_cpu,
+            "stages": self.stages
+        }
+
+        if self.memory:
+            import tracemalloc
+            report["peak_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+
+        if self.profiles:
+            report["cprofile"] = {}
+            base_path = os.path.splitext(self.report_path)[0]
+            for name, profile in self.profiles.items():
+                stats_path = f"{base_path}.{name.replace('/', '.')}.prof"
+                profile.dump_stats(stats_path)
+                report["cprofile"][name] = stats_path
+
+        with open(self.report_path, mode="w") as handle:
+            json.dump(report, handle, indent=2)
+
+        print(f"[PROFILE][+] Report saved to: {self.report_path}")
+
+        return self.report_path
+
+
+class stage:
+    """
+    Context manager timing a named stage, doing nothing when profiling is off:
+        with profiling.stage("hashing"):
+            ...
+    """
+
+    __slots__ = ("name", "frame")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.frame = None
+
+    def __enter__(self):
+        if _profiler is not None:
+            self.frame = _profiler.enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.frame is not None:
+            _profiler.exit(self.frame)
+        return False
+
+
+def profiled(name: str):
+    """
+    Decorator timing every call of a function as a stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def start(args: argparse.Namespace, command: str) -> Profiler:
+    """
+    Starts profiling if --profile was given. The report is written when the
+    process exits, so that runs stopped by sys.exit are reported as well.
+    """
+    global _profiler
+
+    if not getattr(args, "profile", None) or _profiler is not None:
+        return _profiler
+
+    _profiler = Profiler(
+        report_path=args.profile,
+        command=command,
+        cprofile=args.profile_cprofile,
+        memory=args.profile_memory
+    )
+    atexit.register(_profiler.save)
+
+    return _profiler
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--profile",
+                        help="JSON file where the wall/CPU time of each stage of the run is saved.",
+                        type=str
+                        )
+    parser.add_argument("--profile_cprofile",
+                        action="store_true",
+                        help="With --profile, also dump the cProfile statistics of each stage (.prof files)."
+                        )
+    parser.add_argument("--profile_memory",
+                        action="store_true",
+                        help="With --profile, also record the tracemalloc peak memory of each stage."
+                        )
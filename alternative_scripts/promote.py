@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import events
+import profiling
+import submissions
+import s01_create_samples_xml as s01
+import s05_register_object as s05
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="promote")
+    events.start(args, command="promote")
+
+    promoted = promote(
+        metadata_path=args.metadata_path,
+        user_password=args.user_password,
+        experiment_types=args.experiment_types,
+        dry_run=args.dry_run
+    )
+
+    if not promoted:
+        print('Exiting....')
+        sys.exit(1)
+
+
+@profiling.profiled("promote")
+def promote(metadata_path: str, user_password: str, experiment_types: list, dry_run: bool = False) -> bool:
+    """
+    Sends the XML files validated in the TEST partition to the permanent
+    one, as they were sent: nothing is generated again. The parts of the
+    TEST submissions recorded by s01/s05 (<project>_ena_submissions.json)
+    must still have their SHA-256, and their receipts must be successful.
+    When the samples were tested too, they are registered first and the
+    experiments refer to their permanent accessions instead of the TEST
+    ones: the only bytes changed. The TEST experiment XML is then kept as
+    <project>_ena_experiment_test.xml.
+    Returns:
+        bool: False if anything changed since the TEST run or ENA refused a submission.
+    """
+    # WARNING: project name is assumed to be in the first field of the path
+    project_name = os.path.basename(metadata_path).split("_")[0]
+    metadata_dir = os.path.dirname(metadata_path)
+    manifest = submissions.load_manifest(metadata_dir, project_name)
+
+    objects_test = manifest.get("objects", {}).get("test")
+    samples_test = manifest.get("samples", {}).get("test")
+    if not objects_test:
+        print(f"[!] No TEST registration of the objects in "
+              f"{submissions.manifest_path(metadata_dir, project_name)}: run s05 (or the pipeline) with -x n first")
+        return False
+
+    # Everything is checked before the first byte is sent
+    problems = []
+    for kind, entry in (("samples", samples_test), ("objects", objects_test)):
+        if entry is None:
+            continue
+        problems += [f"{kind} {problem}" for problem in submissions.changed_files(entry)]
+        if not problems and not s01.receipt_output_handling(entry["receipt"]["path"])["success"]:
+            problems.append(f"{kind}: the TEST submission failed, see {entry['receipt']['path']}")
+    if problems:
+        print('\n'.join(f"[!] {problem}" for problem in problems))
+        print("[!] Not the validated submission anymore: register it in TEST again")
+        return False
+    print(f"[PROMOTE] TEST submissions verified: {sum(len(e['files']) for e in (samples_test, objects_test) if e)} "
+          f"files unchanged since {objects_test['date']}")
+
+    samples_receipt_path = submissions.artifact_path(metadata_dir, project_name, "ena_samples_receipt.xml")
+    object_receipt_path = submissions.artifact_path(metadata_dir, project_name, "ena_object_receipt.xml")
+    if os.path.exists(object_receipt_path):
+        return already_registered(object_receipt_path)
+
+    accessions = {}
+    if samples_test:
+        # Left by a previous promotion stopped before the objects
+        if os.path.exists(samples_receipt_path):
+            if not already_registered(samples_receipt_path):
+                return False
+        elif not send(samples_test, "samples", samples_receipt_path, metadata_dir, project_name,
+                      user_password, dry_run, launch=True):
+            return False
+        if dry_run:
+            print("[PROMOTE] Dry run: the experiments would refer to the permanent sample accessions")
+        else:
+            accessions = map_accessions(samples_test["receipt"]["path"], samples_receipt_path)
+
+    experiment = objects_test["files"]["EXPERIMENT"]
+    with open(experiment["path"], mode="rb") as handle:
+        tested = handle.read()
+    promoted = rewrite_sample_refs(tested, accessions)
+    if promoted != tested:
+        experiment_path = submissions.artifact_path(metadata_dir, project_name, "ena_experiment.xml")
+        test_path = submissions.artifact_path(metadata_dir, project_name, "ena_experiment.xml", "test")
+        if experiment["path"] != os.path.abspath(test_path):
+            write_bytes(test_path, tested)
+            # The TEST bytes are kept, under their partition name
+            experiment["path"] = os.path.abspath(test_path)
+            submissions.record_submission(
+                metadata_dir, project_name, "objects", "test", objects_test["url"],
+                files={part: file["path"] for part, file in objects_test["files"].items()},
+                receipt_path=objects_test["receipt"]["path"],
+                date=objects_test["date"]
+            )
+        write_bytes(experiment_path, promoted)
+        objects_test["files"]["EXPERIMENT"] = {"path": os.path.abspath(experiment_path)}
+        print(f"[PROMOTE] {len(accessions)} sample references moved to the permanent accessions "
+              f"in {os.path.basename(experiment_path)}")
+
+    if not send(objects_test, "objects", object_receipt_path, metadata_dir, project_name, user_password, dry_run):
+        return False
+    if dry_run:
+        return True
+
+    for experiment_type in experiment_types:
+        receipt_df = s05.parse_objects_receipts(
+            metadata_path=metadata_path,
+            template_dir=None,
+            experiment_type=experiment_type
+        )
+        details_path = s05.save_results_metadata(
+            dataframe=receipt_df,
+            metadata_path=metadata_path,
+            template_dir=None,
+            experiment_type=experiment_type
+        )
+        print(f"[PROMOTE][+] Metadata written to {details_path}")
+
+    return True
+
+
+def already_registered(receipt_path: str) -> bool:
+    # ENA refuses the same aliases twice: a permanent receipt is final
+    if s01.receipt_output_handling(receipt_path)["success"]:
+        print(f"[PROMOTE][=] Already registered permanently: {receipt_path}")
+        return True
+
+    print(f"[!] {receipt_path} is a failed permanent submission: move it away and promote again")
+    return False
+
+
+def send(
+    entry: dict,
+    kind: str,
+    output_path: str,
+    metadata_dir: str,
+    project_name: str,
+    user_password: str,
+    dry_run: bool,
+    launch: bool = False
+) -> bool:
+    """
+    Posts the parts of a recorded TEST submission to the permanent
+    partition, as s01/s05 do, and records it once successful.
+    """
+    url = submissions.SUBMIT_URL["permanent"]
+    files = {part: file["path"] for part, file in entry["files"].items()}
+    command = ["curl", "-u", user_password]
+    for part, path in files.items():
+        command += ["-F", f"{part}=@{path}"]
+    if launch:
+        command += ["-F", "LAUNCH=YES"]
+    command += ["-o", output_path, url]
+
+    if dry_run:
+        print(f"[PROMOTE] Dry run, would send: {' '.join(command[:1] + command[3:])}")
+        return True
+
+    print(f"[PROMOTE] Registering the {kind} to the Permanent partition ..")
+    start_time = time.perf_counter()
+    posted = True
+    try:
+        with profiling.stage("curl"), events.heartbeat("submission_running", url=url):
+            subprocess.run(command, check=True, text=True)
+    except subprocess.CalledProcessError as e:
+        print(f"[!] Error:", {e.stderr})
+        posted = False
+
+    events.emit("submission_posted", url=url, files=list(files.values()), receipt=output_path,
+                duration_s=time.perf_counter() - start_time, ok=posted)
+
+    if not posted or not os.path.exists(output_path):
+        return False
+
+    message = s01.receipt_output_handling(output_path)
+    if not message["success"]:
+        print('\n'.join(f'[!] {k} --> {v}' for k, v in message.items()))
+        return False
+
+    submissions.record_submission(metadata_dir, project_name, kind, "permanent", url, files, output_path)
+    print(f"[PROMOTE][+] {kind.capitalize()} registered Permanently, receipt saved to {output_path}")
+
+    return True
+
+
+def map_accessions(test_receipt_path: str, permanent_receipt_path: str) -> dict:
+    # TEST sample accession -> permanent one, through the sample aliases
+    import bs4 as bs
+
+    def accessions(receipt_path):
+        with open(receipt_path, mode="r") as handle:
+            receipt = bs.BeautifulSoup(handle, "xml")
+        return {sample.get("alias"): sample.get("accession") for sample in receipt.find_all("SAMPLE")}
+
+    test, permanent = accessions(test_receipt_path), accessions(permanent_receipt_path)
+    missing = sorted(set(test) - set(permanent))
+    if missing:
+        raise ValueError(f"[!] Samples missing from {permanent_receipt_path}: {', '.join(missing)}")
+
+    return {accession: permanent[alias] for alias, accession in test.items() if accession != permanent[alias]}
+
+
+def rewrite_sample_refs(experiment_xml: bytes, accessions: dict) -> bytes:
+    # Only the SAMPLE_DESCRIPTOR references change, the rest stays byte for byte
+    for test, permanent in accessions.items():
+        experiment_xml = experiment_xml.replace(
+            f'<SAMPLE_DESCRIPTOR accession="{test}"'.encode(),
+            f'<SAMPLE_DESCRIPTOR accession="{permanent}"'.encode()
+        )
+
+    return experiment_xml
+
+
+def write_bytes(output_path: str, data: bytes) -> None:
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode="wb") as handle:
+        handle.write(data)
+    os.replace(tmp_path, output_path)
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Register the submission validated in TEST to the permanent partition")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-i", "--metadata_path",
+                        help="Metadata of the campaign: the XML files, receipts and submission record are next to it.",
+                        type=str,
+                        required=True
+                        )
+    parser.add_argument("-u", "--user_password",
+                        help="User and password of the submission (e.g. user1:password1234).",
+                        type=str
+                        )
+    parser.add_argument("-e", "--experiment_types",
+                        help="String defining either 16S, WGS or both (details CSV).",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=["16S", "WGS"]
+                        )
+    parser.add_argument("--dry_run",
+                        action="store_true",
+                        help="Check the TEST submissions and show what would be sent, send nothing."
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import sys
+import zlib
+import hashlib
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import events
+import profiling
+from paired_check import add_pair_arguments, list_campaign_pairs, read_blocks
+
+
+DEFAULT_RECORDS = 1000
+# Decompressed bytes read at most per file: a few hundred reads of 150 bp fit in 1 MiB
+DEFAULT_MAX_BYTES = 1024 * 1024
+READ_SIZE = 64 * 1024
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="quick_check")
+    events.start(args, command="quick_check")
+
+    pairs = list_campaign_pairs(args)
+    if not pairs:
+        print("[!] No read pairs found")
+        sys.exit(1)
+
+    if not quick_check(pairs, records=args.records, max_bytes=args.max_bytes, workers=args.workers):
+        sys.exit(1)
+
+
+def parse_header(header: bytes) -> tuple:
+    """
+    Splits an Illumina read header into (read_id, direction, flowcell, lane).
+    Casava 1.8+:  @instrument:run:flowcell:lane:tile:x:y 1:N:0:index
+    Older:        @instrument:lane:tile:x:y#index/1
+    Unknown parts are None.
+    """
+    name, _, comment = header[1:].rstrip(b"\r").partition(b" ")
+
+    direction = None
+    if comment[:2] in (b"1:", b"2:"):
+        direction = int(comment[:1])
+    elif name[-2:] in (b"/1", b"/2"):
+        direction = int(name[-1:])
+        name = name[:-2]
+
+    fields = name.split(b"#")[0].split(b":")
+    if len(fields) >= 7:
+        flowcell, lane = fields[2].decode(errors="replace"), fields[3].decode(errors="replace")
+    elif len(fields) == 5:
+        flowcell, lane = None, fields[1].decode(errors="replace")
+    else:
+        flowcell, lane = None, None
+
+    return name, direction, flowcell, lane
+
+
+def sample_file(file_path: str, records: int = DEFAULT_RECORDS, max_bytes: int = DEFAULT_MAX_BYTES) -> dict:
+    """
+    Decompresses the start of a file, at most records reads and max_bytes bytes.
+    Returns:
+        dict: 'path', 'records' (sampled), 'ids' (read IDs), 'directions'
+              (Counter), 'lanes' (set of (flowcell, lane)), 'digest' (SHA-1 of
+              the sampled records) and 'problem' (None if readable).
+    """
+    sample = {
+        "path": file_path,
+        "records": 0,
+        "ids": [],
+        "directions": Counter(),
+        "lanes": set(),
+        "digest": None,
+        "problem": None
+    }
+
+    # Newlines counted per block: the sample is not scanned again for each one
+    chunks = []
+    size, newlines = 0, 0
+    blocks = read_blocks(file_path, block_size=READ_SIZE, limit=max_bytes)
+    try:
+        for block in blocks:
+            chunks.append(block)
+            size += len(block)
+            newlines += block.count(b"\n")
+            if size >= max_bytes or newlines >= 4 * records:
+                break
+    except FileNotFoundError:
+        sample["problem"] = "file not found"
+        return sample
+    except (OSError, zlib.error) as e:
+        sample["problem"] = f"cannot read: {e}"
+        return sample
+    finally:
+        blocks.close()
+
+    data = b"".join(chunks)
+    lines = data[:max_bytes].split(b"\n")
+    n_records = min(records, (len(lines) - 1) // 4)
+    if n_records == 0:
+        sample["problem"] = f"no complete record in the first {len(data[:max_bytes])} bytes"
+        return sample
+
+    lines = lines[:4 * n_records]
+    for header in lines[0::4]:
+        if header[:1] != b"@":
+            sample["problem"] = f"not a FASTQ file (header {header[:30]!r})"
+            return sample
+
+        read_id, direction, flowcell, lane = parse_header(header)
+        sample["ids"].append(read_id)
+        sample["directions"][direction] += 1
+        if lane is not None:
+            sample["lanes"].add((flowcell, lane))
+
+    sample["records"] = n_records
+    sample["digest"] = hashlib.sha1(b"\n".join(lines)).hexdigest()
+
+    return sample
+
+
+def check_samples(pairs: list, samples: dict) -> list:
+    """
+    Compares the sampled reads of the pairs.
+    Args:
+        pairs (list): (sample_alias, forward, reverse, experiment_type) tuples.
+        samples (dict): path -> result of sample_file.
+    Returns:
+        list: One dictionary per pair with 'sample_alias', 'forward', 'reverse',
+              'records', 'lanes', 'problems' and 'warnings'.
+    """
+    # Files (and first reads) listed more than once in the campaign
+    paths_by_digest = defaultdict(set)
+    for path, sample in samples.items():
+        if sample["digest"]:
+            paths_by_digest[sample["digest"]].add(path)
+    listed = Counter(path for _, forward, reverse, _ in pairs for path in (forward, reverse))
+
+    # Samples using each flowcell, to spot a file coming from another campaign
+    aliases_by_flowcell = defaultdict(set)
+    for alias, forward, reverse, _ in pairs:
+        for flowcell, _ in samples[forward]["lanes"] | samples[reverse]["lanes"]:
+            if flowcell:
+                aliases_by_flowcell[flowcell].add(alias)
+    n_aliases = len({alias for alias, _, _, _ in pairs})
+
+    results = []
+    for alias, forward, reverse, experiment_type in pairs:
+        problems = []
+        warnings = []
+        sample_for, sample_rev = samples[forward], samples[reverse]
+
+        for side, sample in (("forward", sample_for), ("reverse", sample_rev)):
+            if sample["problem"]:
+                problems.append(f"{side}: {sample['problem']}")
+            if listed[sample["path"]] > 1:
+                problems.append(f"{side} file listed {listed[sample['path']]} times")
+            others = paths_by_digest[sample["digest"]] - {sample["path"]} if sample["digest"] else set()
+            if others:
+                problems.append(f"{side} starts with the same reads as {', '.join(sorted(others))}")
+
+        if sample_for["problem"] or sample_rev["problem"]:
+            results.append(result(alias, forward, reverse, sample_for, problems, warnings))
+            continue
+
+        directions_for = set(sample_for["directions"]) - {None}
+        directions_rev = set(sample_rev["directions"]) - {None}
+        if directions_for == {2} and directions_rev == {1}:
+            problems.append("forward and reverse files are swapped")
+        else:
+            if directions_for - {1}:
+                problems.append("forward file has reverse reads (read 2 markers)")
+            if directions_rev - {2}:
+                problems.append("reverse file has forward reads (read 1 markers)")
+
+        n = min(sample_for["records"], sample_rev["records"])
+        mismatch = next((i for i in range(n) if sample_for["ids"][i] != sample_rev["ids"][i]), None)
+        if mismatch is not None:
+            problems.append(f"read IDs differ from read {mismatch + 1}: "
+                            f"{sample_for['ids'][mismatch].decode(errors='replace')} / "
+                            f"{sample_rev['ids'][mismatch].decode(errors='replace')}")
+
+        if sample_for["lanes"] != sample_rev["lanes"]:
+            problems.append(f"flowcell/lane differ: {format_lanes(sample_for['lanes'])} / "
+                            f"{format_lanes(sample_rev['lanes'])}")
+
+        # Only meaningful when the other samples share their flowcells
+        if n_aliases > 2:
+            alone = sorted(
+                flowcell for flowcell, _ in sample_for["lanes"]
+                if flowcell and aliases_by_flowcell[flowcell] == {alias}
+            )
+            if alone:
+                warnings.append(f"flowcell {', '.join(alone)} not used by any other sample")
+
+        results.append(result(alias, forward, reverse, sample_for, problems, warnings))
+
+    return results
+
+
+def result(alias: str, forward: str, reverse: str, sample: dict, problems: list, warnings: list) -> dict:
+    return {
+        "sample_alias": alias,
+        "forward": forward,
+        "reverse": reverse,
+        "records": sample["records"],
+        "lanes": format_lanes(sample["lanes"]),
+        "problems": problems,
+        "warnings": warnings
+    }
+
+
+def format_lanes(lanes: set) -> str:
+    return ",".join(f"{flowcell or '?'}:{lane}" for flowcell, lane in sorted(lanes, key=str)) or "-"
+
+
+@profiling.profiled("quick_check")
+def quick_check(
+    pairs: list,
+    records: int = DEFAULT_RECORDS,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    workers: int = 8
+) -> bool:
+    """
+    Catches mix-ups in the mapping tables (wrong sample_alias for a file, R1
+    and R2 swapped, a file listed twice) from the first reads of every file,
+    without reading the files through: each one costs at most max_bytes of
+    decompressed data, whatever its size.
+    Args:
+        pairs (list): (sample_alias, forward, reverse, experiment_type) tuples,
+                      from paired_check.list_campaign_pairs.
+        records (int): Reads sampled at the start of each file.
+        max_bytes (int): Decompressed bytes read at most per file.
+        workers (int): Files read at the same time.
+    Returns:
+        bool: True if no problem was found (warnings are only printed).
+    """
+    paths = list(dict.fromkeys(path for _, forward, reverse, _ in pairs for path in (forward, reverse)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        samples = dict(zip(paths, pool.map(lambda path: sample_file(path, records, max_bytes), paths)))
+
+    results = check_samples(pairs, samples)
+
+    for check in results:
+        status = "OK" if not check["problems"] else f"[!] {'; '.join(check['problems'])}"
+        print(f"[QUICKCHECK] {check['sample_alias']:<24} {check['lanes']:<28} {status}")
+        for warning in check["warnings"]:
+            print(f"[WARNING] {check['sample_alias']}: {warning}")
+
+    failed = [check for check in results if check["problems"]]
+    print(f"[QUICKCHECK] {len(results) - len(failed)}/{len(results)} pairs consistent "
+          f"(first {records} reads of {len(paths)} files)")
+    events.emit("quick_checked", pairs=len(results), failed=len(failed), files=len(paths))
+
+    return not failed
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Quick check of the read files from their first reads")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    add_pair_arguments(parser)
+    parser.add_argument("-n", "--records",
+                        help="Reads sampled at the start of each file.",
+                        type=int,
+                        default=DEFAULT_RECORDS
+                        )
+    parser.add_argument("--max_bytes",
+                        help="Decompressed bytes read at most per file.",
+                        type=int,
+                        default=DEFAULT_MAX_BYTES
+                        )
+    parser.add_argument("-j", "--workers",
+                        help="Files read at the same time.",
+                        type=int,
+                        default=8
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
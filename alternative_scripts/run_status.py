@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import json
+import time
+import base64
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import events
+import profiling
+import submissions
+
+
+REPORTS_URL = {
+    "production": "https://www.ebi.ac.uk/ena/submit/report/",
+    "test": "https://wwwdev.ebi.ac.uk/ena/submit/report/"
+}
+PAGE_SIZE = 500
+DEFAULT_WORKERS = 4
+# Seconds between two polls with --wait
+DEFAULT_INTERVAL = 300
+MAX_RETRIES = 3
+
+# Processing status of a run in the reports -> final or not
+FINAL_STATUSES = {"COMPLETED", "FAILED", "ERROR", "CANCELLED"}
+FAILED_STATUSES = {"FAILED", "ERROR", "CANCELLED"}
+# Outcome of the reconciliation, the first ones need an action
+ACTION_STATUSES = ("FAILED", "MD5_MISMATCH", "MISSING_FILE")
+
+
+class AuthenticationError(ValueError):
+    pass
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="run_status")
+    events.start(args, command="run_status")
+
+    runs = load_runs(args.metadata_path, partition="test" if args.test else "permanent")
+    if not runs:
+        print(f"[!] No run accession in the object receipt of {args.metadata_path}")
+        sys.exit(1)
+
+    client = ReportsClient(
+        base_url=args.reports_url or REPORTS_URL["test" if args.test else "production"],
+        user_password=args.user_password,
+        cache_path=report_path(args.metadata_path, "ena_reports_cache.json"),
+        workers=args.workers,
+        page_size=args.page_size
+    )
+
+    deadline = time.time() + args.timeout
+    while True:
+        try:
+            results = poll(runs, client)
+        except AuthenticationError as e:
+            print(e)
+            sys.exit(1)
+        pending = [result for result in results if result["status"] == "PENDING"]
+        if not args.wait or not pending or time.time() + args.interval > deadline:
+            break
+        print(f"[STATUS] {len(pending)} runs still processed by ENA, next look in {args.interval:.0f} s")
+        time.sleep(args.interval)
+
+    client.save_cache()
+    output_path = save_results(results, report_path(args.metadata_path, "ena_run_status.csv"))
+    action = print_results(results)
+    print(f"[STATUS][+] Status of {len(runs)} runs written to {output_path}")
+
+    if action:
+        sys.exit(1)
+
+
+def report_path(metadata_path: str, suffix: str) -> str:
+    # WARNING: project name is assumed to be in the first field of the path
+    project_name = os.path.basename(metadata_path).split("_")[0]
+    return os.path.join(os.path.dirname(metadata_path), f"{project_name}_{suffix}")
+
+
+def load_runs(metadata_path: str, partition: str = "permanent") -> dict:
+    """
+    Runs registered by s05 and the files s03 declared for them.
+    Returns:
+        dict: run accession -> {'alias': run alias, 'files': {file name: MD5}}
+    """
+    import bs4 as bs
+
+    receipt_path = submissions.artifact_path(
+        os.path.dirname(metadata_path), os.path.basename(metadata_path).split("_")[0],
+        "ena_object_receipt.xml", partition
+    )
+    with open(receipt_path, mode="r") as handle:
+        receipt = bs.BeautifulSoup(handle, "xml")
+    with open(report_path(metadata_path, "ena_run.xml"), mode="r") as handle:
+        run_xml = bs.BeautifulSoup(handle, "xml")
+
+    files = {}
+    for run in run_xml.find_all("RUN"):
+        files[run.get("alias")] = {
+            os.path.basename(file.get("filename")): file.get("checksum").lower()
+            for file in run.find_all("FILE")
+        }
+
+    runs = {}
+    for run in receipt.find_all("RUN"):
+        if run.get("accession"):
+            runs[run.get("accession")] = {"alias": run.get("alias"), "files": files.get(run.get("alias"), {})}
+
+    return runs
+
+
+class ReportsClient:
+    """
+    Webin reports service: the listings of the account, page after page,
+    with up to workers pages requested at the same time. Each page is
+    requested with the ETag/Last-Modified of the previous poll (cache_path):
+    the unchanged ones come back as 304 Not Modified, without a body.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        user_password: str = None,
+        cache_path: str = None,
+        workers: int = DEFAULT_WORKERS,
+        page_size: int = PAGE_SIZE
+    ):
+        self.base_url = base_url if base_url.endswith("/") else f"{base_url}/"
+        self.headers = {"Accept": "application/json"}
+        if user_password:
+            token = base64.b64encode(user_password.encode()).decode()
+            self.headers["Authorization"] = f"Basic {token}"
+        self.cache_path = cache_path
+        self.workers = workers
+        self.page_size = page_size
+
+        self.cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, mode="r") as handle:
+                self.cache = json.load(handle)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+
+    def get(self, url: str) -> list:
+        headers = dict(self.headers)
+        cached = self.cache.get(url)
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        for attempt in range(MAX_RETRIES + 1):
+            with self.lock:
+                self.requests += 1
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=60) as response:
+                    body = json.loads(response.read() or b"[]")
+                    entry = {
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "body": body
+                    }
+            except urllib.error.HTTPError as e:
+                if e.code == 304 and cached:
+                    with self.lock:
+                        self.not_modified += 1
+                    return cached["body"]
+                if e.code == 404:
+                    # Nothing registered in the listing yet
+                    return []
+                if e.code in (401, 403):
+                    raise AuthenticationError(f"[!] Authentication failed for the reports service (HTTP {e.code}): "
+                                     f"check -u user:password") from None
+                if (e.code == 429 or e.code >= 500) and attempt < MAX_RETRIES:
+                    time.sleep(float(e.headers.get("Retry-After") or 2 ** attempt))
+                    continue
+                raise
+            except urllib.error.URLError:
+                if attempt < MAX_RETRIES:
+                    time.sleep(2 ** attempt)
+                    continue
+                raise
+
+            with self.lock:
+                self.cache[url] = entry
+            return body
+
+    def page_url(self, report: str, offset: int, params: dict) -> str:
+        query = dict(params, format="json", max=self.page_size, offset=offset)
+        return f"{self.base_url}{report}?{urllib.parse.urlencode(query)}"
+
+    def listing(self, report: str, **params) -> list:
+        """
+        All the rows of a listing (run-files, run-processes). The first page
+        comes alone (most campaigns fit in it), then pages are requested
+        workers at a time until one comes back short.
+        Returns:
+            list: The 'report' part of each row.
+        """
+        rows = []
+        offset = 0
+        window = 1
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                urls = [self.page_url(report, offset + i * self.page_size, params) for i in range(window)]
+                pages = list(pool.map(self.get, urls))
+                for page in pages:
+                    rows.extend(item.get("report", item) for item in page)
+                if any(len(page) < self.page_size for page in pages):
+                    return rows
+                offset += window * self.page_size
+                window = self.workers
+
+    def save_cache(self) -> None:
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w") as handle:
+            json.dump(self.cache, handle)
+        os.replace(tmp_path, self.cache_path)
+
+
+@profiling.profiled("run_status")
+def poll(runs: dict, client: ReportsClient) -> list:
+    """
+    Reads the processing status and the archived files of all the runs in
+    two listings and reconciles them with the local MD5s.
+    Returns:
+        list: One dict per file (or per run without file problem): 'run_accession',
+              'run_alias', 'status', 'file', 'local_md5', 'remote_md5', 'detail'.
+    """
+    start_time = time.perf_counter()
+    requests, not_modified = client.requests, client.not_modified
+
+    processes = {}
+    for row in client.listing("run-processes"):
+        run_id = row.get("id") or row.get("runId")
+        if run_id in runs:
+            processes[run_id] = row
+
+    archived = {}
+    for row in client.listing("run-files"):
+        run_id = row.get("runId") or row.get("id")
+        if run_id in runs and row.get("fileName"):
+            archived.setdefault(run_id, {})[os.path.basename(row["fileName"])] = (row.get("md5") or "").lower()
+
+    results = [
+        result
+        for accession, run in runs.items()
+        for result in reconcile(accession, run, processes.get(accession), archived.get(accession, {}))
+    ]
+
+    events.emit("run_status_polled", runs=len(runs), requests=client.requests - requests,
+                not_modified=client.not_modified - not_modified,
+                action=sum(result["status"] in ACTION_STATUSES for result in results),
+                duration_s=time.perf_counter() - start_time)
+
+    return results
+
+
+def reconcile(accession: str, run: dict, process: dict, archived: dict) -> list:
+    def result(status, file=None, local_md5=None, remote_md5=None, detail=None):
+        return {
+            "run_accession": accession,
+            "run_alias": run["alias"],
+            "status": status,
+            "file": file,
+            "local_md5": local_md5,
+            "remote_md5": remote_md5,
+            "detail": detail
+        }
+
+    processing = (process or {}).get("processingStatus", "").upper()
+    if processing in FAILED_STATUSES:
+        return [result("FAILED", detail=process.get("processingError") or processing)]
+
+    problems = []
+    for name, local_md5 in run["files"].items():
+        remote_md5 = archived.get(name)
+        if remote_md5 and remote_md5 != local_md5:
+            problems.append(result("MD5_MISMATCH", name, local_md5, remote_md5,
+                                   "the uploaded file is not the one hashed, upload it again"))
+        elif not remote_md5 and processing in FINAL_STATUSES:
+            problems.append(result("MISSING_FILE", name, local_md5, None, "not in the archived files of the run"))
+
+    if problems:
+        return problems
+    if processing not in FINAL_STATUSES:
+        return [result("PENDING", detail=processing.lower() or "not in the reports yet")]
+
+    return [result("OK")]
+
+
+def save_results(results: list, output_path: str) -> str:
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode="w", newline="") as handle:
+        writer = csv.DictWriter(handle, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+    os.replace(tmp_path, output_path)
+
+    return output_path
+
+
+def print_results(results: list) -> list:
+    # Returns the results needing an action
+    counts = {}
+    for result in results:
+        counts.setdefault(result["status"], set()).add(result["run_accession"])
+    print(f"[STATUS] {', '.join(f'{len(runs)} {status}' for status, runs in sorted(counts.items()))}")
+
+    action = [result for result in results if result["status"] in ACTION_STATUSES]
+    for result in action:
+        file = f" {result['file']}" if result["file"] else ""
+        md5 = f" (local {result['local_md5']}, ENA {result['remote_md5']})" if result["remote_md5"] else ""
+        print(f"[!] {result['run_accession']} {result['run_alias']} {result['status']}{file}{md5}: {result['detail']}")
+
+    return action
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Check the ENA processing of the registered runs and the MD5 of their files")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-i", "--metadata_path",
+                        help="Excel file of the campaign: the object receipt and run XML are next to it.",
+                        type=str,
+                        required=True
+                        )
+    parser.add_argument("-u", "--user_password",
+                        help="User and password of the submission (e.g. user1:password1234), "
+                             "needed by the reports service.",
+                        type=str
+                        )
+    parser.add_argument("--test",
+                        action="store_true",
+                        help="Runs registered in the TEST partition (s05 -x n)."
+                        )
+    parser.add_argument("--reports_url",
+                        help="Base URL of the reports service (default: ENA, production or test).",
+                        type=str
+                        )
+    parser.add_argument("--wait",
+                        action="store_true",
+                        help="Poll again until no run is being processed, or --timeout."
+                        )
+    parser.add_argument("--interval",
+                        help="Seconds between two polls with --wait.",
+                        type=float,
+                        default=DEFAULT_INTERVAL
+                        )
+    parser.add_argument("--timeout",
+                        help="Seconds after which --wait gives up.",
+                        type=float,
+                        default=24 * 3600
+                        )
+    parser.add_argument("-j", "--workers",
+                        help="Pages requested at the same time.",
+                        type=int,
+                        default=DEFAULT_WORKERS
+                        )
+    parser.add_argument("--page_size",
+                        help="Rows per page of the listings.",
+                        type=int,
+                        default=PAGE_SIZE
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,21 +7,39 @@ import hashlib
 import sys
 import argparse
 from datetime import datetime
-import pandas as pd
-import bs4 as bs
 import subprocess
+import time
 
+import metadata_cache
+import events
+import xsd_validation
+import checklist_validation
+import taxonomy
+import profiling
+import submissions
+from metadata_reader import read_metadata, format_dates
 
-def main():
-    args = parse_args()
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="s01_create_samples_xml")
+    events.start(args, command="s01_create_samples_xml")
 
     samples_xml_path = create_samples_file(
         metadata_path=args.metadata_path,
-        template_dir=args.template_dir
+        template_dir=args.template_dir,
+        checklist=None if args.checklist == "none" else args.checklist,
+        taxonomy_index=args.taxonomy_index,
+        fill_taxonomy=args.fill_taxonomy
     )
 
     registrationType = None if args.registration_type == "null" else args.registration_type
 
+    # Malformed XML is refused by ENA only after the upload of the whole set
+    if not args.no_validation and not xsd_validation.validate_files([samples_xml_path]):
+        print('Exiting....')
+        sys.exit(1)
+
     samples_receipt_path = register_samples(
         samples_xml_path=samples_xml_path,
         template_dir=args.template_dir,
@@ -31,6 +49,7 @@ def main():
     )
 
 
+@profiling.profiled("register_samples")
 def register_samples(
                 samples_xml_path: str,
                 template_dir: str,
@@ -56,8 +75,10 @@ def register_samples(
     # WARNING: project name is assumed to be in the first field of the path
     project_name = os.path.basename(samples_xml_path).split("_")[0]
     
-    output_path = os.path.join(os.path.dirname(samples_xml_path),
-                               f"{project_name}_ena_samples_receipt.xml")
+    metadata_dir = os.path.dirname(samples_xml_path)
+    # TEST and permanent receipts side by side, see 'ena.py promote'
+    partition = submissions.get_partition(registration_type)
+    output_path = submissions.artifact_path(metadata_dir, project_name, "ena_samples_receipt.xml", partition)
     
     if os.path.exists(output_path):
         raise FileExistsError(f"Il file '{output_path}' esiste già e non deve essere sovrascritto!")
@@ -70,12 +91,12 @@ def register_samples(
     # --- Validate submission type ---
     normalized = registration_type.lower()
     if normalized in ['y', 'yes']:
-        url_ebi_ac_uk = "https://www.ebi.ac.uk/ena/submit/drop-box/submit/"
+        url_ebi_ac_uk = submissions.SUBMIT_URL["permanent"]
         print('[STEP0][+] Registering to Permanent partition ..')
         permanent = True
 
     elif normalized in ['n','no']:
-        url_ebi_ac_uk = "https://wwwdev.ebi.ac.uk/ena/submit/drop-box/submit/"
+        url_ebi_ac_uk = submissions.SUBMIT_URL["test"]
         print('[STEP0][+] Registering to TEST partition ..')
         permanent = False
 
@@ -101,17 +122,29 @@ def register_samples(
     ]
 
     # Execute the command
+    start_time = time.perf_counter()
+    posted = True
     try:
-        subprocess.run(command, check=True, text=True)
+        with profiling.stage("curl"), events.heartbeat("submission_running", url=url_ebi_ac_uk):
+            subprocess.run(command, check=True, text=True)
         print(f"[+] Samples receipt XML created: {output_path}")
 
     except subprocess.CalledProcessError as e:
         print(f"[!] Error:", {e.stderr})
+        posted = False
+
+    events.emit("submission_posted", url=url_ebi_ac_uk, files=[submission_path, samples_xml_path], receipt=output_path,
+                duration_s=time.perf_counter() - start_time, ok=posted)
 
     message = receipt_output_handling(output_path)
 
     if message['success']:
         print(f"[STEP1][+] Samples receipt saved to: {output_path}")
+        submissions.record_submission(
+            metadata_dir, project_name, "samples", partition, url_ebi_ac_uk,
+            files={"SUBMISSION": submission_path, "SAMPLE": samples_xml_path},
+            receipt_path=output_path
+        )
 
         if permanent:
             print(f"[STEP1][+] Samples registered Permanently")
@@ -137,6 +170,8 @@ def receipt_output_handling(receipt_path: str)-> dict:
             - 'errors' (list of str)
             - 'info' (list of str)
     """
+    import bs4 as bs
+
     with open(receipt_path, 'r', encoding='utf-8') as file:
         content = file.read()
     
@@ -159,12 +194,26 @@ def receipt_output_handling(receipt_path: str)-> dict:
         'info': info
     }
 
+    events.emit("receipt_parsed", path=receipt_path, success=success, errors=errors)
+
     return info_submission
 
 
 ### CREATING SAMPLES XML
-def create_samples_file( metadata_path: str, template_dir: str) -> str:
-    metadata_df = load_metadata(metadata_path)
+@profiling.profiled("create_samples_file")
+def create_samples_file(
+    metadata_path: str,
+    template_dir: str,
+    checklist: str = checklist_validation.DEFAULT_CHECKLIST,
+    taxonomy_index: str = None,
+    fill_taxonomy: bool = False
+) -> str:
+    metadata_df = load_metadata(
+        metadata_path,
+        checklist=checklist,
+        taxonomy_index=taxonomy_index,
+        fill_taxonomy=fill_taxonomy
+    )
 
     template_path = os.path.join(template_dir, "samples.xml")
 
@@ -231,23 +280,70 @@ def create_samples_file( metadata_path: str, template_dir: str) -> str:
     return output_path
 
 
-def load_metadata(metadata_path: str) -> pd.DataFrame:
-    metadata_df = pd.read_excel(metadata_path, sheet_name="sample_submission")
-
-    # Drop first and last empty rows
-    metadata_df = metadata_df.iloc[1:].dropna(subset=["sample_alias"])
+@profiling.profiled("load_metadata")
+def load_metadata(
+    metadata_path: str,
+    checklist: str = checklist_validation.DEFAULT_CHECKLIST,
+    taxonomy_index: str = None,
+    fill_taxonomy: bool = False
+) -> "pd.DataFrame":
+    # Parsing the metadata file is slow, reuse it while the file does not change.
+    # Only metadata that passed these checks is cached, under a key of its own
+    # (not the entry of s02, never checked)
+    variant = validation_variant(checklist, taxonomy_index, fill_taxonomy)
+    metadata_df = metadata_cache.get(metadata_path, variant)
+    if metadata_df is not None:
+        return metadata_df
+
+    metadata_df = read_metadata(metadata_path)
+
+    # Before the checklist, which requires the values filled here
+    if taxonomy_index:
+        index = taxonomy.TaxonomyIndex(taxonomy_index)
+        metadata_df, problems = taxonomy.resolve_taxonomy(metadata_df, index, fill=fill_taxonomy)
+        index.close()
+        if problems:
+            print('\n'.join(f'[!] {problem}' for problem in problems))
+            raise ValueError(f"[!] {metadata_path}: tax_id and scientific_name do not match the taxonomy")
+
+    # Report all the violations before ENA does, one sample at a time
+    if checklist:
+        violations = checklist_validation.validate_metadata(
+            metadata_df,
+            checklist_validation.load_checklist(checklist)
+        )
+        if len(violations):
+            checklist_validation.print_violations(violations, checklist)
+            raise ValueError(f"[!] {metadata_path} does not comply with checklist {checklist}")
 
     # Remove time from the date
-    metadata_df["collection date"] = pd.to_datetime(metadata_df["collection date"])\
-        .dt.strftime("%Y-%m-%d")
+    metadata_df["collection date"] = format_dates(metadata_df["collection date"])
+
+    metadata_cache.put(metadata_path, metadata_df, variant)
 
     return metadata_df
 
 
-def parse_args():
+def validation_variant(checklist: str, taxonomy_index: str, fill_taxonomy: bool) -> str:
+    # Checks of load_metadata, with the version of the taxonomy index used
+    index = ""
+    if taxonomy_index:
+        stat = os.stat(taxonomy_index)
+        index = f"{os.path.realpath(taxonomy_index)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    return f"s01\tchecklist={checklist}\ttaxonomy={index}\tfill={fill_taxonomy}"
+
+
+def parse_args(argv: list = None):
     parser = argparse.ArgumentParser("preprocess_sequences")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-i", "--metadata_path", 
-                        help="Excel file containing the metadata for the sequences.",
+                        help="Metadata of the sequences: ENA spreadsheet (.xlsx) or CSV/TSV/Parquet export.",
                         type=str
                         )
     parser.add_argument("-t", "--template_dir",
@@ -270,8 +366,25 @@ def parse_args():
                         help="User and password for the submission (e.g. user1:password1234).",
                         type=str
     )
-
-    return parser.parse_args()
+    parser.add_argument("-c", "--checklist",
+                        help="ENA checklist the metadata is validated against (data/checklists), 'none' to skip.",
+                        type=str,
+                        default=checklist_validation.DEFAULT_CHECKLIST
+                        )
+    parser.add_argument("--taxonomy_index",
+                        help="Taxonomy index built with 'ena.py taxonomy --build': tax_id and scientific_name are checked against it.",
+                        type=str
+                        )
+    parser.add_argument("--fill_taxonomy",
+                        action="store_true",
+                        help="With --taxonomy_index, fill the missing tax_id or scientific_name instead of reporting them."
+                        )
+    parser.add_argument("--no_validation",
+                        action="store_true",
+                        help="Do not validate the XML files against the ENA schemas before submitting them."
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
 
 
 if __name__ == "__main__":
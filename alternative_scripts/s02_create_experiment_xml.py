@@ -7,13 +7,17 @@ import hashlib
 import sys
 import argparse
 from datetime import datetime
-import pandas as pd
-import bs4 as bs
 import subprocess
 
+import events
+import profiling
+from metadata_reader import load_metadata
 
-def main():
-    args = parse_args()
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="s02_create_experiment_xml")
+    events.start(args, command="s02_create_experiment_xml")
 
     print(f"[INFO] Using 16S forward pattern {args.forward_pattern_16s}")
     print(f"[INFO] Using WGS forward pattern {args.forward_pattern_wgs}")
@@ -33,6 +37,7 @@ def main():
     )
 
 
+@profiling.profiled("create_experiment")
 def create_experiment(
     samples_receipt_path: str,
     metadata_path: str,
@@ -124,7 +129,11 @@ def create_experiment(
     return output_path
 
 
-def parse_samples_receipt(samples_receipt_path: str, metadata_path: str) -> pd.DataFrame:
+@profiling.profiled("parse_samples_receipt")
+def parse_samples_receipt(samples_receipt_path: str, metadata_path: str) -> "pd.DataFrame":
+    import pandas as pd
+    import bs4 as bs
+
     # Programmatically assign study ID
     metadata_df = load_metadata(metadata_path)
 
@@ -152,26 +161,21 @@ def parse_samples_receipt(samples_receipt_path: str, metadata_path: str) -> pd.D
 
         data_df.append(row)
 
-    return pd.concat(data_df)
-
+    events.emit("receipt_parsed", path=samples_receipt_path, samples=len(data_df))
 
-def load_metadata(metadata_path: str) -> pd.DataFrame:
-    metadata_df = pd.read_excel(metadata_path, sheet_name="sample_submission")
+    return pd.concat(data_df)
 
-    # Drop first and last empty rows
-    metadata_df = metadata_df.iloc[1:].dropna(subset=["sample_alias"])
 
-    # Remove time from the date
-    metadata_df["collection date"] = pd.to_datetime(metadata_df["collection date"])\
-        .dt.strftime("%Y-%m-%d")
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("preprocess_sequences")
+    add_arguments(parser)
 
-    return metadata_df
+    return parser.parse_args(argv)
 
 
-def parse_args():
-    parser = argparse.ArgumentParser("preprocess_sequences")
+def add_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-i", "--metadata_path", 
-                        help="Excel file containing the metadata for the sequences.",
+                        help="Metadata of the sequences: ENA spreadsheet (.xlsx) or CSV/TSV/Parquet export.",
                         type=str
                         )
     parser.add_argument("-t", "--template_dir",
@@ -202,8 +206,8 @@ def parse_args():
                         type=str,
                         default="*1.fq.gz"
                         )
-
-    return parser.parse_args()
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
 
 
 if __name__ == "__main__":
@@ -3,17 +3,28 @@
 from typing import List
 import os
 import glob
-import hashlib
 import sys
 import argparse
 from datetime import datetime
-import pandas as pd
-import bs4 as bs
 import subprocess
 
+import events
+import profiling
+from checksum_store import ChecksumStore, default_store_path, read_md5_file, write_md5_file
+from fastq_check import FastqError
+from hash_queue import distribute
+from compress import compressed_checksum, compressed_name, is_compressed
+from dedup import DedupIndex, prefill, check_run_checksums
 
-def main():
-    args = parse_args()
+
+# Checksums computed by s03, next to the provider's MD5.txt which is not rewritten
+MANIFEST_NAME = "s03_MD5.txt"
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="s03_create_run_xml")
+    events.start(args, command="s03_create_run_xml")
 
     print(f"[INFO] Using 16S forward pattern {args.forward_pattern_16s}")
     print(f"[INFO] Using WGS forward pattern {args.forward_pattern_wgs}")
@@ -27,16 +38,29 @@ def main():
         samples_dir=args.samples_dir,
         template_dir=args.template_dir,
         forward_pattern_dict=forward_pattern_dict,
-        experiment_types=args.experiment_types
+        experiment_types=args.experiment_types,
+        checksum_store=args.checksum_store,
+        verify_fastq=args.verify_fastq,
+        hash_queue=args.hash_queue,
+        local_workers=args.local_workers,
+        dedup_index=args.dedup_index,
+        allow_duplicates=args.allow_duplicates
     )
 
 
+@profiling.profiled("create_run")
 def create_run(
     metadata_path: str,
     samples_dir: str,
     template_dir: str,
     forward_pattern_dict: dict,
-    experiment_types: List[str]
+    experiment_types: List[str],
+    checksum_store: str = None,
+    verify_fastq: bool = False,
+    hash_queue: str = None,
+    local_workers: int = 1,
+    dedup_index: str = None,
+    allow_duplicates: bool = False
 ) -> str:
 
     # Raise error if samples directory does not exist
@@ -50,91 +74,105 @@ def create_run(
         template_dir,
         f"run.xml"
     )
+
+    # Checksums already computed by previous runs (or by s04 --overlap)
+    store = ChecksumStore(
+        checksum_store or default_store_path(os.path.dirname(metadata_path))
+    )
+
+    # Corrupt files and files not matching their MD5.txt are collected, the
+    # run XML is written only if there is none
+    bad_files = []
+    mismatched = []
+
+    def checksum(file_path: str) -> str:
+        try:
+            # Uncompressed files are sent gzipped: MD5 of the gzip stream
+            return compressed_checksum(file_path, store, verify_fastq=verify_fastq)
+        except FastqError as e:
+            bad_files.append(str(e))
+            return ""
     
+    read_pairs = {
+        experiment_type: find_read_pairs(
+            samples_dir=samples_dir,
+            experiment_type=experiment_type,
+            forward_pattern=forward_pattern_dict[experiment_type]
+        )
+        for experiment_type in experiment_types
+    }
+
+    # Files already hashed for another campaign (same file, symlinked or listed twice)
+    index = DedupIndex(dedup_index) if dedup_index else None
+    if index is not None:
+        prefill([path for pairs in read_pairs.values() for pair in pairs for path in pair], index, store)
+
+    # Hashed by the nodes sharing the queue, the loop below then reads the store
+    if hash_queue:
+        file_paths = []
+        for experiment_type, pairs in read_pairs.items():
+            for pair in pairs:
+                listed = read_md5_file(os.path.join(os.path.dirname(pair[0]), "MD5.txt")) \
+                    if experiment_type == "WGS" and not verify_fastq else {}
+                file_paths += [
+                    path for path in pair
+                    if is_compressed(path) and os.path.basename(path) not in listed
+                ]
+        distribute(file_paths, hash_queue, store, verify_fastq=verify_fastq, local_workers=local_workers)
+
     run_xml = []
+    run_checksums = {}
 
     for experiment_type in experiment_types:
 
-        if experiment_type == '16S':
-            exp_dir = '16_S'
-        elif experiment_type == 'WGS':
-            exp_dir = 'Metagenomes'
-        
-        forward_pattern = forward_pattern_dict[experiment_type]
-        pattern_for = f"{samples_dir}/{exp_dir}/**/{forward_pattern}"
-
-        exclude_dirs = ['weak_failed','unmerged_lanes','ANT23_raw_sequences']
         print(f'----- Experiment type: {experiment_type} ------')
 
-        for filename_for in glob.glob(pattern_for, recursive=True):
-            
-            name = '_'.join(os.path.basename(filename_for).strip().split('_')[:3])
-            if any(excluded in filename_for for excluded in exclude_dirs):
-                continue
-
-            # Avoid raw reads
-            if "raw" in os.path.basename(filename_for):
-                continue
-
-            # Get reverse file from forward one
-            # WARNING: may generate errors there are multiple "1" in the pattern
-            forward_pattern = forward_pattern.replace("*", "")
-            reverse_pattern = forward_pattern.replace("1", "2")
-            filename_rev = filename_for.replace(
-                forward_pattern,
-                reverse_pattern
-            )
-
-            # Raise error when reverse file does not exist
-            if not os.path.exists(filename_rev):
-                raise ValueError(f"[!] Reverse file not found: {filename_rev}")
-            else:
-                print(filename_for)
+        for filename_for, filename_rev in read_pairs[experiment_type]:
+            print(filename_for)
 
             if experiment_type == "WGS":
-                # Retrieve checksum (MD5.txt)
+                # Retrieve checksum (MD5.txt of the delivery or written by ingest), by file name
                 checksum_path = os.path.join(
                     os.path.dirname(filename_for),
                     f"MD5.txt"
                 )
-                try:
-                    if checksum_path:
-                        
-                        with open(checksum_path, mode="r") as reader:
-                            lines = reader.readlines()
-                            print(lines)
-                            # WARNING: assuming for and rev are in the 1st and 2nd lines
-                            hash_for = lines[0].split(" ")[0]
-                            hash_rev = lines[1].split(" ")[0]
-                    else:
-                        raise FileNotFoundError
-
-                except (FileNotFoundError):
-
-                    hash_for = hashlib.md5(open(filename_for, mode="rb").read())\
-                        .hexdigest()
-                    hash_rev = hashlib.md5(open(filename_rev, mode="rb").read())\
-                         .hexdigest()
-                    checksum_file = os.path.join(
-                        os.path.dirname(filename_for),
-                        f'MD5.txt'
-                        )
-                    with open(checksum_file, mode='w') as writer:
-                        writer.write(f"{hash_for} {os.path.basename(filename_for)}\n")
-                        writer.write(f"{hash_rev} {os.path.basename(filename_rev)}\n")
+                checksums = read_md5_file(checksum_path)
+                hash_for = checksums.get(os.path.basename(compressed_name(filename_for)))
+                hash_rev = checksums.get(os.path.basename(compressed_name(filename_rev)))
+
+                if hash_for and hash_rev:
+                    # The files are read anyway to be checked, against MD5.txt too
+                    if verify_fastq:
+                        for file_path, listed in ((filename_for, hash_for), (filename_rev, hash_rev)):
+                            computed = checksum(file_path)
+                            if computed and computed != listed.lower():
+                                mismatched.append(f"[!] {file_path}: MD5 {computed}, "
+                                                  f"{listed} in {checksum_path}")
+                else:
+                    hash_for = hash_for or checksum(filename_for)
+                    hash_rev = hash_rev or checksum(filename_rev)
+
+                    # Own manifest, the provider's MD5.txt stays as delivered
+                    if hash_for and hash_rev:
+                        manifest_path = os.path.join(os.path.dirname(filename_for), MANIFEST_NAME)
+                        computed = read_md5_file(manifest_path) if os.path.exists(manifest_path) else {}
+                        computed[os.path.basename(compressed_name(filename_for))] = hash_for
+                        computed[os.path.basename(compressed_name(filename_rev))] = hash_rev
+                        write_md5_file(manifest_path, computed)
 
             elif experiment_type == "16S":
                 # Compute the checksum (MD5)
-                hash_for = hashlib.md5(open(filename_for, mode="rb").read())\
-                    .hexdigest()
-                hash_rev = hashlib.md5(open(filename_rev, mode="rb").read())\
-                    .hexdigest()
+                hash_for = checksum(filename_for)
+                hash_rev = checksum(filename_rev)
 
             else:
                 raise NotImplementedError(
                     f"[ERROR] Experiment {experiment_type} is not supported!"
                 )
 
+            run_checksums[filename_for] = hash_for
+            run_checksums[filename_rev] = hash_rev
+
             with open(template_path, mode="r") as handle:
                 template_xml = handle.read()
 
@@ -144,8 +182,8 @@ def create_run(
             exp_alias = f"{project_name}-{sample_alias}-{experiment_type}"
 
             # Add only the filename instead of the whole path
-            filename_for = os.path.basename(filename_for)
-            filename_rev = os.path.basename(filename_rev)
+            filename_for = os.path.basename(compressed_name(filename_for))
+            filename_rev = os.path.basename(compressed_name(filename_rev))
 
             template_xml = template_xml\
                 .replace("$$$EXPERIMENT_ALIAS$$$",  exp_alias)\
@@ -156,6 +194,19 @@ def create_run(
 
             run_xml += [template_xml]
 
+    if bad_files:
+        store.close()
+        print('\n'.join(bad_files + mismatched))
+        raise FastqError(f"[!] {len(bad_files)} corrupt or truncated FASTQ files, run XML not written")
+    if mismatched:
+        store.close()
+        print('\n'.join(mismatched))
+        raise ValueError(f"[!] {len(mismatched)} files do not match their MD5.txt, run XML not written")
+
+    if index is not None:
+        check_run_checksums(run_checksums, index, store, os.path.dirname(os.path.abspath(metadata_path)),
+                            allow_duplicates)
+
     run_xml = \
         '<?xml version="1.0" encoding="UTF-8"?>' + "\n" + \
         "<RUN_SET>" + "\n" + \
@@ -169,13 +220,80 @@ def create_run(
     with open(output_path, mode="w") as handle:
         handle.write(run_xml)
 
+    store.close()
+
     print(f"[STEP1][+] Run XML saved to:         {output_path}")
 
     return output_path
 
 
-def parse_args():
+@profiling.profiled("find_read_pairs")
+def find_read_pairs(
+    samples_dir: str,
+    experiment_type: str,
+    forward_pattern: str
+) -> List[tuple]:
+    """
+    Globs the forward reads of an experiment and pairs them with their reverse.
+    Args:
+        samples_dir (str): Directory containing the 16_S and Metagenomes folders.
+        experiment_type (str): Either 16S or WGS.
+        forward_pattern (str): Glob pattern of the forward files (e.g. *1.fq.gz).
+    Returns:
+        list: (forward, reverse) paths, in glob order.
+    """
+    if experiment_type == '16S':
+        exp_dir = '16_S'
+    elif experiment_type == 'WGS':
+        exp_dir = 'Metagenomes'
+    else:
+        raise NotImplementedError(
+            f"[ERROR] Experiment {experiment_type} is not supported!"
+        )
+
+    pattern_for = f"{samples_dir}/{exp_dir}/**/{forward_pattern}"
+
+    exclude_dirs = ['weak_failed','unmerged_lanes','ANT23_raw_sequences']
+
+    read_pairs = []
+    for filename_for in glob.glob(pattern_for, recursive=True):
+
+        if any(excluded in filename_for for excluded in exclude_dirs):
+            continue
+
+        # Avoid raw reads
+        if "raw" in os.path.basename(filename_for):
+            continue
+
+        # Get reverse file from forward one
+        # WARNING: may generate errors there are multiple "1" in the pattern
+        forward_suffix = forward_pattern.replace("*", "")
+        reverse_suffix = forward_suffix.replace("1", "2")
+        filename_rev = filename_for.replace(
+            forward_suffix,
+            reverse_suffix
+        )
+
+        # Raise error when reverse file does not exist
+        if not os.path.exists(filename_rev):
+            raise ValueError(f"[!] Reverse file not found: {filename_rev}")
+
+        read_pairs.append((filename_for, filename_rev))
+
+        for filename in (filename_for, filename_rev):
+            events.file_discovered(filename, experiment_type=experiment_type)
+
+    return read_pairs
+
+
+def parse_args(argv: list = None):
     parser = argparse.ArgumentParser("preprocess_sequences")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-i", "--metadata_path", 
                         help="Excel file containing the metadata for the sequences.",
                         type=str
@@ -216,8 +334,33 @@ def parse_args():
                         help="XML File obtained from the s01 script.",
                         type=str    
                         )
-
-    return parser.parse_args()
+    parser.add_argument("--checksum_store",
+                        help="SQLite file caching the checksums (default: ena_checksums.sqlite next to the metadata).",
+                        type=str
+                        )
+    parser.add_argument("--verify_fastq",
+                        action="store_true",
+                        help="While hashing, also check the gzip CRC/size and the FASTQ records of every file."
+                        )
+    parser.add_argument("--hash_queue",
+                        help="Folder on a shared file system: the files are hashed by 'ena.py hash-worker' on any node.",
+                        type=str
+                        )
+    parser.add_argument("--local_workers",
+                        help="Files hashed by this run itself while waiting for the queue (0: only wait).",
+                        type=int,
+                        default=1
+                        )
+    parser.add_argument("--dedup_index",
+                        help="Index of the files of all campaigns ('ena.py dedup'): report the files already known or registered.",
+                        type=str
+                        )
+    parser.add_argument("--allow_duplicates",
+                        action="store_true",
+                        help="Write the run XML even if files are already registered in runs of other campaigns."
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
 
 
 if __name__ == "__main__":
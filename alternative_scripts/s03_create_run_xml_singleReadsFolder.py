@@ -3,17 +3,24 @@
 from typing import List
 import os
 import glob
-import hashlib
 import sys
 import argparse
 from datetime import datetime
-import pandas as pd
-import bs4 as bs
 import subprocess
 
+import events
+import profiling
+from checksum_store import ChecksumStore, default_store_path, read_md5_file
+from fastq_check import FastqError
+from hash_queue import distribute
+from compress import compressed_checksum, compressed_name, is_compressed
+from dedup import DedupIndex, prefill, check_run_checksums
 
-def main():
-    args = parse_args()
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="s03_create_run_xml_singleReadsFolder")
+    events.start(args, command="s03_create_run_xml_singleReadsFolder")
 
     run_path = create_run(
         metadata_path=args.metadata_path,
@@ -24,10 +31,17 @@ def main():
         AMP_samples_dir=args.AMP_samples_dir,
 
         mapping_WGS=args.mapping_WGS,
-        mapping_AMP=args.mapping_AMP
+        mapping_AMP=args.mapping_AMP,
+        checksum_store=args.checksum_store,
+        verify_fastq=args.verify_fastq,
+        hash_queue=args.hash_queue,
+        local_workers=args.local_workers,
+        dedup_index=args.dedup_index,
+        allow_duplicates=args.allow_duplicates
     )
 
 
+@profiling.profiled("create_run")
 def create_run(
     metadata_path: str,
     template_dir: str,
@@ -35,9 +49,17 @@ def create_run(
     WGS_samples_dir: str,
     AMP_samples_dir: str,
     mapping_WGS,
-    mapping_AMP
+    mapping_AMP,
+    checksum_store: str = None,
+    verify_fastq: bool = False,
+    hash_queue: str = None,
+    local_workers: int = 1,
+    dedup_index: str = None,
+    allow_duplicates: bool = False
 ) -> str:
 
+    import pandas as pd
+
     # Raise error if samples directory does not exist
     if WGS_samples_dir and not os.path.exists(WGS_samples_dir):
         raise FileNotFoundError(f"{WGS_samples_dir} does not exist!")
@@ -45,6 +67,10 @@ def create_run(
     if AMP_samples_dir and not os.path.exists(AMP_samples_dir):
         raise FileNotFoundError(f"{AMP_samples_dir} does not exist!")
 
+    # The names of the tables are relative to the samples directory, as for s04 (with or without a trailing /)
+    WGS_samples_dir = os.path.abspath(WGS_samples_dir) if WGS_samples_dir else WGS_samples_dir
+    AMP_samples_dir = os.path.abspath(AMP_samples_dir) if AMP_samples_dir else AMP_samples_dir
+
     # WARNING: project name is assumed to be in the first field of the path
     project_name = os.path.basename(metadata_path).split("_")[0]
 
@@ -52,8 +78,50 @@ def create_run(
         template_dir,
         f"run.xml"
     )
+
+    # Checksums already computed by previous runs (or by s04 --overlap)
+    store = ChecksumStore(
+        checksum_store or default_store_path(os.path.dirname(metadata_path))
+    )
+
+    # Corrupt files and files not matching their MD5.txt are collected, the
+    # run XML is written only if there is none
+    bad_files = []
+    mismatched = []
+
+    def checksum(file_path: str) -> str:
+        try:
+            # Uncompressed files are sent gzipped: MD5 of the gzip stream
+            return compressed_checksum(file_path, store, verify_fastq=verify_fastq)
+        except FastqError as e:
+            bad_files.append(str(e))
+            return ""
     
+    # Files of the tables, and those to hash (no checksum in MD5.txt)
+    file_paths = []
+    to_hash = []
+    if hash_queue or dedup_index:
+        for experiment_type in experiment_types:
+            exp_dir, mapping = (AMP_samples_dir, mapping_AMP) if experiment_type == '16S' \
+                else (WGS_samples_dir, mapping_WGS)
+            listed = {} if verify_fastq else read_md5_file(os.path.join(exp_dir, "MD5.txt"))
+            for row in pd.read_csv(mapping, sep="\t").itertuples():
+                for name in (row.forward, row.reverse):
+                    file_paths.append(os.path.join(exp_dir, name))
+                    if is_compressed(name) and os.path.basename(name) not in listed:
+                        to_hash.append(file_paths[-1])
+
+    # Files already hashed for another campaign (same file, symlinked or listed twice)
+    index = DedupIndex(dedup_index) if dedup_index else None
+    if index is not None:
+        prefill(file_paths, index, store)
+
+    # Hashed by the nodes sharing the queue, the loop below then reads the store
+    if hash_queue:
+        distribute(to_hash, hash_queue, store, verify_fastq=verify_fastq, local_workers=local_workers)
+
     run_xml = []
+    run_checksums = {}
     for experiment_type in experiment_types:
         if experiment_type == '16S':
             exp_dir = AMP_samples_dir
@@ -63,35 +131,37 @@ def create_run(
             table_mapping = pd.read_csv(mapping_WGS, sep="\t")
         
         for row in table_mapping.itertuples():
-            # Retrieve checksum (MD5.txt)
-            checksum_path = os.path.join(os.path.dirname(exp_dir), f"MD5.txt")
-            try:
-                if checksum_path:
-                    print("MD5.txt ESISTE!!!!")
-                    with open(checksum_path, mode="r") as file:
-                        for line in file:
-                            if row.sample_alias in line and row.forward in line:
-                                hash_for = line.split(" ")[0]
-                            elif row.sample_alias in line and row.reverse in line:
-                                hash_rev = line.split(" ")[0]
-                else:
-                    raise FileNotFoundError
-
-            except (FileNotFoundError):
-                r1= os.path.join(os.path.dirname(exp_dir), row.forward)
-                r2= os.path.join(os.path.dirname(exp_dir), row.reverse)
-
-                hash_for = hashlib.md5(open(r1, mode="rb").read())\
-                    .hexdigest()
-                hash_rev = hashlib.md5(open(r2, mode="rb").read())\
-                        .hexdigest()
-                
-                checksum_file = os.path.join(os.path.dirname(exp_dir), 
-                                             f"{row.sample_alias}_MD5.txt")
-                
-                with open(checksum_file, mode='w') as writer:
-                    writer.write(f"{hash_for} {row.forward}\n")
-                    writer.write(f"{hash_rev} {row.reverse}\n")
+            # Retrieve checksum (MD5.txt of the delivery or written by ingest), by file name
+            checksum_path = os.path.join(exp_dir, f"MD5.txt")
+            checksums = read_md5_file(checksum_path)
+            # Names at ENA: uncompressed files are sent as <name>.gz
+            forward, reverse = compressed_name(row.forward), compressed_name(row.reverse)
+            hash_for = checksums.get(os.path.basename(forward))
+            hash_rev = checksums.get(os.path.basename(reverse))
+
+            r1 = os.path.join(exp_dir, row.forward)
+            r2 = os.path.join(exp_dir, row.reverse)
+            if hash_for and hash_rev:
+                # The files are read anyway to be checked, against MD5.txt too
+                if verify_fastq:
+                    for file_path, listed in ((r1, hash_for), (r2, hash_rev)):
+                        computed = checksum(file_path)
+                        if computed and computed != listed.lower():
+                            mismatched.append(f"[!] {file_path}: MD5 {computed}, {listed} in {checksum_path}")
+            else:
+                hash_for = hash_for or checksum(r1)
+                hash_rev = hash_rev or checksum(r2)
+
+                # A corrupt file has no checksum (the run fails below), nothing to write
+                if hash_for and hash_rev:
+                    checksum_file = os.path.join(exp_dir, f"{row.sample_alias}_MD5.txt")
+
+                    with open(checksum_file, mode='w') as writer:
+                        writer.write(f"{hash_for} {forward}\n")
+                        writer.write(f"{hash_rev} {reverse}\n")
+
+            run_checksums[r1] = hash_for
+            run_checksums[r2] = hash_rev
 
             with open(template_path, mode="r") as handle:
                 template_xml = handle.read()
@@ -102,13 +172,26 @@ def create_run(
 
             template_xml = template_xml\
                 .replace("$$$EXPERIMENT_ALIAS$$$",  exp_alias)\
-                .replace("$$$FORWARD_R1_FASTQ$$$",  row.forward)\
+                .replace("$$$FORWARD_R1_FASTQ$$$",  forward)\
                 .replace("$$$FORWARD_R1_MD5SUM$$$", hash_for)\
-                .replace("$$$REVERSE_R2_FASTQ$$$",  row.reverse)\
+                .replace("$$$REVERSE_R2_FASTQ$$$",  reverse)\
                 .replace("$$$REVERSE_R2_MD5SUM$$$", hash_rev)
 
             run_xml += [template_xml]
 
+    if bad_files:
+        store.close()
+        print('\n'.join(bad_files + mismatched))
+        raise FastqError(f"[!] {len(bad_files)} corrupt or truncated FASTQ files, run XML not written")
+    if mismatched:
+        store.close()
+        print('\n'.join(mismatched))
+        raise ValueError(f"[!] {len(mismatched)} files do not match their MD5.txt, run XML not written")
+
+    if index is not None:
+        check_run_checksums(run_checksums, index, store, os.path.dirname(os.path.abspath(metadata_path)),
+                            allow_duplicates)
+
     run_xml = \
         '<?xml version="1.0" encoding="UTF-8"?>' + "\n" + \
         "<RUN_SET>" + "\n" + \
@@ -122,13 +205,21 @@ def create_run(
     with open(output_path, mode="w") as handle:
         handle.write(run_xml)
 
+    store.close()
+
     print(f"[STEP1][+] Run XML saved to:         {output_path}")
 
     return output_path
 
 
-def parse_args():
+def parse_args(argv: list = None):
     parser = argparse.ArgumentParser("preprocess_sequences")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-i", "--metadata_path", 
                         help="Excel file containing the metadata for the sequences.",
                         type=str
@@ -160,8 +251,33 @@ def parse_args():
                         help="XML File obtained from the s01 script.",
                         type=str    
                         )
-
-    return parser.parse_args()
+    parser.add_argument("--checksum_store",
+                        help="SQLite file caching the checksums (default: ena_checksums.sqlite next to the metadata).",
+                        type=str
+                        )
+    parser.add_argument("--verify_fastq",
+                        action="store_true",
+                        help="While hashing, also check the gzip CRC/size and the FASTQ records of every file."
+                        )
+    parser.add_argument("--hash_queue",
+                        help="Folder on a shared file system: the files are hashed by 'ena.py hash-worker' on any node.",
+                        type=str
+                        )
+    parser.add_argument("--local_workers",
+                        help="Files hashed by this run itself while waiting for the queue (0: only wait).",
+                        type=int,
+                        default=1
+                        )
+    parser.add_argument("--dedup_index",
+                        help="Index of the files of all campaigns ('ena.py dedup'): report the files already known or registered.",
+                        type=str
+                        )
+    parser.add_argument("--allow_duplicates",
+                        action="store_true",
+                        help="Write the run XML even if files are already registered in runs of other campaigns."
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
 
 
 if __name__ == "__main__":
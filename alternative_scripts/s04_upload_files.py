@@ -1,31 +1,122 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import csv
 import argparse
-import pandas as pd
 import subprocess
 import time
 
+import events
+import profiling
+import io_engine
+from checksum_store import default_store_path, record_throughput, UPLOAD_TARGET
+from compress import compress_upload_files, is_compressed
+from dedup import skip_registered
+from bandwidth import scheduled_upload
 
-def main():
-    args = parse_args()
 
-    file_list = gather_files(
-        experiment_type = args.experiment_type,
-        WGS_samples_dir = args.WGS_samples_dir,
-        AMP_samples_dir = args.AMP_samples_dir,
-        mapping_WGS = args.mapping_WGS,
-        mapping_AMP = args.mapping_AMP
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="s04_upload_files")
+    events.start(args, command="s04_upload_files")
+
+    # All the experiment types and tables in one plan, sent through one session
+    file_list = gather_plan(
+        experiment_types=args.experiment_type,
+        WGS_samples_dir=args.WGS_samples_dir,
+        AMP_samples_dir=args.AMP_samples_dir,
+        mapping_WGS=args.mapping_WGS,
+        mapping_AMP=args.mapping_AMP
     )
 
-    upload_files(
-        file_list=file_list,
-        username = args.username,
-        interactive=args.interactive,
-        dry_run=args.dry_run
+    mapping_path = (args.mapping_WGS if args.experiment_type[0] == "WGS" else args.mapping_AMP)[0]
+    checksum_store = args.checksum_store or default_store_path(
+        os.path.dirname(os.path.abspath(mapping_path))
     )
 
+    # Content already registered by another campaign is not sent again
+    if args.dedup_index:
+        file_list = skip_registered(
+            file_list,
+            index_path=args.dedup_index,
+            checksum_store=checksum_store,
+            campaign=os.path.dirname(os.path.abspath(mapping_path)),
+            allow_duplicates=args.allow_duplicates
+        )
+
+    # Uncompressed FASTQ files are gzipped on the fly while they are sent
+    uncompressed = [path for path in file_list if not is_compressed(path)]
+    if uncompressed:
+        compressed = compress_upload_files(
+            file_list=uncompressed,
+            username=args.username,
+            checksum_store=checksum_store,
+            dry_run=args.dry_run
+        )
+        if not compressed:
+            print("[!] Some uncompressed files were not sent, run s04 again to send them")
+            print('Exiting....')
+            sys.exit(1)
+        file_list = [path for path in file_list if is_compressed(path)]
+        if not file_list:
+            return
+
+    if args.overlap:
+        # Imported here: the module imports this script for upload_file
+        from hash_upload import hash_and_upload
+
+        results = hash_and_upload(
+            file_list=file_list,
+            username=args.username,
+            checksum_store=checksum_store,
+            hash_workers=args.hash_workers,
+            upload_workers=args.upload_workers,
+            queue_size=args.queue_size,
+            dry_run=args.dry_run
+        )
+        if results["failed"]:
+            exit_not_uploaded(results["failed"])
+        return
+
+    total_bytes = sum(os.path.getsize(path) for path in file_list)
+    start_time = time.perf_counter()
+    if args.rate_cap or args.rate_schedule or args.adaptive:
+        uploaded = scheduled_upload(
+            file_list=file_list,
+            username=args.username,
+            rate_cap=args.rate_cap,
+            rate_schedule=args.rate_schedule,
+            max_workers=args.upload_workers,
+            adaptive=args.adaptive,
+            dry_run=args.dry_run
+        )
+    else:
+        uploaded = upload_files(
+            file_list=file_list,
+            username = args.username,
+            interactive=args.interactive,
+            dry_run=args.dry_run,
+            parallel=args.upload_workers
+        )
+
+    # Speed of the uplink, for 'ena.py plan'
+    if uploaded:
+        record_throughput(checksum_store, "upload", UPLOAD_TARGET, total_bytes,
+                          time.perf_counter() - start_time, args.upload_workers)
+    elif not args.dry_run:
+        # The scheduler lists its failed files; which files of a single lftp session made it is not known
+        exit_not_uploaded([] if args.rate_cap or args.rate_schedule or args.adaptive else file_list)
+
 
+def exit_not_uploaded(file_list: list) -> None:
+    print('\n'.join(f"[!] Not uploaded: {path}" for path in file_list))
+    print("[!] Run s04 again to send them, lftp continues the partial files")
+    print('Exiting....')
+    sys.exit(1)
+
+
+@profiling.profiled("gather_files")
 def gather_files(experiment_type: str, 
            WGS_samples_dir: str,
            AMP_samples_dir: str,
@@ -41,15 +132,19 @@ def gather_files(experiment_type: str,
 
     if experiment_type == '16S':
         exp_dir = os.path.abspath(AMP_samples_dir)
-        table_mapping = pd.read_csv(mapping_AMP, sep="\t")
+        mapping_path = mapping_AMP
     elif experiment_type == 'WGS':
         exp_dir = os.path.abspath(WGS_samples_dir)
-        table_mapping = pd.read_csv(mapping_WGS, sep="\t")
+        mapping_path = mapping_WGS
+
+    # Plain csv module: the table has a handful of columns, no need for pandas
+    with open(mapping_path, mode="r", newline="") as handle:
+        table_mapping = list(csv.DictReader(handle, delimiter="\t"))
 
     all_files = []
-    for i in table_mapping.itertuples():
-        r1 = os.path.join(str(exp_dir), i.forward)
-        r2 = os.path.join(str(exp_dir), i.reverse)
+    for i in table_mapping:
+        r1 = os.path.join(str(exp_dir), i["forward"])
+        r2 = os.path.join(str(exp_dir), i["reverse"])
  
         all_files.append(r1)
         all_files.append(r2)
@@ -60,10 +155,71 @@ def gather_files(experiment_type: str,
         print(f"- {r1} ---- ({size_for:.2f} MB)")
         print(f"- {r2} ---- ({size_rev:.2f} MB)")
 
+        for filename in (r1, r2):
+            events.file_discovered(filename, experiment_type=experiment_type)
+
     return all_files
 
 
-def upload_files(file_list: list, username: str,  interactive: bool, dry_run)-> None:
+def gather_plan(experiment_types: list,
+                WGS_samples_dir: str,
+                AMP_samples_dir: str,
+                mapping_WGS: list,
+                mapping_AMP: list) -> list:
+    """
+    Files of all the mapping tables of all the experiment types, as one
+    upload plan (see plan_uploads).
+    """
+    file_list = []
+    for experiment_type in experiment_types:
+        mapping_paths = mapping_WGS if experiment_type == "WGS" else mapping_AMP
+        if not mapping_paths:
+            raise ValueError(f"[!] No mapping table for {experiment_type} (-m for WGS, -k for 16S)")
+
+        for mapping_path in mapping_paths:
+            file_list += gather_files(
+                experiment_type=experiment_type,
+                WGS_samples_dir=WGS_samples_dir,
+                AMP_samples_dir=AMP_samples_dir,
+                mapping_WGS=mapping_path,
+                mapping_AMP=mapping_path
+            )
+
+    return plan_uploads(file_list)
+
+
+def plan_uploads(file_list: list) -> list:
+    """
+    Orders the files of one upload session: each file once, even when several
+    tables (or a symlink) list it, largest first so that the small amplicon
+    files fill the connections freed by the last large WGS transfers.
+    Two different files with the same name would overwrite each other in the
+    upload area: that is an error.
+    """
+    plan = {}
+    names = {}
+    for file_path in file_list:
+        real_path = os.path.realpath(file_path)
+        if real_path in plan:
+            continue
+
+        name = os.path.basename(file_path)
+        if name in names:
+            raise ValueError(f"[!] {file_path} and {names[name]} would both be uploaded as {name}")
+        names[name] = file_path
+        plan[real_path] = (os.path.getsize(real_path), file_path)
+
+    ordered = [file_path for _, file_path in sorted(plan.values(), key=lambda item: -item[0])]
+    duplicates = len(file_list) - len(ordered)
+    total_bytes = sum(size for size, _ in plan.values())
+    print(f"[UPLOAD] {len(ordered)} files ({total_bytes / 1e9:.2f} GB) in one session"
+          + (f", {duplicates} listed twice" if duplicates else ""))
+
+    return ordered
+
+
+@profiling.profiled("upload")
+def upload_files(file_list: list, username: str,  interactive: bool, dry_run, parallel: int = 1)-> bool:
     # NOTE: ftp will ask for each file confirmation, to disable interactive
     # mode, issue the prompt command or use -i flag in ftp command. Save
     # credentials in netrc file
@@ -71,7 +227,9 @@ def upload_files(file_list: list, username: str,  interactive: bool, dry_run)->
         mput_command =  "mput "+ " ".join(file_list) + "; bye"
 
     else:
-        mput_command = "mput -c " + " ".join(file_list) + "; bye"
+        # One login, parallel files on the connections of the same session
+        options = f"-c -P {parallel}" if parallel > 1 else "-c"
+        mput_command = f"mput {options} " + " ".join(file_list) + "; bye"
 
     ftp_connection = [
         "lftp",
@@ -80,13 +238,21 @@ def upload_files(file_list: list, username: str,  interactive: bool, dry_run)->
     ]
     
     start_time = time.time() 
+    uploaded = False
+    total_bytes = sum(os.path.getsize(path) for path in file_list)
 
     try:
         print('Uploading ...')
         if dry_run:
             print(ftp_connection)
         else:
-            subprocess.run(ftp_connection, check=True, text=True)
+            events.emit("upload_started", files=len(file_list), bytes=total_bytes)
+            with events.heartbeat("upload_running", files=len(file_list), bytes=total_bytes):
+                subprocess.run(ftp_connection, check=True, text=True)
+            uploaded = True
+            # Sent: not worth keeping in the page cache of a shared node
+            for file_path in file_list:
+                io_engine.drop_cache(file_path)
         
         print(f"First commmand run")
 
@@ -96,6 +262,10 @@ def upload_files(file_list: list, username: str,  interactive: bool, dry_run)->
     end_time = time.time()  # Record end time
     elapsed_time = end_time - start_time  # Compute duration
 
+    if not dry_run:
+        events.emit("upload_finished", files=len(file_list), bytes=total_bytes,
+                    duration_s=elapsed_time, ok=uploaded)
+
     hours = int(elapsed_time // 3600)
     minutes = int((elapsed_time % 3600) // 60)
     seconds = elapsed_time % 60
@@ -104,16 +274,65 @@ def upload_files(file_list: list, username: str,  interactive: bool, dry_run)->
     print(f"End Time: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time))}")
     print(f"Total Duration: {hours}h {minutes}m {seconds:.2f}s")
     
-    return None
+    return uploaded
 
 
-def parse_args():
+@profiling.profiled("upload")
+def upload_file(file_path: str, username: str, dry_run: bool) -> bool:
+    # One lftp session per file, so that several workers can upload at once
+    ftp_connection = [
+        "lftp",
+        f"{username}@webin2.ebi.ac.uk",
+        "-e", f'put -c "{file_path}"; bye'
+    ]
+
+    if dry_run:
+        print(ftp_connection)
+        return False
+
+    size = os.path.getsize(file_path)
+    events.emit("upload_started", path=file_path, bytes=size)
+    start_time = time.perf_counter()
+    uploaded = True
+
+    try:
+        with events.heartbeat("upload_running", path=file_path, bytes=size):
+            subprocess.run(ftp_connection, check=True, text=True)
+
+    except subprocess.CalledProcessError as e:
+        print(f"[!] Upload failed for {file_path}:", {e.stderr})
+        uploaded = False
+
+    if uploaded:
+        io_engine.drop_cache(file_path)
+
+    events.emit("upload_finished", path=file_path, bytes=size,
+                duration_s=time.perf_counter() - start_time, ok=uploaded)
+
+    return uploaded
+
+
+def experiment_types(text: str) -> list:
+    types = [s.strip() for s in text.split(",")]
+    unknown = [t for t in types if t not in ("16S", "WGS")]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown experiment type {', '.join(unknown)} (16S, WGS)")
+
+    return types
+
+
+def parse_args(argv: list = None):
     parser = argparse.ArgumentParser("Uploading raw sequences")
-    
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-e", "--experiment_type",
-                        help="Either 16S or metagenomics.",
-                        type=str,
-                        choices=["WGS", "16S"]
+                        help="16S, WGS or both (16S,WGS): all uploaded in one session.",
+                        type=experiment_types,
+                        required=True
     )
     parser.add_argument("-w", "--WGS_samples_dir",
                         help="Directory containing the sequences to submit.",
@@ -124,11 +343,13 @@ def parse_args():
                         type=str
                         )
     parser.add_argument("-m", "--mapping_WGS",
-                        help="Table containing rawreads filename (forward and reverse) and sample_alias for WGS",
-                        type=str,)
+                        help="Tables containing rawreads filename (forward and reverse) and sample_alias for WGS",
+                        type=str,
+                        nargs="+")
     parser.add_argument("-k", "--mapping_AMP",
-                        help="Table containing rawreads filename (forward and reverse) and sample_alias for AMPLICON",
-                        type=str,)
+                        help="Tables containing rawreads filename (forward and reverse) and sample_alias for AMPLICON",
+                        type=str,
+                        nargs="+")
     parser.add_argument("-u", "--username",
                         help="Username for the submission.",
                         type=str
@@ -140,8 +361,45 @@ def parse_args():
     )
     parser.add_argument("--dry_run", action='store_true',
                         help="Execute a dry_run with only printing the command")
-    
-    return parser.parse_args()
+    parser.add_argument("--overlap", action='store_true',
+                        help="Compute the checksums while uploading: each file is sent as soon as it is hashed.")
+    parser.add_argument("--hash_workers",
+                        help="Files hashed at the same time (only with --overlap).",
+                        type=int,
+                        default=2
+    )
+    parser.add_argument("--upload_workers",
+                        help="Files uploaded at the same time (parallel transfers of the session, at most with --adaptive).",
+                        type=int,
+                        default=4
+    )
+    parser.add_argument("--queue_size",
+                        help="Hashed files waiting for an upload worker before hashing pauses (only with --overlap).",
+                        type=int,
+                        default=8
+    )
+    parser.add_argument("--checksum_store",
+                        help="SQLite file caching the checksums (default: ena_checksums.sqlite next to the mapping table).",
+                        type=str
+    )
+    parser.add_argument("--dedup_index",
+                        help="Index of the files of all campaigns ('ena.py dedup'): files already registered are not sent.",
+                        type=str
+    )
+    parser.add_argument("--allow_duplicates", action='store_true',
+                        help="Send the files even if they are already registered in runs of other campaigns.")
+    parser.add_argument("--rate_cap",
+                        help="Upload rate shared by all transfers, e.g. 20M (bytes per second).",
+                        type=str
+    )
+    parser.add_argument("--rate_schedule",
+                        help="Rate caps by time of day, e.g. '08:00-19:00=20M,19:00-08:00=0' (--rate_cap elsewhere).",
+                        type=str
+    )
+    parser.add_argument("--adaptive", action='store_true',
+                        help="Adapt the number of transfers to the throughput, up to --upload_workers.")
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
 
 
 if __name__ == "__main__":
@@ -4,16 +4,34 @@ import argparse
 import os
 import csv
 import subprocess
-import bs4 as bs
 import sys 
-import pandas as pd
+import time
 
+import events
+import xsd_validation
+import profiling
+import submissions
 
-def main():
-    args = parse_args()
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="s05_register_object")
+    events.start(args, command="s05_register_object")
 
     registrationType = None if args.registration_type == "null" else args.registration_type
 
+    if not args.no_validation:
+        project_name = os.path.basename(args.metadata_path).split("_")[0]
+        xml_paths = [
+            os.path.join(os.path.dirname(args.metadata_path), f"{project_name}_ena_{name}.xml")
+            for name in ("experiment", "run")
+        ]
+        # Missing files are reported by register_objects
+        xml_paths = [path for path in xml_paths if os.path.exists(path)]
+        if not xsd_validation.validate_files(xml_paths):
+            print('Exiting....')
+            sys.exit(1)
+
     final_receipt_path = register_objects(
         metadata_path=args.metadata_path,
         template_dir=args.template_dir,
@@ -23,25 +41,33 @@ def main():
 
     )
 
+    # Dry run: nothing was registered, there is no receipt to parse
+    if not registrationType:
+        return
+
     print(f"[STEP3][+] Experiments and runs info saved to {final_receipt_path}")
 
+    partition = submissions.get_partition(registrationType)
     for experiment_type in args.experiment_types:
         receipt_df = parse_objects_receipts(
             metadata_path = args.metadata_path,
             template_dir=args.template_dir,
             experiment_type=experiment_type,
+            partition=partition
         )
 
         details_path = save_results_metadata(
             dataframe=receipt_df,
             metadata_path=args.metadata_path,
             template_dir=args.template_dir,
-            experiment_type=experiment_type
+            experiment_type=experiment_type,
+            partition=partition
         )
 
         print(f"[STEP3][+] Metadata written to {details_path}")
 
 
+@profiling.profiled("register_objects")
 def register_objects(
     metadata_path: str,
     template_dir: str,
@@ -54,7 +80,7 @@ def register_objects(
     metadata_dir = os.path.dirname(metadata_path)
 
     # Define paths
-   if submission_type == 1:
+    if submission_type == 1:
         print(f'[INFO] Submitting metadata in ADD mode')
         submission_path = os.path.join(
             template_dir,
@@ -74,10 +100,9 @@ def register_objects(
         metadata_dir,
         f"{project_name}_ena_run.xml"
     )
-    output_path = os.path.join(
-        metadata_dir,
-        f"{project_name}_ena_object_receipt.xml"
-    )
+    # TEST and permanent receipts side by side, see 'ena.py promote'
+    partition = submissions.get_partition(registration_type)
+    output_path = submissions.artifact_path(metadata_dir, project_name, "ena_object_receipt.xml", partition)
 
     if os.path.exists(output_path):
         raise FileExistsError(f"Il file '{output_path}' esiste già e non deve essere sovrascritto!")
@@ -91,13 +116,13 @@ def register_objects(
     normalized = registration_type.lower()
     if normalized in ['y', 'yes']:
 
-        url_ebi_ac_uk = "https://www.ebi.ac.uk/ena/submit/drop-box/submit/"
+        url_ebi_ac_uk = submissions.SUBMIT_URL["permanent"]
         print('[STEP0][+] Submitting to Permanent partition ..')
         permanent = True
 
     elif normalized in ['n','no']:
 
-        url_ebi_ac_uk = "https://wwwdev.ebi.ac.uk/ena/submit/drop-box/submit/"
+        url_ebi_ac_uk = submissions.SUBMIT_URL["test"]
         print('[STEP0][+] Submitted to TEST partition ..')
         permanent = False
 
@@ -122,17 +147,29 @@ def register_objects(
         url_ebi_ac_uk
     ]
     # # Execute the command
+    start_time = time.perf_counter()
+    posted = True
     try:
-        subprocess.run(command, check=True, text=True)
+        with profiling.stage("curl"), events.heartbeat("submission_running", url=url_ebi_ac_uk):
+            subprocess.run(command, check=True, text=True)
         print(f"[+] Objects receipt XML created: {os.path.basename(output_path)}")
 
     except subprocess.CalledProcessError as e:
         print(f"[!] Error:", {e.stderr})
+        posted = False
+
+    events.emit("submission_posted", url=url_ebi_ac_uk, files=[submission_path, experiment_path, run_path], receipt=output_path,
+                duration_s=time.perf_counter() - start_time, ok=posted)
     
     message = receipt_output_handling(output_path)
     
     if message['success']:
         print(f"[STEP3][+]  Object receipt saved to: {output_path}")
+        submissions.record_submission(
+            metadata_dir, project_name, "objects", partition, url_ebi_ac_uk,
+            files={"SUBMISSION": submission_path, "EXPERIMENT": experiment_path, "RUN": run_path},
+            receipt_path=output_path
+        )
         if permanent:
             print(f"[STEP3][+] Objects registered Permanently")
         else:
@@ -145,11 +182,16 @@ def register_objects(
     return output_path
 
 
+@profiling.profiled("parse_objects_receipts")
 def parse_objects_receipts(
     metadata_path: str,
     template_dir: str,
-    experiment_type: str
-) -> pd.DataFrame:
+    experiment_type: str,
+    partition: str = "permanent"
+) -> "pd.DataFrame":
+
+    import pandas as pd
+    import bs4 as bs
 
     # Associate:
     # - SAMPLE accession: ERS00000000 and SAMEA
@@ -160,10 +202,10 @@ def parse_objects_receipts(
     project_name = os.path.basename(metadata_path).split("_")[0]
     metadata_dir = os.path.dirname(metadata_path)
 
-    sample_receipt_path = os.path.join(
-        metadata_dir,
-        f"{project_name}_ena_samples_receipt.xml"
-    )
+    # Objects tested against samples registered permanently: no TEST samples receipt
+    sample_receipt_path = submissions.artifact_path(metadata_dir, project_name, "ena_samples_receipt.xml", partition)
+    if not os.path.exists(sample_receipt_path):
+        sample_receipt_path = submissions.artifact_path(metadata_dir, project_name, "ena_samples_receipt.xml")
     experiment_path = os.path.join(
         metadata_dir,
         f"{project_name}_ena_experiment.xml"
@@ -172,10 +214,7 @@ def parse_objects_receipts(
         metadata_dir,
         f"{project_name}_ena_run.xml"
     )
-    object_receipt_path = os.path.join(
-        metadata_dir,
-        f"{project_name}_ena_object_receipt.xml"
-    )
+    object_receipt_path = submissions.artifact_path(metadata_dir, project_name, "ena_object_receipt.xml", partition)
 
     # ------------------------------------------------------------------------ #
 
@@ -284,16 +323,23 @@ def parse_objects_receipts(
 
                 results_df.append(row)
 
+    events.emit("receipt_parsed", path=object_receipt_path, experiment_type=experiment_type,
+                runs=len(results_df))
+
     return pd.concat(results_df)
 
 
+@profiling.profiled("save_results_metadata")
 def save_results_metadata(
-    dataframe: pd.DataFrame,
+    dataframe: "pd.DataFrame",
     metadata_path: str,
     template_dir: str,
     experiment_type: str,
+    partition: str = "permanent"
 )-> str:
 
+    import bs4 as bs
+
     # WARNING: project name is assumed to be in the first field of the path
     project_name = os.path.basename(metadata_path).split("_")[0]
     # project ACCESSION such : PRJEB67767
@@ -312,10 +358,7 @@ def save_results_metadata(
                 break  
 
     output_dir = os.path.dirname(metadata_path)
-    output_path = os.path.join(
-        output_dir,
-        f"{project_name}_details_{experiment_type}.csv"
-    )
+    output_path = submissions.artifact_path(output_dir, project_name, f"details_{experiment_type}.csv", partition)
 
     cols_study = ["expID", "study_accession"]
     study_data = [project_name, project_accession]
@@ -374,6 +417,8 @@ def receipt_output_handling(receipt_path: str)-> dict:
             - 'errors' (list of str)
             - 'info' (list of str)
     """
+    import bs4 as bs
+
     with open(receipt_path, 'r', encoding='utf-8') as file:
         content = file.read()
     
@@ -396,6 +441,8 @@ def receipt_output_handling(receipt_path: str)-> dict:
         'info': info
     }
 
+    events.emit("receipt_parsed", path=receipt_path, success=success, errors=errors)
+
     return info_submission
 
 
@@ -414,8 +461,14 @@ def mapping(
     return results_dict
 
 
-def parse_args():
+def parse_args(argv: list = None):
     parser = argparse.ArgumentParser("Register objects")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         "-i", "--metadata_path",
         help="Excel file containing the metadata for the sequences.",
@@ -451,8 +504,12 @@ def parse_args():
         default="null",
         choices=['y', 'yes', 'n', 'no', 'null']  # Accept only known values
     )
-
-    return parser.parse_args()
+    parser.add_argument("--no_validation",
+                        action="store_true",
+                        help="Do not validate the XML files against the ENA schemas before submitting them."
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
 
 
 if __name__ == "__main__":
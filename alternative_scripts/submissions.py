@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+
+
+SUBMIT_URL = {
+    "permanent": "https://www.ebi.ac.uk/ena/submit/drop-box/submit/",
+    "test": "https://wwwdev.ebi.ac.uk/ena/submit/drop-box/submit/"
+}
+# Added to the name of the artifacts of a TEST submission (receipts, details)
+TEST_SUFFIX = "_test"
+MANIFEST_NAME = "ena_submissions.json"
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def get_partition(registration_type: str) -> str:
+    # -x of s01/s05/pipeline: 'permanent', 'test', or None for a dry run
+    normalized = (registration_type or "").lower()
+    if normalized in ("y", "yes"):
+        return "permanent"
+    if normalized in ("n", "no"):
+        return "test"
+
+    return None
+
+
+def artifact_path(metadata_dir: str, project_name: str, name: str, partition: str = "permanent") -> str:
+    """
+    <project>_<name> in the metadata folder. The permanent artifacts keep
+    these names (read by s02, s05, status and dedup); the TEST ones get
+    TEST_SUFFIX before the extension, so both can sit side by side.
+    """
+    if partition == "test":
+        stem, extension = os.path.splitext(name)
+        name = f"{stem}{TEST_SUFFIX}{extension}"
+
+    return os.path.join(metadata_dir, f"{project_name}_{name}")
+
+
+def sha256sum(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, mode="rb") as handle:
+        for block in iter(lambda: handle.read(BLOCK_SIZE), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def manifest_path(metadata_dir: str, project_name: str) -> str:
+    return artifact_path(metadata_dir, project_name, MANIFEST_NAME)
+
+
+def load_manifest(metadata_dir: str, project_name: str) -> dict:
+    try:
+        with open(manifest_path(metadata_dir, project_name), mode="r") as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return {}
+
+
+def record_submission(
+    metadata_dir: str,
+    project_name: str,
+    kind: str,
+    partition: str,
+    url: str,
+    files: dict,
+    receipt_path: str,
+    date: str = None
+) -> dict:
+    """
+    Records what a successful submission sent, in <project>_ena_submissions.json:
+    the SHA-256 of every part (SUBMISSION, SAMPLE, EXPERIMENT, RUN) and of
+    the receipt, so that 'ena.py promote' can send the same bytes again.
+    Args:
+        kind (str): 'samples' (s01) or 'objects' (s05).
+        files (dict): Form part -> path of the file sent.
+    Returns:
+        dict: The entry recorded.
+    """
+    entry = {
+        "url": url,
+        "date": date or time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "files": {
+            part: {"path": os.path.abspath(path), "sha256": sha256sum(path)}
+            for part, path in files.items()
+        },
+        "receipt": {"path": os.path.abspath(receipt_path), "sha256": sha256sum(receipt_path)}
+    }
+
+    manifest = load_manifest(metadata_dir, project_name)
+    manifest.setdefault(kind, {})[partition] = entry
+
+    output_path = manifest_path(metadata_dir, project_name)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode="w") as handle:
+        json.dump(manifest, handle, indent=2)
+    os.replace(tmp_path, output_path)
+
+    return entry
+
+
+def changed_files(entry: dict) -> list:
+    # Parts and receipt of a recorded submission whose bytes are not the recorded ones
+    changed = []
+    for part, file in list(entry["files"].items()) + [("receipt", entry["receipt"])]:
+        if not os.path.exists(file["path"]):
+            changed.append(f"{part}: {file['path']} is missing")
+        elif sha256sum(file["path"]) != file["sha256"]:
+            changed.append(f"{part}: {file['path']} changed since the submission")
+
+    return changed
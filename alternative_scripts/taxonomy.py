@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import argparse
+
+import profiling
+
+
+# Built from the NCBI dump on this machine, outside of the repository
+STATE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "ena-submission")
+INDEX_NAME = "taxonomy.sqlite"
+TAXDUMP_URL = "https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz"
+
+# Classes of names.dmp resolved to a tax_id, the others (authority, type material, ...) are skipped
+NAME_CLASSES = [
+    "scientific name",
+    "synonym",
+    "equivalent name",
+    "genbank synonym",
+    "common name",
+    "genbank common name"
+]
+
+BATCH_SIZE = 100000
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="taxonomy")
+
+    if args.build:
+        build_index(args.build, args.index)
+
+    if not args.queries:
+        return
+
+    index = TaxonomyIndex(args.index)
+    for query in args.queries:
+        if query.isdigit():
+            taxon = index.get_taxon(int(query))
+            print(f"{query}\t{taxon['scientific_name'] if taxon else '[!] unknown tax_id'}")
+        else:
+            tax_ids = index.get_tax_ids(query)
+            print(f"{query}\t{', '.join(str(tax_id) for tax_id in tax_ids) or '[!] unknown name'}")
+    index.close()
+
+
+def read_dmp(dmp_path: str):
+    # Fields are separated by '\t|\t' and rows end with '\t|\n'
+    with open(dmp_path, mode="r", encoding="utf-8", errors="replace") as handle:
+        for line in handle:
+            yield line.rstrip("\n").rstrip("\t|").split("\t|\t")
+
+
+def build_index(taxdump_dir: str, index_path: str = None) -> str:
+    """
+    Builds the SQLite index from an NCBI taxdump folder (names.dmp, nodes.dmp,
+    optionally merged.dmp), once: the lookups afterwards only read the index.
+    Args:
+        taxdump_dir (str): Folder where taxdump.tar.gz was extracted.
+        index_path (str): Where the index is written (default: ~/.cache/ena-submission/taxonomy.sqlite).
+    Returns:
+        str: Path of the index.
+    """
+    index_path = index_path or os.path.join(STATE_DIR, INDEX_NAME)
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+
+    # Built aside then renamed, a reader never sees a half written index
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.executescript(
+        "CREATE TABLE taxa (tax_id INTEGER PRIMARY KEY, parent_id INTEGER, rank TEXT, scientific_name TEXT);"
+        "CREATE TABLE names (name_key TEXT, name TEXT, name_class TEXT, tax_id INTEGER);"
+        "CREATE TABLE merged (old_tax_id INTEGER PRIMARY KEY, tax_id INTEGER);"
+    )
+
+    print(f"[TAXONOMY] Reading {os.path.join(taxdump_dir, 'nodes.dmp')} ...")
+    insert_batches(
+        connection,
+        "INSERT INTO taxa (tax_id, parent_id, rank) VALUES (?, ?, ?)",
+        ((int(row[0]), int(row[1]), row[2]) for row in read_dmp(os.path.join(taxdump_dir, "nodes.dmp")))
+    )
+
+    print(f"[TAXONOMY] Reading {os.path.join(taxdump_dir, 'names.dmp')} ...")
+    insert_batches(
+        connection,
+        "INSERT INTO names VALUES (?, ?, ?, ?)",
+        (
+            (row[1].lower(), row[1], row[3], int(row[0]))
+            for row in read_dmp(os.path.join(taxdump_dir, "names.dmp"))
+            if row[3] in NAME_CLASSES
+        )
+    )
+
+    merged_path = os.path.join(taxdump_dir, "merged.dmp")
+    if os.path.exists(merged_path):
+        insert_batches(
+            connection,
+            "INSERT OR REPLACE INTO merged VALUES (?, ?)",
+            ((int(row[0]), int(row[1])) for row in read_dmp(merged_path))
+        )
+
+    # Indexes created after the inserts, much faster than maintaining them row by row.
+    # The tax_id one is only needed to copy the scientific names into taxa
+    with connection:
+        connection.executescript(
+            "CREATE INDEX names_key ON names (name_key);"
+            "CREATE INDEX names_scientific ON names (tax_id) WHERE name_class = 'scientific name';"
+            "UPDATE taxa SET scientific_name = ("
+            "  SELECT name FROM names WHERE names.tax_id = taxa.tax_id AND name_class = 'scientific name');"
+            "DROP INDEX names_scientific;"
+        )
+    connection.execute("VACUUM")
+    connection.close()
+
+    os.replace(tmp_path, index_path)
+    print(f"[TAXONOMY][+] Index saved to: {index_path}")
+
+    return index_path
+
+
+def insert_batches(connection: sqlite3.Connection, query: str, rows) -> None:
+    batch = []
+    with connection:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                connection.executemany(query, batch)
+                batch = []
+        connection.executemany(query, batch)
+
+
+class TaxonomyIndex:
+    """
+    Read-only lookups in the index built by build_index. Both tax_id -> name
+    and name -> tax_id go through a B-tree index of SQLite (read through a
+    memory map), and each distinct value is looked up once per process.
+    """
+
+    def __init__(self, index_path: str = None):
+        index_path = index_path or os.path.join(STATE_DIR, INDEX_NAME)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(
+                f"[!] Taxonomy index not found: {index_path} (build it with: python ena.py taxonomy --build <taxdump_dir>)"
+            )
+
+        self.connection = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True, check_same_thread=False)
+        self.connection.execute("PRAGMA mmap_size = 1073741824")
+        self.taxa = {}
+        self.names = {}
+
+    def get_taxon(self, tax_id: int) -> dict:
+        """
+        Returns the taxon of a tax_id ('tax_id', 'scientific_name', 'rank',
+        'merged_from' when the id was merged into another one), or None.
+        """
+        if tax_id not in self.taxa:
+            merged_from = None
+            row = self.connection.execute(
+                "SELECT tax_id, scientific_name, rank FROM taxa WHERE tax_id = ?", (tax_id,)
+            ).fetchone()
+
+            if row is None:
+                merged = self.connection.execute(
+                    "SELECT tax_id FROM merged WHERE old_tax_id = ?", (tax_id,)
+                ).fetchone()
+                if merged:
+                    merged_from = tax_id
+                    row = self.connection.execute(
+                        "SELECT tax_id, scientific_name, rank FROM taxa WHERE tax_id = ?", merged
+                    ).fetchone()
+
+            self.taxa[tax_id] = {
+                "tax_id": row[0],
+                "scientific_name": row[1],
+                "rank": row[2],
+                "merged_from": merged_from
+            } if row else None
+
+        return self.taxa[tax_id]
+
+    def get_tax_ids(self, name: str) -> list:
+        """
+        Returns the tax_ids of a name (case insensitive): the taxa having it as
+        scientific name if any, otherwise the ones having it as synonym.
+        """
+        key = name.strip().lower()
+        if key not in self.names:
+            rows = self.connection.execute(
+                "SELECT DISTINCT tax_id, name_class = 'scientific name' FROM names WHERE name_key = ?", (key,)
+            ).fetchall()
+            scientific = [tax_id for tax_id, is_scientific in rows if is_scientific]
+            self.names[key] = sorted(scientific or {tax_id for tax_id, _ in rows})
+
+        return self.names[key]
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+@profiling.profiled("resolve_taxonomy")
+def resolve_taxonomy(metadata_df: "pd.DataFrame", index: TaxonomyIndex, fill: bool = False) -> tuple:
+    """
+    Checks that tax_id and scientific_name of every sample agree with the index.
+    With fill, an empty tax_id is taken from the scientific name and an empty
+    scientific name from the tax_id; merged tax_ids are replaced by the current one.
+    A tax_id that is not a number is reported, never replaced. The filled
+    values are written as text, as the other cells.
+    Args:
+        metadata_df (pd.DataFrame): Rows of the sample_submission sheet.
+        index (TaxonomyIndex): Opened taxonomy index.
+        fill (bool): Complete the missing values instead of reporting them.
+    Returns:
+        tuple: The metadata (completed if fill) and the list of problems.
+    """
+    import pandas as pd
+
+    metadata_df = metadata_df.copy()
+    values = metadata_df["tax_id"].where(metadata_df["tax_id"].notna(), "").astype(str).str.strip()
+    tax_ids = pd.to_numeric(values, errors="coerce")
+    names = metadata_df["scientific_name"].where(metadata_df["scientific_name"].notna(), "")\
+        .astype(str).str.strip()
+
+    problems = []
+    for row, alias, value, tax_id, name in zip(metadata_df.index, metadata_df["sample_alias"], values, tax_ids, names):
+        # Spreadsheet row: header, units row, then the samples
+        where = f"row {row + 2} ({alias})"
+
+        if value and (pd.isna(tax_id) or tax_id != int(tax_id)):
+            problems.append(f"{where}: invalid tax_id '{value}'")
+            continue
+
+        if not value:
+            if not name:
+                problems.append(f"{where}: tax_id and scientific_name missing")
+                continue
+
+            candidates = index.get_tax_ids(name)
+            if len(candidates) != 1:
+                problems.append(f"{where}: '{name}' matches {len(candidates) or 'no'} taxa "
+                                f"{candidates if candidates else ''}".rstrip())
+            elif fill:
+                metadata_df.at[row, "tax_id"] = str(candidates[0])
+                metadata_df.at[row, "scientific_name"] = index.get_taxon(candidates[0])["scientific_name"]
+            else:
+                problems.append(f"{where}: tax_id missing, '{name}' is {candidates[0]}")
+            continue
+
+        taxon = index.get_taxon(int(tax_id))
+        if taxon is None:
+            problems.append(f"{where}: unknown tax_id {int(tax_id)}")
+            continue
+
+        if taxon["merged_from"] is not None:
+            if fill:
+                metadata_df.at[row, "tax_id"] = str(taxon["tax_id"])
+            else:
+                problems.append(f"{where}: tax_id {int(tax_id)} was merged into {taxon['tax_id']}")
+
+        if not name:
+            if fill:
+                metadata_df.at[row, "scientific_name"] = taxon["scientific_name"]
+            else:
+                problems.append(f"{where}: scientific_name missing, {int(tax_id)} is '{taxon['scientific_name']}'")
+
+        elif name.lower() != taxon["scientific_name"].lower():
+            problems.append(f"{where}: tax_id {int(tax_id)} is '{taxon['scientific_name']}', not '{name}'")
+
+    return metadata_df, problems
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Offline NCBI taxonomy index")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("queries",
+                        help="tax_ids or scientific names to look up.",
+                        nargs="*"
+                        )
+    parser.add_argument("-b", "--build",
+                        help=f"Build the index from an extracted NCBI taxdump folder ({TAXDUMP_URL}).",
+                        type=str
+                        )
+    parser.add_argument("--index",
+                        help="Taxonomy index (default: ~/.cache/ena-submission/taxonomy.sqlite).",
+                        type=str,
+                        default=os.path.join(STATE_DIR, INDEX_NAME)
+                        )
+    profiling.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
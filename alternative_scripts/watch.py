@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import struct
+import fnmatch
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import events
+import profiling
+from checksum_store import ChecksumStore, get_checksum, default_store_path, write_md5_file
+from fastq_check import FastqError
+
+
+DEFAULT_PATTERNS = ["*.fastq.gz", "*.fq.gz"]
+# Written next to the files. Not MD5.txt: the provider's one is kept as delivered
+MANIFEST_NAME = "watch_MD5.txt"
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="watch")
+    events.start(args, command="watch")
+
+    if not args.checksum_store and not args.metadata_path:
+        print("[!] Either --checksum_store or -i/--metadata_path (to use the campaign store) is required")
+        sys.exit(1)
+
+    for directory in args.directories:
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"{directory} does not exist!")
+
+    watcher = Watcher(
+        directories=args.directories,
+        checksum_store=args.checksum_store or default_store_path(os.path.dirname(args.metadata_path)),
+        patterns=args.patterns,
+        settle=args.settle,
+        interval=args.interval,
+        workers=args.workers,
+        verify_fastq=args.verify_fastq,
+        manifest_name=args.manifest_name,
+        polling=args.polling
+    )
+    # Stopped by a service manager: close the store and finish the event stream
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        watcher.run(once=args.once)
+    except KeyboardInterrupt:
+        print("\n[WATCH] Stopped")
+    finally:
+        watcher.close()
+
+    if watcher.failed:
+        sys.exit(1)
+
+
+class Inotify:
+    """
+    Minimal inotify binding (ctypes on the libc functions): reports the
+    paths created, written or moved into the watched directories.
+    """
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        # AttributeError outside Linux: the caller falls back to polling
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self.raise_errno("inotify_init1")
+        self.directories = {}
+
+    def raise_errno(self, what: str) -> None:
+        error = self.ctypes.get_errno()
+        raise OSError(error, f"{what}: {os.strerror(error)}")
+
+    def add_watch(self, directory: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            # ENOSPC: fs.inotify.max_user_watches reached
+            self.raise_errno(f"inotify_add_watch {directory}")
+        self.directories[wd] = directory
+
+    def read(self, timeout: float) -> list:
+        """
+        Waits at most timeout seconds for events.
+        Returns:
+            list: (path, is_dir) of the changed entries, (None, True) when the
+                  kernel queue overflowed and events were lost.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+
+        changes = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                changes.append((None, True))
+            elif mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+            elif wd in self.directories and name:
+                changes.append((os.path.join(self.directories[wd], os.fsdecode(name)), bool(mask & IN_ISDIR)))
+
+        return changes
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Hashes the sequence files of a delivery while it is still arriving: a
+    file is hashed once its size and modification time have not changed for
+    `settle` seconds, its MD5 goes into the checksum store (where s03, s04
+    and the pipeline find it) and the manifest of its folder is rewritten.
+    New files are reported by inotify on Linux, by a rescan every `interval`
+    seconds otherwise.
+    """
+
+    def __init__(
+        self,
+        directories: list,
+        checksum_store: str,
+        patterns: list = None,
+        settle: float = 60,
+        interval: float = 10,
+        workers: int = 2,
+        verify_fastq: bool = False,
+        manifest_name: str = MANIFEST_NAME,
+        polling: bool = False
+    ):
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.store = ChecksumStore(checksum_store)
+        self.patterns = patterns or DEFAULT_PATTERNS
+        self.settle = settle
+        self.interval = interval
+        self.workers = workers
+        self.verify_fastq = verify_fastq
+        self.manifest_name = manifest_name
+
+        # path -> (size, mtime_ns, time of the last change seen)
+        self.pending = {}
+        self.hashed = 0
+        self.failed = []
+
+        self.inotify = None
+        if not polling:
+            try:
+                self.inotify = Inotify()
+            except (AttributeError, OSError) as e:
+                print(f"[WARNING] inotify not available ({e}), polling every {interval} s")
+
+    def run(self, once: bool = False) -> None:
+        """
+        Watches until interrupted, or with once until every file found is hashed.
+        """
+        for directory in self.directories:
+            self.scan(directory)
+        print(f"[WATCH] Watching {len(self.directories)} folders "
+              f"({'inotify' if self.inotify else 'polling'}), {len(self.pending)} files to hash")
+
+        while True:
+            ready = self.get_ready()
+            if ready:
+                self.hash_files(ready)
+
+            if once and not self.pending:
+                break
+
+            self.wait()
+
+        print(f"[WATCH][+] {self.hashed} files hashed, {len(self.failed)} failed")
+
+    def matches(self, path: str) -> bool:
+        name = os.path.basename(path)
+        # Hidden files are the temporary files of rsync and most transfer tools
+        return not name.startswith(".") and any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns)
+
+    def scan(self, directory: str) -> None:
+        # Also (re)adds the inotify watches: a subfolder may appear at any time
+        if self.inotify is not None:
+            try:
+                self.inotify.add_watch(directory)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    print(f"[WARNING] {e}, polling every {self.interval} s")
+                    self.inotify.close()
+                    self.inotify = None
+
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                self.scan(entry.path)
+            elif entry.is_file() and self.matches(entry.path):
+                self.observe(entry.path)
+
+    def observe(self, path: str) -> None:
+        """
+        Records the size and modification time of a file not hashed yet. The
+        time of the last change starts at the modification time, so a file
+        already complete when the watcher starts is hashed right away.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.pending.pop(path, None)
+            return
+
+        now = time.time()
+        previous = self.pending.get(path)
+        if previous is None:
+            if self.store.get(path):
+                return
+            # Found corrupt before, reported again only when the file changes
+            problem = self.store.get_check(path)[1]
+            if problem:
+                if path not in self.failed:
+                    print(problem)
+                    self.failed.append(path)
+                return
+            events.file_discovered(path)
+            self.pending[path] = (stat.st_size, stat.st_mtime_ns, min(now, stat.st_mtime))
+        elif (stat.st_size, stat.st_mtime_ns) != previous[:2]:
+            self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+
+    def get_ready(self) -> list:
+        # Files whose size and modification time are stable for settle seconds
+        for path in list(self.pending):
+            self.observe(path)
+
+        now = time.time()
+        return sorted(
+            path for path, (_, _, changed) in self.pending.items()
+            if now - changed >= self.settle
+        )
+
+    def wait(self) -> None:
+        # Wakes up when the next pending file may be stable, or on new files
+        now = time.time()
+        timeout = min(
+            [self.interval] + [max(0.0, changed + self.settle - now) for _, _, changed in self.pending.values()]
+        )
+
+        if self.inotify is None:
+            time.sleep(timeout)
+            for directory in self.directories:
+                self.scan(directory)
+            return
+
+        for path, is_dir in self.inotify.read(timeout):
+            if path is None:
+                print("[WARNING] inotify queue overflow, rescanning")
+                for directory in self.directories:
+                    self.scan(directory)
+            elif is_dir:
+                self.scan(path)
+            elif self.matches(path):
+                self.observe(path)
+
+    def hash_files(self, paths: list) -> None:
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(self.hash_file, paths))
+
+        for directory in sorted({os.path.dirname(path) for path, done in zip(paths, results) if done}):
+            self.write_manifest(directory)
+
+    def hash_file(self, path: str) -> bool:
+        size, mtime_ns, _ = self.pending[path]
+        problem = None
+        try:
+            # Not through the store: the file may still change while it is read
+            md5 = get_checksum(path, verify_fastq=self.verify_fastq)
+        except FastqError as e:
+            md5, problem = None, str(e)
+        except FileNotFoundError:
+            self.pending.pop(path, None)
+            return False
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.pending.pop(path, None)
+            return False
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            # Written again while hashing: waits for a new quiet period
+            self.pending[path] = (stat.st_size, stat.st_mtime_ns, time.time())
+            return False
+
+        del self.pending[path]
+        if self.verify_fastq:
+            self.store.put_check(path, problem)
+        if problem:
+            print(problem)
+            self.failed.append(path)
+            return False
+
+        self.store.put(path, md5)
+        self.hashed += 1
+        print(f"[WATCH][+] {md5} {path}")
+
+        return True
+
+    def write_manifest(self, directory: str) -> str:
+        """
+        Writes '<md5> <file name>' for every hashed file of a folder, as the
+        MD5.txt files of the deliveries.
+        """
+        checksums = {}
+        for entry in os.scandir(directory):
+            if entry.is_file() and self.matches(entry.path) and entry.path not in self.pending:
+                md5 = self.store.get(entry.path)
+                if md5:
+                    checksums[entry.name] = md5
+
+        manifest_path = write_md5_file(os.path.join(directory, self.manifest_name), checksums)
+
+        events.emit("manifest_written", path=manifest_path, files=len(checksums))
+
+        return manifest_path
+
+    def close(self) -> None:
+        if self.inotify is not None:
+            self.inotify.close()
+        self.store.close()
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Hashing the sequence files as they are delivered")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("directories",
+                        help="Folders receiving the sequence files (subfolders included).",
+                        nargs="+"
+                        )
+    parser.add_argument("-i", "--metadata_path",
+                        help="Excel file of the campaign: the checksums go to the store next to it, as for s03.",
+                        type=str
+                        )
+    parser.add_argument("--checksum_store",
+                        help="SQLite file where the checksums are saved (default: next to the metadata file).",
+                        type=str
+                        )
+    parser.add_argument("-p", "--patterns",
+                        help="Comma separated patterns of the files to hash.",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=DEFAULT_PATTERNS
+                        )
+    parser.add_argument("--settle",
+                        help="Seconds a file must keep the same size and modification time before it is hashed.",
+                        type=float,
+                        default=60
+                        )
+    parser.add_argument("--interval",
+                        help="Seconds between two checks of the pending files (and rescans when polling).",
+                        type=float,
+                        default=10
+                        )
+    parser.add_argument("-j", "--workers",
+                        help="Files hashed at the same time.",
+                        type=int,
+                        default=2
+                        )
+    parser.add_argument("--verify_fastq",
+                        action="store_true",
+                        help="Also check the gzip CRC/size and the FASTQ records of every file."
+                        )
+    parser.add_argument("--manifest_name",
+                        help="Name of the manifest written in each folder.",
+                        type=str,
+                        default=MANIFEST_NAME
+                        )
+    parser.add_argument("--polling",
+                        action="store_true",
+                        help="Rescan the folders instead of using inotify (network file systems)."
+                        )
+    parser.add_argument("--once",
+                        action="store_true",
+                        help="Exit once every file found is hashed instead of watching forever."
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import copy
+import time
+import argparse
+import urllib.request
+
+import events
+import profiling
+
+
+SCHEMA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "schemas"))
+SCHEMA_URL = "https://ftp.ebi.ac.uk/pub/databases/ena/doc/xsd/sra_1_5/"
+
+# Root element of the generated XML -> ENA schema defining it
+SCHEMA_FILES = {
+    "SAMPLE_SET": "SRA.sample.xsd",
+    "EXPERIMENT_SET": "SRA.experiment.xsd",
+    "RUN_SET": "SRA.run.xsd",
+    "SUBMISSION": "SRA.submission.xsd"
+}
+# Included by all the others
+COMMON_SCHEMA = "SRA.common.xsd"
+
+# Compiled schemas of the process: (path, mtime) -> XMLSchema
+_schemas = {}
+
+
+def main(args: argparse.Namespace = None):
+    args = args or parse_args()
+    profiling.start(args, command="xsd_validation")
+    events.start(args, command="xsd_validation")
+
+    if args.download:
+        download_schemas(args.schema_dir)
+
+    if args.xml_paths and not validate_files(args.xml_paths, args.schema_dir, required=True):
+        sys.exit(1)
+
+
+def schemas_available(schema_dir: str = SCHEMA_DIR) -> bool:
+    return all(
+        os.path.exists(os.path.join(schema_dir, name))
+        for name in list(SCHEMA_FILES.values()) + [COMMON_SCHEMA]
+    )
+
+
+def download_schemas(schema_dir: str = SCHEMA_DIR) -> list:
+    """
+    Saves the ENA SRA schemas in schema_dir, to validate without network access afterwards.
+    Returns:
+        list: Paths of the saved schemas.
+    """
+    os.makedirs(schema_dir, exist_ok=True)
+
+    paths = []
+    for name in list(SCHEMA_FILES.values()) + [COMMON_SCHEMA]:
+        path = os.path.join(schema_dir, name)
+        with urllib.request.urlopen(SCHEMA_URL + name, timeout=60) as response:
+            content = response.read()
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="wb") as handle:
+            handle.write(content)
+        os.replace(tmp_path, path)
+
+        print(f"[XSD][+] Schema saved to: {path}")
+        paths.append(path)
+
+    return paths
+
+
+def load_schema(set_tag: str, schema_dir: str = SCHEMA_DIR):
+    """
+    Returns the compiled schema of a root element. Compiling the SRA schemas
+    takes longer than validating a small file, so it is done once per process
+    (and again only if the schema file changes).
+    """
+    from lxml import etree
+
+    if set_tag not in SCHEMA_FILES:
+        raise ValueError(f"[!] No ENA schema for <{set_tag}>, expected one of: {', '.join(SCHEMA_FILES)}")
+
+    schema_path = os.path.realpath(os.path.join(schema_dir, SCHEMA_FILES[set_tag]))
+    key = (schema_path, os.stat(schema_path).st_mtime_ns)
+
+    if key not in _schemas:
+        # Parsed from the path so that the relative includes (SRA.common.xsd) resolve
+        _schemas[key] = etree.XMLSchema(etree.parse(schema_path))
+
+    return _schemas[key]
+
+
+@profiling.profiled("validate_xml")
+def validate_xml(xml_path: str, schema_dir: str = SCHEMA_DIR) -> list:
+    """
+    Validates a SAMPLE_SET, EXPERIMENT_SET or RUN_SET file against the ENA schema.
+    The file is streamed: each record is validated on its own, wrapped in an
+    empty set, then freed, so memory does not grow with the number of records
+    and all the invalid records are reported instead of only the first one.
+    Args:
+        xml_path (str): XML file written by s01, s02 or s03.
+        schema_dir (str): Directory containing the SRA XSD files.
+    Returns:
+        list: Error messages, empty if the file is valid.
+    """
+    from lxml import etree
+
+    errors = []
+    records = 0
+    start_time = time.perf_counter()
+
+    root = None
+    schema = None
+    depth = 0
+    try:
+        for event, element in etree.iterparse(xml_path, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = element
+                    schema = load_schema(element.tag, schema_dir)
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            records += 1
+            wrapper = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+            wrapper.append(copy.deepcopy(element))
+
+            if not schema.validate(wrapper):
+                alias = element.get("alias", f"record {records}")
+                for error in schema.error_log:
+                    errors.append(f"{os.path.basename(xml_path)}:{element.sourceline} "
+                                  f"{element.tag} '{alias}': {error.message}")
+
+            # Free the validated records
+            element.clear()
+            while element.getprevious() is not None:
+                del root[0]
+
+    except etree.XMLSyntaxError as e:
+        errors.append(f"{os.path.basename(xml_path)}: malformed XML: {e}")
+
+    events.emit("xml_validated", path=xml_path, records=records, errors=len(errors),
+                duration_s=time.perf_counter() - start_time)
+
+    return errors
+
+
+def validate_files(xml_paths: list, schema_dir: str = SCHEMA_DIR, required: bool = False) -> bool:
+    """
+    Validates the generated XML files before they are sent to ENA.
+    Without the schemas the check is skipped with a warning (unless required).
+    Returns:
+        bool: True if every file is valid (or the check was skipped).
+    """
+    schema_dir = schema_dir or SCHEMA_DIR
+
+    if not schemas_available(schema_dir):
+        print(f"[WARNING] ENA schemas not found in {schema_dir}, XML files not validated. "
+              f"Download them with: python ena.py validate --download")
+        return not required
+
+    valid = True
+    for xml_path in xml_paths:
+        errors = validate_xml(xml_path, schema_dir)
+        if errors:
+            valid = False
+            print(f"[XSD][!] {xml_path}: {len(errors)} errors")
+            print('\n'.join(f'[!] {error}' for error in errors))
+        else:
+            print(f"[XSD][+] {xml_path} is valid")
+
+    return valid
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser("Validating the XML files against the ENA schemas")
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("xml_paths",
+                        help="SAMPLE_SET, EXPERIMENT_SET or RUN_SET files to validate.",
+                        nargs="*"
+                        )
+    parser.add_argument("--schema_dir",
+                        help="Directory containing the ENA SRA XSD files (default: data/schemas).",
+                        type=str,
+                        default=SCHEMA_DIR
+                        )
+    parser.add_argument("--download",
+                        action="store_true",
+                        help=f"Download the schemas from {SCHEMA_URL} into --schema_dir first."
+                        )
+    profiling.add_arguments(parser)
+    events.add_arguments(parser)
+
+
+if __name__ == "__main__":
+    main()
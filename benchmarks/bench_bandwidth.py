@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "alternative_scripts"))
+
+import bandwidth
+
+
+CHUNK = 64 * 1024
+
+
+def main():
+    args = parse_args()
+    if args.send:
+        sys.exit(send(args.send, args.port, args.rate))
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as base_dir:
+        print(f"[BENCH] Writing {args.files} files of {args.size_mb} MiB ...")
+        file_list = []
+        for index in range(args.files):
+            file_path = os.path.join(base_dir, f"S{index}_1.fastq.gz")
+            with open(file_path, mode="wb") as handle:
+                handle.write(os.urandom(args.size_mb * 1024 * 1024))
+            file_list.append(file_path)
+
+        for policy in args.policies:
+            link = Link(
+                capacity=bandwidth.parse_rate(args.capacity),
+                stream_rate=bandwidth.parse_rate(args.stream_rate),
+                max_connections=args.max_connections,
+                users=args.users,
+                user_demand=bandwidth.parse_rate(args.user_demand),
+                load_window=args.load_window
+            )
+            with link:
+                result = run_policy(policy, file_list, link, args)
+            results.append(result)
+            print(f"[BENCH] {policy:<10} {result['wall_s']:7.1f}s  "
+                  f"{bandwidth.format_rate(result['bytes_per_s']):>12}  "
+                  f"{result['errors']:3d} errors  {len(result['failed'])} failed  "
+                  f"users got {result['user_share']:.0%} of their demand  "
+                  f"concurrency {' '.join(str(c) for c in result['concurrency'])}")
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "link": {
+            "capacity": args.capacity,
+            "stream_rate": args.stream_rate,
+            "max_connections": args.max_connections,
+            "users": args.users,
+            "user_demand": args.user_demand,
+            "load_window": args.load_window,
+            "rate_cap": args.rate_cap
+        },
+        "files": args.files,
+        "size_mb": args.size_mb,
+        "results": results
+    }
+
+    with open(args.output, mode="w") as handle:
+        json.dump(report, handle, indent=2)
+    print(f"[BENCH] Results written to {args.output}")
+
+
+def fair_share(capacity: float, demands: list) -> list:
+    # Max-min fair allocation of the link, as TCP flows sharing a bottleneck
+    allocation = [0.0] * len(demands)
+    remaining = capacity
+    order = sorted(range(len(demands)), key=lambda i: demands[i])
+    for position, i in enumerate(order):
+        allocation[i] = min(demands[i], remaining / (len(order) - position))
+        remaining -= allocation[i]
+
+    return allocation
+
+
+class Link:
+    """
+    Local stand-in for the FTP upload area behind a shared uplink: a TCP sink
+    whose connections are paced to their fair share of the capacity, each
+    one at most stream_rate (window / round trip time of a long distance
+    session). Connections above max_connections are refused, as the server
+    refuses the sessions of a user over its limit. During load_window
+    (seconds after start), users flows of the other users of the uplink
+    compete for it; the bytes they get are counted.
+    """
+
+    def __init__(self, capacity: int, stream_rate: int, max_connections: int,
+                 users: int = 0, user_demand: int = 0, load_window: tuple = (0, 0)):
+        self.capacity = capacity
+        self.stream_rate = stream_rate
+        self.max_connections = max_connections
+        self.users = users
+        self.user_demand = user_demand
+        self.load_window = load_window
+
+        self.lock = threading.Lock()
+        self.active = 0
+        self.refused = 0
+        self.received = 0
+        self.user_bytes = 0.0
+        self.stopped = threading.Event()
+        self.server = socket.create_server(("127.0.0.1", 0))
+        # Small buffers: the pacing, not the loopback buffers, sets the rate
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, CHUNK)
+        self.port = self.server.getsockname()[1]
+        self.start_time = time.perf_counter()
+
+    def __enter__(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+        threading.Thread(target=self.monitor, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.server.close()
+
+    def loaded(self) -> bool:
+        elapsed = time.perf_counter() - self.start_time
+        return self.users and self.load_window[0] <= elapsed < self.load_window[1]
+
+    def shares(self) -> tuple:
+        # (rate of one upload connection, rate of the other users together)
+        users = self.users if self.loaded() else 0
+        allocation = fair_share(self.capacity, [self.stream_rate] * max(1, self.active) + [self.user_demand] * users)
+        return allocation[0], sum(allocation[len(allocation) - users:]) if users else 0.0
+
+    def monitor(self) -> None:
+        while not self.stopped.wait(0.1):
+            with self.lock:
+                self.user_bytes += self.shares()[1] * 0.1
+
+    def accept(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection: socket.socket) -> None:
+        with connection:
+            with self.lock:
+                refused = self.active >= self.max_connections
+                self.refused += refused
+                self.active += not refused
+            if refused:
+                connection.sendall(b"-")
+                return
+
+            try:
+                connection.sendall(b"+")
+                while True:
+                    data = connection.recv(CHUNK)
+                    if not data:
+                        break
+                    with self.lock:
+                        self.received += len(data)
+                        rate = self.shares()[0]
+                    time.sleep(len(data) / rate)
+                connection.sendall(b"+")
+            except OSError:
+                pass
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+
+def send(file_path: str, port: int, rate: int) -> int:
+    # One transfer, paced to rate as lftp's net:limit-rate
+    with socket.create_connection(("127.0.0.1", port)) as connection:
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CHUNK)
+        if connection.recv(1) != b"+":
+            print("Too many connections for this user", file=sys.stderr)
+            return 1
+
+        sent = 0
+        start_time = time.perf_counter()
+        with open(file_path, mode="rb") as handle:
+            for block in iter(lambda: handle.read(CHUNK), b""):
+                connection.sendall(block)
+                sent += len(block)
+                if rate:
+                    ahead = sent / rate - (time.perf_counter() - start_time)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        connection.shutdown(socket.SHUT_WR)
+
+        return 0 if connection.recv(1) == b"+" else 1
+
+
+def run_policy(policy: str, file_list: list, link: Link, args: argparse.Namespace) -> dict:
+    if policy == "adaptive":
+        controller = bandwidth.AimdController(max_workers=args.max_workers, hold=args.hold)
+    else:
+        workers = int(policy.split("-")[1])
+        controller = bandwidth.AimdController(min_workers=workers, max_workers=workers)
+
+    script = os.path.abspath(__file__)
+    scheduler = bandwidth.UploadScheduler(
+        file_list,
+        command=lambda file_path, rate: [
+            sys.executable, "-S", script, "--send", file_path, "--port", str(link.port), "--rate", str(rate)
+        ],
+        schedule=bandwidth.Schedule(default=bandwidth.parse_rate(args.rate_cap or 0)),
+        controller=controller,
+        interval=args.interval
+    )
+
+    start_wall = time.perf_counter()
+    with open(os.devnull, mode="w") as devnull, contextlib.redirect_stdout(devnull):
+        results = scheduler.run()
+    wall = time.perf_counter() - start_wall
+
+    window = max(0.0, min(link.load_window[1], wall) - link.load_window[0])
+    demand = link.users * link.user_demand * window
+
+    return {
+        "policy": policy,
+        "wall_s": wall,
+        "bytes_per_s": link.received / wall if wall else 0.0,
+        "errors": sum(interval["errors"] for interval in results["history"]),
+        "refused": link.refused,
+        "failed": results["failed"],
+        "user_share": link.user_bytes / demand if demand else 1.0,
+        "concurrency": [interval["concurrency"] for interval in results["history"]],
+        "history": results["history"]
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark of the upload concurrency policies on a throttled local link")
+    parser.add_argument("-p", "--policies",
+                        help="Comma separated policies: fixed-<n> or adaptive.",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=["fixed-1", "fixed-8", "adaptive"]
+                        )
+    parser.add_argument("-f", "--files",
+                        help="Files uploaded by each policy.",
+                        type=int,
+                        default=16
+                        )
+    parser.add_argument("-s", "--size_mb",
+                        help="Size of each file (MiB).",
+                        type=int,
+                        default=16
+                        )
+    parser.add_argument("--capacity",
+                        help="Capacity of the uplink, shared with the other users (bytes per second).",
+                        type=str,
+                        default="30M"
+                        )
+    parser.add_argument("--stream_rate",
+                        help="Rate of one connection on its own (window / round trip time).",
+                        type=str,
+                        default="6M"
+                        )
+    parser.add_argument("--max_connections",
+                        help="Connections accepted at the same time, more are refused.",
+                        type=int,
+                        default=6
+                        )
+    parser.add_argument("--users",
+                        help="Flows of the other users of the uplink during the load window.",
+                        type=int,
+                        default=3
+                        )
+    parser.add_argument("--user_demand",
+                        help="Rate each of these flows asks for.",
+                        type=str,
+                        default="5M"
+                        )
+    parser.add_argument("--load_window",
+                        help="Seconds after the start when the other users are active, e.g. 5,15.",
+                        type=lambda t: tuple(float(s) for s in t.split(",")),
+                        default=(5.0, 15.0)
+                        )
+    parser.add_argument("--rate_cap",
+                        help="Rate cap of the uploads (as s04 --rate_cap).",
+                        type=str
+                        )
+    parser.add_argument("--max_workers",
+                        help="Most transfers of the adaptive policy.",
+                        type=int,
+                        default=8
+                        )
+    parser.add_argument("--hold",
+                        help="Intervals the adaptive policy waits before probing again.",
+                        type=int,
+                        default=3
+                        )
+    parser.add_argument("--interval",
+                        help="Seconds between two concurrency decisions (10 in s04).",
+                        type=float,
+                        default=1.0
+                        )
+    parser.add_argument("-o", "--output",
+                        help="JSON file where the results are saved.",
+                        type=str,
+                        default="bench_bandwidth.json"
+                        )
+    parser.add_argument("--tmp_dir",
+                        help="Where the files are written (default: system temp).",
+                        type=str
+                        )
+    parser.add_argument("--send",
+                        help=argparse.SUPPRESS,
+                        type=str
+                        )
+    parser.add_argument("--port",
+                        help=argparse.SUPPRESS,
+                        type=int
+                        )
+    parser.add_argument("--rate",
+                        help=argparse.SUPPRESS,
+                        type=int,
+                        default=0
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "alternative_scripts")
+ENTRY_POINT = os.path.join(SCRIPTS_DIR, "ena.py")
+TEMPLATE_DIR = os.path.join(SCRIPTS_DIR, "..", "data", "templates")
+
+# Modules that must not be loaded by the help and dry-run paths
+HEAVY_MODULES = ["pandas", "numpy", "bs4", "lxml", "openpyxl"]
+
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = []
+        for name, command in get_cases(tmp_dir).items():
+            result = measure(name, command, repeats=args.repeats)
+            result["over_budget"] = result["imports_ms"] > args.budget_ms
+            results.append(result)
+
+    failed = False
+    for result in results:
+        status = "OK"
+        if result["heavy_modules"]:
+            status = f"LOADS {', '.join(result['heavy_modules'])}"
+        elif result["over_budget"]:
+            status = f"OVER {args.budget_ms:.0f} ms"
+        failed = failed or status != "OK"
+
+        print(f"{result['case']:<20} imports {result['imports_ms']:6.1f} ms "
+              f"(wall {result['wall_ms']:6.1f} ms)  {status}")
+
+    if args.output:
+        with open(args.output, mode="w") as handle:
+            json.dump({"budget_ms": args.budget_ms, "results": results}, handle, indent=2)
+
+    if failed:
+        sys.exit(1)
+
+
+def get_cases(tmp_dir: str) -> dict:
+    # Minimal campaign so that the dry runs get past the argument checks
+    metadata_path = os.path.join(tmp_dir, "BENCH_ena_submission.xlsx")
+    mapping_path = os.path.join(tmp_dir, "map.tsv")
+    with open(mapping_path, mode="w") as handle:
+        handle.write("forward\treverse\tsample_alias\n")
+        handle.write("S1_1.fastq.gz\tS1_2.fastq.gz\tAA_000000_F\n")
+    for name in ("S1_1.fastq.gz", "S1_2.fastq.gz"):
+        open(os.path.join(tmp_dir, name), mode="wb").close()
+
+    cases = {"help": ["-h"]}
+    for command in ("samples", "experiment", "run", "run-mapping",
+                    "upload", "register", "pipeline", "batch"):
+        cases[f"{command} -h"] = [command, "-h"]
+
+    cases["upload --dry_run"] = [
+        "upload", "-e", "16S", "-a", tmp_dir, "-k", mapping_path,
+        "-u", "Webin-0", "--dry_run"
+    ]
+    cases["register dry-run"] = [
+        "register", "-i", metadata_path, "-t", TEMPLATE_DIR, "-x", "null"
+    ]
+
+    return cases
+
+
+def measure(name: str, command: list, repeats: int) -> dict:
+    wall_times = []
+    import_times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", ENTRY_POINT] + command,
+            capture_output=True,
+            text=True
+        )
+        wall_times.append((time.perf_counter() - start_time) * 1000)
+
+        if process.returncode != 0:
+            raise RuntimeError(f"{name} failed:\n{process.stdout}\n{process.stderr}")
+
+        imports = parse_importtime(process.stderr)
+        import_times.append(sum(self_us for self_us, _ in imports.values()) / 1000)
+
+    loaded = {module.split(".")[0] for module in imports}
+
+    return {
+        "case": name,
+        "command": command,
+        "wall_ms": statistics.median(wall_times),
+        "imports_ms": statistics.median(import_times),
+        "heavy_modules": sorted(loaded & set(HEAVY_MODULES))
+    }
+
+
+def parse_importtime(stderr: str) -> dict:
+    # import time: self [us] | cumulative | imported package
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        imports[module.strip()] = (int(self_us), int(cumulative_us))
+
+    return imports
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Import time of the entry point")
+    parser.add_argument("-b", "--budget_ms",
+                        help="Maximum import time (median, ms) of each help or dry-run command.",
+                        type=float,
+                        default=150
+                        )
+    parser.add_argument("-r", "--repeats",
+                        help="Runs of each command, the median is reported.",
+                        type=int,
+                        default=5
+                        )
+    parser.add_argument("-o", "--output",
+                        help="JSON file where the results are saved.",
+                        type=str
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "alternative_scripts"))
+
+import run_status
+
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as base_dir:
+        metadata_path = os.path.join(base_dir, "MOCK_ena_submission.xlsx")
+        expected = make_campaign(metadata_path, args.runs, args.problems, seed=args.seed)
+        rows = make_reports(expected, args.other_runs)
+
+        with MockReports(rows, latency=args.latency) as server:
+            runs = run_status.load_runs(metadata_path)
+            client = run_status.ReportsClient(
+                base_url=server.url,
+                user_password="Webin-0:mock",
+                cache_path=run_status.report_path(metadata_path, "ena_reports_cache.json"),
+                workers=args.workers,
+                page_size=args.page_size
+            )
+
+            polls = []
+            for label in ("first poll", "unchanged", "one run changed"):
+                if label == "one run changed":
+                    server.complete_one()
+                start_time = time.perf_counter()
+                requests, not_modified = client.requests, client.not_modified
+                with open(os.devnull, mode="w") as devnull, contextlib.redirect_stdout(devnull):
+                    results = run_status.poll(runs, client)
+                polls.append({
+                    "poll": label,
+                    "wall_s": time.perf_counter() - start_time,
+                    "requests": client.requests - requests,
+                    "not_modified": client.not_modified - not_modified,
+                    "bytes": server.take_bytes(),
+                    "results": results
+                })
+                print(f"[BENCH] {label:<16} {polls[-1]['wall_s']:6.2f}s  {polls[-1]['requests']:4d} requests  "
+                      f"{polls[-1]['not_modified']:4d} not modified  {polls[-1]['bytes'] / 1e6:7.2f} MB")
+
+    found = {
+        (result["run_accession"], result["status"])
+        for result in polls[0]["results"] if result["status"] != "OK"
+    }
+    missing = set(expected["problems"]) - found
+    unexpected = found - set(expected["problems"])
+    for accession, status in sorted(missing):
+        print(f"[!] Not reported: {accession} {status}")
+    for accession, status in sorted(unexpected):
+        print(f"[!] Reported but not injected: {accession} {status}")
+    print(f"[BENCH] {len(found & set(expected['problems']))}/{len(expected['problems'])} injected problems reported")
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "runs": args.runs,
+        "other_runs": args.other_runs,
+        "page_size": args.page_size,
+        "workers": args.workers,
+        "latency_s": args.latency,
+        "polls": [{key: value for key, value in poll.items() if key != "results"} for poll in polls]
+    }
+    with open(args.output, mode="w") as handle:
+        json.dump(report, handle, indent=2)
+    print(f"[BENCH] Results written to {args.output}")
+
+    if missing or unexpected:
+        sys.exit(1)
+
+
+def make_campaign(metadata_path: str, n_runs: int, n_problems: int, seed: int = 0) -> dict:
+    """
+    Writes the object receipt and run XML of n_runs paired runs, and picks
+    the injected problems: MD5 mismatch, missing file, failed and pending runs.
+    Returns:
+        dict: 'runs' (accession -> {file name: MD5}) and 'problems' ((accession, status) list).
+    """
+    generator = random.Random(seed)
+    runs = {}
+    receipt = ['<RECEIPT receiptDate="2024-01-01T00:00:00.000Z" success="true">']
+    run_xml = ["<RUN_SET>"]
+    for index in range(n_runs):
+        accession = f"ERR{9000000 + index}"
+        alias = f"run_MOCK-S{index}-16S"
+        files = {
+            f"S{index}_{direction}.fastq.gz": hashlib.md5(f"{seed}{index}{direction}".encode()).hexdigest()
+            for direction in (1, 2)
+        }
+        runs[accession] = files
+        receipt.append(f'<RUN accession="{accession}" alias="{alias}" status="PRIVATE"/>')
+        run_xml.append(f'<RUN alias="{alias}"><EXPERIMENT_REF refname="{alias[4:]}"/><DATA_BLOCK><FILES>')
+        run_xml.extend(
+            f'<FILE filename="{name}" filetype="fastq" checksum_method="MD5" checksum="{md5}"/>'
+            for name, md5 in files.items()
+        )
+        run_xml.append("</FILES></DATA_BLOCK></RUN>")
+    receipt.append("</RECEIPT>")
+    run_xml.append("</RUN_SET>")
+
+    with open(run_status.report_path(metadata_path, "ena_object_receipt.xml"), mode="w") as handle:
+        handle.write("\n".join(receipt))
+    with open(run_status.report_path(metadata_path, "ena_run.xml"), mode="w") as handle:
+        handle.write("\n".join(run_xml))
+
+    statuses = ["MD5_MISMATCH", "MISSING_FILE", "FAILED", "PENDING"]
+    chosen = generator.sample(sorted(runs), min(n_problems, len(runs)))
+    problems = [(accession, statuses[i % len(statuses)]) for i, accession in enumerate(chosen)]
+
+    return {"runs": runs, "problems": problems}
+
+
+def make_reports(expected: dict, other_runs: int) -> dict:
+    # Listings of the account: the campaign runs among older ones of other campaigns
+    problems = dict(expected["problems"])
+    processes, files = [], []
+    for index in range(other_runs):
+        accession = f"ERR{1000000 + index}"
+        processes.append({"id": accession, "processingStatus": "COMPLETED", "processingError": None})
+        files.extend(
+            {"runId": accession, "fileName": f"old/{accession}_{d}.fastq.gz", "fileFormat": "FASTQ",
+             "md5": hashlib.md5(f"{accession}{d}".encode()).hexdigest(), "fileSize": 10 ** 9}
+            for d in (1, 2)
+        )
+
+    for accession, run_files in expected["runs"].items():
+        problem = problems.get(accession)
+        if problem == "PENDING":
+            processes.append({"id": accession, "processingStatus": "PENDING", "processingError": None})
+            continue
+        if problem == "FAILED":
+            processes.append({"id": accession, "processingStatus": "FAILED",
+                              "processingError": "Invalid FASTQ file: unexpected end of file"})
+            continue
+        processes.append({"id": accession, "processingStatus": "COMPLETED", "processingError": None})
+        for position, (name, md5) in enumerate(run_files.items()):
+            if problem == "MISSING_FILE" and position == 1:
+                continue
+            if problem == "MD5_MISMATCH" and position == 0:
+                md5 = hashlib.md5(md5.encode()).hexdigest()
+            files.append({"runId": accession, "fileName": f"{accession}/{name}", "fileFormat": "FASTQ",
+                          "md5": md5, "fileSize": 10 ** 9})
+
+    return {"run-processes": processes, "run-files": files}
+
+
+class MockReports:
+    """
+    Local stand-in for the Webin reports service: the run-processes and
+    run-files listings in JSON, paged with max/offset, with an ETag per page
+    (304 when it matches If-None-Match), Basic authentication and a fixed
+    latency per request.
+    """
+
+    def __init__(self, rows: dict, latency: float = 0.05):
+        self.rows = rows
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.bytes = 0
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(mock.latency)
+                url = urllib.parse.urlparse(self.path)
+                report = url.path.strip("/").split("/")[-1]
+                query = urllib.parse.parse_qs(url.query)
+                if not self.headers.get("Authorization", "").startswith("Basic "):
+                    self.send_error(401)
+                    return
+                if report not in mock.rows:
+                    self.send_error(404)
+                    return
+
+                offset = int(query.get("offset", ["0"])[0])
+                size = int(query.get("max", ["100"])[0])
+                with mock.lock:
+                    page = [{"report": row, "links": []} for row in mock.rows[report][offset:offset + size]]
+                body = json.dumps(page).encode()
+                etag = f'"{hashlib.md5(body).hexdigest()}"'
+
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+                with mock.lock:
+                    mock.bytes += len(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/ena/submit/report/"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def complete_one(self) -> None:
+        # A pending run finishes: only the last page of run-processes changes
+        with self.lock:
+            for row in reversed(self.rows["run-processes"]):
+                if row["processingStatus"] == "PENDING":
+                    row["processingStatus"] = "COMPLETED"
+                    return
+
+    def take_bytes(self) -> int:
+        with self.lock:
+            sent, self.bytes = self.bytes, 0
+        return sent
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark of the run status poller on a local mock of the reports service")
+    parser.add_argument("-n", "--runs",
+                        help="Runs of the campaign.",
+                        type=int,
+                        default=2000
+                        )
+    parser.add_argument("--other_runs",
+                        help="Runs of older campaigns in the same account listings.",
+                        type=int,
+                        default=20000
+                        )
+    parser.add_argument("--problems",
+                        help="Runs with an injected problem (mismatch, missing file, failed, pending).",
+                        type=int,
+                        default=8
+                        )
+    parser.add_argument("--page_size",
+                        help="Rows per page.",
+                        type=int,
+                        default=run_status.PAGE_SIZE
+                        )
+    parser.add_argument("-j", "--workers",
+                        help="Pages requested at the same time.",
+                        type=int,
+                        default=run_status.DEFAULT_WORKERS
+                        )
+    parser.add_argument("--latency",
+                        help="Seconds the mock waits before answering a request.",
+                        type=float,
+                        default=0.1
+                        )
+    parser.add_argument("--seed",
+                        help="Seed of the injected problems.",
+                        type=int,
+                        default=0
+                        )
+    parser.add_argument("-o", "--output",
+                        help="JSON file where the results are saved.",
+                        type=str,
+                        default="bench_reports.json"
+                        )
+    parser.add_argument("--tmp_dir",
+                        help="Where the campaign files are written (default: system temp).",
+                        type=str
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
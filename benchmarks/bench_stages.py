@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "alternative_scripts"))
+
+import synthetic
+import metadata_cache
+import s01_create_samples_xml as s01
+import s02_create_experiment_xml as s02
+import s03_create_run_xml as s03
+import s04_upload_files as s04
+import s05_register_object as s05
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "templates")
+FORWARD_PATTERN_DICT = {"16S": "*1.fastq.gz", "WGS": "*1.fq.gz"}
+
+
+def main():
+    args = parse_args()
+
+    results = []
+    for n_samples in args.scales:
+        with tempfile.TemporaryDirectory(dir=args.tmp_dir) as base_dir:
+            print(f"[BENCH] Generating {n_samples} samples ...")
+            campaign = synthetic.make_campaign(
+                base_dir=base_dir,
+                project_name="SYNTH",
+                n_samples=n_samples,
+                n_reads=args.reads,
+                experiment_types=args.experiment_types
+            )
+            flat_campaign = synthetic.make_campaign(
+                base_dir=base_dir,
+                project_name="FLAT",
+                n_samples=n_samples,
+                n_reads=args.reads,
+                experiment_types=args.experiment_types,
+                nested=False
+            )
+
+            for stage, function in get_stages(campaign, flat_campaign, args.experiment_types):
+                result = measure(stage, function, repeats=args.repeats)
+                result["samples"] = n_samples
+                results.append(result)
+                print(f"[BENCH] {stage:<24} {n_samples:>6} samples  "
+                      f"{result['wall_s']:8.3f}s wall  {result['cpu_s']:8.3f}s cpu  "
+                      f"{result['peak_mb']:8.1f} MB peak")
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "reads_per_file": args.reads,
+        "experiment_types": args.experiment_types,
+        "results": results
+    }
+
+    with open(args.output, mode="w") as handle:
+        json.dump(report, handle, indent=2)
+    print(f"[BENCH][+] Results saved to: {args.output}")
+
+    if args.compare:
+        regressions = compare(args.compare, report, threshold=args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+def get_stages(campaign: dict, flat_campaign: dict, experiment_types: list) -> list:
+    """
+    Returns (name, function) pairs, in pipeline order since the later stages
+    read the XML files written by the earlier ones. Every call starts from the
+    same state: outputs, checksum store and metadata cache are removed first.
+    """
+    campaign_dir = campaign["campaign_dir"]
+    metadata_path = campaign["metadata_path"]
+
+    def clean(*names):
+        metadata_cache.clear()
+        for name in names:
+            path = os.path.join(campaign_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def create_samples_file():
+        clean("SYNTH_ena_samples.xml")
+        s01.create_samples_file(metadata_path=metadata_path, template_dir=TEMPLATE_DIR)
+
+    def create_experiment():
+        clean("SYNTH_ena_experiment.xml")
+        s02.create_experiment(
+            samples_receipt_path=campaign["samples_receipt_path"],
+            metadata_path=metadata_path,
+            samples_dir=campaign["samples_dir"],
+            template_dir=TEMPLATE_DIR,
+            forward_pattern_dict=FORWARD_PATTERN_DICT,
+            experiment_types=experiment_types,
+            check=False
+        )
+
+    def create_run():
+        # Cold run: no cached checksum, no MD5.txt from a previous repeat
+        clean("SYNTH_ena_run.xml", "ena_checksums.sqlite")
+        for root, _, files in os.walk(campaign["samples_dir"]):
+            if "MD5.txt" in files:
+                os.remove(os.path.join(root, "MD5.txt"))
+        s03.create_run(
+            metadata_path=metadata_path,
+            samples_dir=campaign["samples_dir"],
+            template_dir=TEMPLATE_DIR,
+            forward_pattern_dict=FORWARD_PATTERN_DICT,
+            experiment_types=experiment_types
+        )
+
+    def gather_files():
+        for experiment_type in experiment_types:
+            samples_dir = os.path.join(flat_campaign["samples_dir"], experiment_type)
+            s04.gather_files(
+                experiment_type=experiment_type,
+                WGS_samples_dir=samples_dir,
+                AMP_samples_dir=samples_dir,
+                mapping_WGS=flat_campaign["mapping_paths"].get("WGS"),
+                mapping_AMP=flat_campaign["mapping_paths"].get("16S")
+            )
+
+    def parse_objects_receipts():
+        object_receipt_path = os.path.join(campaign_dir, "SYNTH_ena_object_receipt.xml")
+        if not os.path.exists(object_receipt_path):
+            synthetic.make_object_receipt(
+                object_receipt_path,
+                project_name="SYNTH",
+                aliases=campaign["aliases"],
+                experiment_types=experiment_types
+            )
+        for experiment_type in experiment_types:
+            s05.parse_objects_receipts(
+                metadata_path=metadata_path,
+                template_dir=TEMPLATE_DIR,
+                experiment_type=experiment_type
+            )
+
+    return [
+        ("create_samples_file", create_samples_file),
+        ("create_experiment", create_experiment),
+        ("create_run", create_run),
+        ("gather_files", gather_files),
+        ("parse_objects_receipts", parse_objects_receipts)
+    ]
+
+
+def measure(stage: str, function, repeats: int) -> dict:
+    # Time and memory are measured in separate calls, tracemalloc slows down the code
+    wall_times = []
+    cpu_times = []
+    with open(os.devnull, mode="w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeats):
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
+            function()
+            cpu_times.append(time.process_time() - start_cpu)
+            wall_times.append(time.perf_counter() - start_wall)
+
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "stage": stage,
+        "wall_s": min(wall_times),
+        "cpu_s": min(cpu_times),
+        "peak_mb": peak / (1024 * 1024)
+    }
+
+
+def compare(baseline_path: str, report: dict, threshold: float) -> list:
+    """
+    Prints the ratio to a previous report and returns the regressions, i.e.
+    the stages and scales whose wall time or peak memory grew over threshold.
+    """
+    with open(baseline_path, mode="r") as handle:
+        baseline = json.load(handle)
+
+    previous = {
+        (result["stage"], result["samples"]): result
+        for result in baseline["results"]
+    }
+
+    regressions = []
+    for result in report["results"]:
+        key = (result["stage"], result["samples"])
+        if key not in previous:
+            continue
+
+        for metric in ("wall_s", "peak_mb"):
+            before = previous[key][metric]
+            ratio = result[metric] / before if before else 1.0
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  [!] REGRESSION"
+                regressions.append((key, metric, ratio))
+            print(f"[COMPARE] {key[0]:<24} {key[1]:>6} samples  {metric:<8} x{ratio:5.2f}{flag}")
+
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark of the pipeline stages")
+    parser.add_argument("-s", "--scales",
+                        help="Comma separated numbers of samples.",
+                        type=lambda t: [int(s) for s in t.split(",")],
+                        default=[10, 100, 1000]
+                        )
+    parser.add_argument("-r", "--reads",
+                        help="Reads per FASTQ file (150 bp).",
+                        type=int,
+                        default=1000
+                        )
+    parser.add_argument("-e", "--experiment_types",
+                        help="String defining either 16S, WGS or both.",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=["16S", "WGS"]
+                        )
+    parser.add_argument("-n", "--repeats",
+                        help="Timed calls of each stage, the fastest is reported.",
+                        type=int,
+                        default=3
+                        )
+    parser.add_argument("-o", "--output",
+                        help="JSON file where the results are saved.",
+                        type=str,
+                        default="bench_stages.json"
+                        )
+    parser.add_argument("-c", "--compare",
+                        help="Results of a previous run: exit with an error on regressions.",
+                        type=str
+                        )
+    parser.add_argument("--threshold",
+                        help="Relative growth counted as a regression (0.2 = 20%%).",
+                        type=float,
+                        default=0.2
+                        )
+    parser.add_argument("--tmp_dir",
+                        help="Where the synthetic campaigns are written (default: system temp).",
+                        type=str
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import argparse
+
+
+# Columns of the sample_submission sheet read by s01/s02
+METADATA_COLUMNS = [
+    "sample_alias",
+    "sample_title",
+    "tax_id",
+    "scientific_name",
+    "project name",
+    "collection date",
+    "geographic location (latitude)",
+    "geographic location (longitude)",
+    "broad-scale environmental context",
+    "local environmental context",
+    "environmental medium",
+    "elevation",
+    "geographic location (country and/or sea)",
+    "geographic location (region and locality)",
+    "depth"
+]
+
+# Random bytes -> nucleotides and Phred qualities, much faster than random.choice
+BASES = bytes((b"ACGT"[i % 4] for i in range(256)))
+QUALITIES = bytes((ord("5") + i % 10 for i in range(256)))
+
+
+def sample_aliases(n_samples: int) -> list:
+    # Three fields, as s03 takes the sample alias from the file name
+    return [f"SY_{230000 + i:06d}_F" for i in range(n_samples)]
+
+
+def make_submission_xlsx(
+    metadata_path: str,
+    n_samples: int,
+    project_accession: str = "PRJEB00000"
+) -> list:
+    """
+    Writes an ENA submission spreadsheet with n_samples rows.
+    Returns:
+        list: The sample aliases.
+    """
+    import pandas as pd
+
+    aliases = sample_aliases(n_samples)
+
+    # First row is the units row dropped by load_metadata
+    rows = [["#units"] + [""] * (len(METADATA_COLUMNS) - 1)]
+    for i, alias in enumerate(aliases):
+        rows.append([
+            alias,
+            f"Synthetic sample {i}",
+            "412755",
+            "marine sediment metagenome",
+            project_accession,
+            f"2023-{1 + i % 12:02d}-{1 + i % 28:02d}",
+            f"{40 + (i % 1000) / 1000:.4f}",
+            f"{14 + (i % 1000) / 1000:.4f}",
+            "marine biome",
+            "hydrothermal vent",
+            "sediment",
+            str(i % 50),
+            "Italy",
+            "Campania, Naples",
+            str(i % 100)
+        ])
+
+    pd.DataFrame(rows, columns=METADATA_COLUMNS).to_excel(
+        metadata_path,
+        sheet_name="sample_submission",
+        index=False
+    )
+
+    return aliases
+
+
+def make_fastq_gz(
+    file_path: str,
+    n_reads: int,
+    read_length: int = 150,
+    direction: int = 1,
+    flowcell: str = "HSYNTH01",
+    lane: int = 1,
+    seed: bytes = b""
+) -> None:
+    """
+    Writes a gzipped FASTQ file with Illumina (Casava 1.8) read headers.
+    """
+    with gzip.open(file_path, mode="wb", compresslevel=1) as handle:
+        for start in range(0, n_reads, 10000):
+            records = []
+            for i in range(start, min(start + 10000, n_reads)):
+                sequence = os.urandom(read_length).translate(BASES)
+                quality = os.urandom(read_length).translate(QUALITIES)
+                records.append(
+                    b"@SYNTH:1:%s:%d:1101:%d:%d %d:N:0:ACGTACGT%s\n%s\n+\n%s\n" % (
+                        flowcell.encode(), lane, 1000 + i % 20000, i,
+                        direction, seed, sequence, quality
+                    )
+                )
+            handle.write(b"".join(records))
+
+
+def make_sequence_tree(
+    samples_dir: str,
+    aliases: list,
+    experiment_types: list,
+    n_reads: int,
+    nested: bool = True
+) -> dict:
+    """
+    Writes the paired FASTQ files of every sample.
+    Nested layout: {samples_dir}/16_S|Metagenomes/{alias}/{alias}_1.fastq.gz|fq.gz,
+    as globbed by s03. Flat layout: {samples_dir}/{experiment}/{alias}_1.fastq.gz,
+    as listed in the mapping tables of s03_singleReadsFolder/s04.
+    Returns:
+        dict: experiment type -> list of (forward, reverse, alias) file names.
+    """
+    exp_dirs = {"16S": "16_S", "WGS": "Metagenomes"}
+    extensions = {"16S": "fastq.gz", "WGS": "fq.gz"}
+
+    files = {}
+    for experiment_type in experiment_types:
+        files[experiment_type] = []
+        for alias in aliases:
+            if nested:
+                file_dir = os.path.join(samples_dir, exp_dirs[experiment_type], alias)
+            else:
+                file_dir = os.path.join(samples_dir, experiment_type)
+            os.makedirs(file_dir, exist_ok=True)
+
+            names = []
+            for direction in (1, 2):
+                name = f"{alias}_{direction}.{extensions[experiment_type]}"
+                make_fastq_gz(
+                    os.path.join(file_dir, name),
+                    n_reads=n_reads,
+                    direction=direction
+                )
+                names.append(name)
+
+            files[experiment_type].append((names[0], names[1], alias))
+
+    return files
+
+
+def make_mapping_tsv(mapping_path: str, entries: list) -> None:
+    with open(mapping_path, mode="w") as handle:
+        handle.write("forward\treverse\tsample_alias\n")
+        for forward, reverse, alias in entries:
+            handle.write(f"{forward}\t{reverse}\t{alias}\n")
+
+
+def make_samples_receipt(receipt_path: str, aliases: list) -> None:
+    samples = "\n".join(
+        f'  <SAMPLE accession="ERS{1000000 + i}" alias="{alias}" status="PRIVATE">\n'
+        f'    <EXT_ID accession="SAMEA{1000000 + i}" type="biosample"/>\n'
+        f'  </SAMPLE>'
+        for i, alias in enumerate(aliases)
+    )
+    write_receipt(receipt_path, samples)
+
+
+def make_object_receipt(
+    receipt_path: str,
+    project_name: str,
+    aliases: list,
+    experiment_types: list
+) -> None:
+    objects = []
+    i = 0
+    for experiment_type in experiment_types:
+        for alias in aliases:
+            exp_alias = f"{project_name}-{alias}-{experiment_type}"
+            objects.append(
+                f'  <EXPERIMENT accession="ERX{1000000 + i}" alias="{exp_alias}" status="PRIVATE"/>\n'
+                f'  <RUN accession="ERR{1000000 + i}" alias="run_{exp_alias}" status="PRIVATE"/>'
+            )
+            i += 1
+    write_receipt(receipt_path, "\n".join(objects))
+
+
+def write_receipt(receipt_path: str, body: str) -> None:
+    with open(receipt_path, mode="w") as handle:
+        handle.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<RECEIPT receiptDate="2025-01-01T00:00:00.000Z" submissionFile="submission.xml" success="true">\n'
+            f'{body}\n'
+            '  <SUBMISSION accession="ERA0000000" alias="SUBMISSION"/>\n'
+            '  <MESSAGES><INFO>Submission has been committed.</INFO></MESSAGES>\n'
+            '  <ACTIONS>ADD</ACTIONS>\n'
+            '</RECEIPT>\n'
+        )
+
+
+def make_campaign(
+    base_dir: str,
+    project_name: str,
+    n_samples: int,
+    n_reads: int,
+    experiment_types: list,
+    nested: bool = True
+) -> dict:
+    """
+    Writes a complete synthetic campaign: spreadsheet, sequences, mapping
+    tables and samples receipt, laid out as data/<campaign>/.
+    Returns:
+        dict: Paths of the generated inputs.
+    """
+    campaign_dir = os.path.join(base_dir, project_name)
+    samples_dir = os.path.join(base_dir, f"{project_name}_sequences")
+    os.makedirs(campaign_dir, exist_ok=True)
+
+    metadata_path = os.path.join(campaign_dir, f"{project_name}_ena_submission.xlsx")
+    aliases = make_submission_xlsx(metadata_path, n_samples)
+
+    files = make_sequence_tree(
+        samples_dir=samples_dir,
+        aliases=aliases,
+        experiment_types=experiment_types,
+        n_reads=n_reads,
+        nested=nested
+    )
+
+    mapping_paths = {}
+    for experiment_type, entries in files.items():
+        mapping_paths[experiment_type] = os.path.join(campaign_dir, f"map_{experiment_type}.tsv")
+        make_mapping_tsv(mapping_paths[experiment_type], entries)
+
+    samples_receipt_path = os.path.join(campaign_dir, f"{project_name}_ena_samples_receipt.xml")
+    make_samples_receipt(samples_receipt_path, aliases)
+
+    return {
+        "campaign_dir": campaign_dir,
+        "samples_dir": samples_dir,
+        "metadata_path": metadata_path,
+        "mapping_paths": mapping_paths,
+        "samples_receipt_path": samples_receipt_path,
+        "aliases": aliases
+    }
+
+
+def main():
+    args = parse_args()
+
+    campaign = make_campaign(
+        base_dir=args.output_dir,
+        project_name=args.project_name,
+        n_samples=args.samples,
+        n_reads=args.reads,
+        experiment_types=args.experiment_types,
+        nested=not args.flat
+    )
+
+    print(f"[+] Synthetic campaign written to: {campaign['campaign_dir']}")
+    print(f"[+] Sequences written to:          {campaign['samples_dir']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Synthetic campaign")
+    parser.add_argument("-o", "--output_dir",
+                        help="Directory where the campaign folder is created.",
+                        type=str,
+                        required=True
+                        )
+    parser.add_argument("-p", "--project_name",
+                        help="Project name, first field of the spreadsheet name.",
+                        type=str,
+                        default="SYNTH"
+                        )
+    parser.add_argument("-n", "--samples",
+                        help="Number of samples.",
+                        type=int,
+                        default=10
+                        )
+    parser.add_argument("-r", "--reads",
+                        help="Reads per FASTQ file (150 bp).",
+                        type=int,
+                        default=1000
+                        )
+    parser.add_argument("-e", "--experiment_types",
+                        help="String defining either 16S, WGS or both.",
+                        type=lambda t: [s.strip() for s in t.split(",")],
+                        default=["16S", "WGS"]
+                        )
+    parser.add_argument("--flat",
+                        action="store_true",
+                        help="Put all the files of an experiment in one folder instead of one per sample."
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()